@@ -44,6 +44,8 @@ class FlatfieldGroup(QGroupBox):
 
         self.flat_scan_progress = QProgressBar(self)
 
+        self.flat_parallel_box = QCheckBox("Compute the flatfield on several processes")
+
         self.flatfield_label = QLabel("Flatfield name : ")
         self.flatfield_output = QLineEdit()
 
@@ -95,6 +97,7 @@ class FlatfieldGroup(QGroupBox):
         self.grid_layout.addWidget(self.flatfield_output, 2, 1)
         self.grid_layout.addWidget(self.flat_save_button, 2, 2)
         # self.grid_layout.addWidget(self.flat_use_box, 2, 3)
+        self.grid_layout.addWidget(self.flat_parallel_box, 2, 3)
         self.grid_layout.addWidget(self.flat_scan_viewer, 4, 0, -1, -1)
 
     def generate_flatfield(self) -> None:
@@ -109,10 +112,12 @@ class FlatfieldGroup(QGroupBox):
                     first_scan_number, last_scan_number = last_scan_number, first_scan_number
             else:
                 last_scan_number = first_scan_number
+            # Spread the scans over all the cores if asked
+            workers = (os.cpu_count() or 1) if self.flat_parallel_box.isChecked() else 1
             # Generate the flatfield file
             try:
                 self.result = gen_flatfield(first_scan_number, last_scan_number, self._parent.flat_scan,
-                                            self.flat_scan_progress, self.application)
+                                            self.flat_scan_progress, self.application, workers)
                 self.flatfield_output.setText(f"flatfield_{first_scan_number}_{last_scan_number}")
                 self.flat_scan_viewer.addImage(self.result)
                 # We emit the signal when the flatfield had been computed,
@@ -1,32 +1,54 @@
-import statistics
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from multiprocessing import get_context
 
 import numpy
-from PyQt5.QtWidgets import QWidget, QVBoxLayout
+import os
+from PyQt5.QtCore import pyqtSignal, Qt, QTimer
+from PyQt5.QtWidgets import QApplication, QCheckBox, QMessageBox, QWidget, QVBoxLayout, QPushButton
 from silx.gui.data.NumpyAxesSelector import NumpyAxesSelector
 from silx.gui.plot import Plot1D
-from silx.math.fit import FitManager
+from silx.gui.utils import blockSignals
 
-from utils.fitAction import pearson7bg, estimate_pearson7
+from utils.fitFunctions import fit_diagram_peaks_in_process, fit_diagram_stack, track_diagram_peaks_in_process
+from utils.progressWidget import ProgressWidget
 
 import matplotlib.pyplot as plt
 from scipy.signal import find_peaks
 
+# Number of consecutive diagrams tracked at once by a process of the pool, a block starting from the last fitted
+# parameters of the previous one
+TRACKING_BLOCK_SIZE = 16
+
 class FittingDataTab(QWidget):
+    # Generation of the automatic fit, index of the diagram and its fitted peaks, emitted by the threads of the pool
+    diagramFitted = pyqtSignal(int, int, object)
+    # Generation of the automatic fit whose processes died, and the error, emitted by the threads of the pool
+    poolLost = pyqtSignal(int, str)
+
     def __init__(self, parent, data_to_fit=None):
         super().__init__(parent)
         self._data_to_fit = data_to_fit
-        self._fitted_data = []
+        # Fitted peaks of each diagram, None until its fit is done
+        self._fitted_peaks = []
         self.layout = QVBoxLayout(self)
         self.automatic_plot = Plot1D(self)
         self.fitting_data_selector = NumpyAxesSelector(self)
-        self.fit = FitManager()
+        self.tracking_box = QCheckBox("Track the peaks from one diagram to the next", self)
+        self.stack_fit_button = QPushButton("Fit the whole stack at once", self)
+        self.cancel_button = QPushButton("Cancel the automatic fit", self)
 
-        self.fit.addtheory("pearson7", function=pearson7bg,
-                           parameters=['backgr', 'slopeLin',
-                                       'amplitude', 'center',
-                                       'fwhm', 'exposant'
-                                       ],
-                           estimate=estimate_pearson7)
+        # Processes of the automatic fit, started with the first one
+        self.executor = None
+        self.futures = []
+        self.fit_generation = 0
+        self.nb_fitted = 0
+        self.tracking = False
+        # Last fitted parameters of each tracked peak, and the (start, stop) diagrams being tracked, None between blocks
+        self.tracking_parameters = []
+        self.tracked_block = None
+        self.progress = None
 
         """
         self.fitting_widget = self.fitting_data_plot.getFitAction()
@@ -40,17 +62,61 @@ class FittingDataTab(QWidget):
         self.setLayout(self.layout)
         self.layout.addWidget(self.automatic_plot)
         self.layout.addWidget(self.fitting_data_selector)
+        self.layout.addWidget(self.tracking_box)
+        self.layout.addWidget(self.stack_fit_button)
+        self.layout.addWidget(self.cancel_button)
 
         self.fitting_data_selector.setNamedAxesSelectorVisibility(False)
         self.fitting_data_selector.setVisible(True)
         self.fitting_data_selector.setAxisNames("12")
-        # self.fitting_data_selector.selectionChanged.connect(self.automatic_plot_fit)
+        self.fitting_data_selector.selectionChanged.connect(self.plot_fit)
+
+        self.tracking_box.toggled.connect(self.restart_automatic_fit)
+        self.stack_fit_button.clicked.connect(self.start_stack_fit)
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.cancel_automatic_fit)
+        self.diagramFitted.connect(self.add_fitted_diagram)
+        # Queued, so that the fit is not cancelled in the middle of a submission
+        self.poolLost.connect(self.handle_pool_lost, Qt.QueuedConnection)
+        QApplication.instance().aboutToQuit.connect(self.shutdown_automatic_fit)
 
     def set_data_to_fit(self, data_to_fit):
+        self.cancel_automatic_fit()
         self._data_to_fit = data_to_fit
+        self._fitted_peaks = [None] * len(data_to_fit)
         self.fitting_data_selector.setData(numpy.zeros((len(data_to_fit), 1, 1)))
         self.start_automatic_fit()
 
+    def add_data_to_fit(self, data_to_fit):
+        """Fit diagrams added at the end of the stack, of a scan being written, without fitting the others again."""
+        if not self._data_to_fit:
+            self.set_data_to_fit(data_to_fit)
+            return
+        start = len(self._data_to_fit)
+        # A fit cancelled by the user is not resumed for the new diagrams
+        fitting = self.progress is not None or self.nb_fitted == start
+        self._data_to_fit = self._data_to_fit + list(data_to_fit)
+        self._fitted_peaks += [None] * len(data_to_fit)
+        selection = self.fitting_data_selector.selection()
+        with blockSignals(self.fitting_data_selector):
+            self.fitting_data_selector.setData(numpy.zeros((len(self._data_to_fit), 1, 1)))
+            self.fitting_data_selector.setSelection(selection)
+        if not fitting or self.executor is None:
+            return
+        if self.progress is None:
+            self.progress = ProgressWidget('Fitting diagrams', len(data_to_fit))
+            self.cancel_button.setEnabled(True)
+        else:
+            self.progress.increase_maximum(len(data_to_fit))
+        generation = self.fit_generation
+        if not self.tracking:
+            self.submit_fits(generation, start, len(self._data_to_fit))
+        elif self._fitted_peaks[0] and self.tracked_block is None:
+            self.submit_tracking(generation, start)
+        elif self._fitted_peaks[0] is not None and not self._fitted_peaks[0]:
+            self.submit_fits(generation, start, len(self._data_to_fit))
+        # else the first diagram or a block is still being fitted, the new diagrams are tracked after them
+
     def automatic_fit(self):
         if self._data_to_fit is not None:
             prominence = max(self._data_to_fit[0][1][~numpy.isnan(self._data_to_fit[0][1])])
@@ -62,60 +128,181 @@ class FittingDataTab(QWidget):
             plt.show()
 
     def plot_fit(self):
-        if len(self._fitted_data) > 0 and len(self._data_to_fit) > 0:
-            self.automatic_plot.addCurve(self._data_to_fit[self.fitting_data_selector.selection()[0]][0],
-                               self._data_to_fit[self.fitting_data_selector.selection()[0]][1],
-                               'Data to fit')
-            self.automatic_plot.addCurve(self._fitted_data[self.fitting_data_selector.selection()[0]][0],
-                               self._fitted_data[self.fitting_data_selector.selection()[0]][1],
-                               'Fitted data')
-
-    def start_automatic_fit(self):
-        self.fit.settheory("pearson7")
+        if self._data_to_fit and self.fitting_data_selector.selection()[0] < len(self._data_to_fit):
+            index = self.fitting_data_selector.selection()[0]
+            self.automatic_plot.clear()
+            # plot the original curve, and each fitted peak once the fit of the diagram is done
+            self.automatic_plot.addCurve(self._data_to_fit[index][0], self._data_to_fit[index][1], 'Data to fit')
+            # a tracked peak keeps its number along the stack, and is None in the diagrams where it is lost
+            for cpt_peak, peak in enumerate(self._fitted_peaks[index] or []):
+                if peak is not None:
+                    self.automatic_plot.addCurve(peak[0], peak[1], f"Peak number {cpt_peak}")
+
+    def start_automatic_fit(self, stack: bool = False):
+        self.cancel_automatic_fit()
         print("Start fitting...")
-        for data in self._data_to_fit:
-            # copy the data arrays, with all the values even the nan ones to keep the size
-            # the copy is used to not erase data on arrays ploted in the last panel
-            x = data[0].copy()
-            y = data[1].copy()
-            # get the max of the y array without any nan value (it would be the maximum)
-            maximum = max(y[~numpy.isnan(y)])
-            # current maximum / peak we are looking for (for the first iteration it will be the max)
-            current_maximum = max(y[~numpy.isnan(y)])
-            try:
-                cpt_peak = 0
-                print("Searching peak and fitting it...")
-                # plot the original curve, were we are going to plot each fitted peak.
-                self.automatic_plot.addCurve(x, y, "Data to fit")
-                print("Max : ", maximum, " Current max : ", current_maximum)
-                # this threshold means that we only want peaks that are at least at 1/4 distance in y axis of the max.
-                while current_maximum > (maximum / 4.0):
-                    peak = numpy.where(y == current_maximum)[0][0]
-                    left = peak - 35 if peak - 35 > 0 else 0
-                    right = peak + 35 if peak + 35 < len(x) else len(x) - 1
-                    x_peak = x[left: right]
-                    y_peak = y[left: right]
-                    # set the data to fit, i.e only the peak without all the curve
-                    self.fit.setdata(x=x_peak, y=y_peak)
-                    # use the estimate function we made to make a first guess of the parameters of the function that will fit our peak.
-                    self.fit.estimate()
-                    # fit the function.
-                    self.fit.runfit()
-                    # draw the resulted function of the fit.
-                    self.automatic_plot.addCurve(x_peak,
-                                       pearson7bg(x_peak, *(param['fitresult'] for param in self.fit.fit_results)),
-                                       f"Peak number {cpt_peak}"
-                                       )
-                    self._fitted_data.append(self.automatic_plot.getActiveCurve())
-
-                    backgr = self.fit.fit_results[0]['fitresult']
-                    fwhm = self.fit.fit_results[4]['fitresult']
-
-                    # erase the peak to make it easier to found other peaks.
-                    y[left: right] = statistics.mean(y[~numpy.isnan(y)])
-                    current_maximum = max(y[~numpy.isnan(y)])
-                    cpt_peak += 1
-                    print("new current_max : ", current_maximum)
-
-            except (numpy.linalg.LinAlgError, TypeError):
-                print("Singular matrix error: fit is impossible with the given parameters")
\ No newline at end of file
+        self._fitted_peaks = [None] * len(self._data_to_fit)
+        self.nb_fitted = 0
+        if self.executor is None:
+            self.create_executor()
+        generation = self.fit_generation
+        self.progress = ProgressWidget('Fitting diagrams', len(self._data_to_fit))
+        self.cancel_button.setEnabled(True)
+        self.tracking = self.tracking_box.isChecked() and not stack
+        self.tracked_block = None
+        if stack:
+            diagrams = numpy.array([data[1] for data in self._data_to_fit])
+            future = self.submit(fit_diagram_stack, self._data_to_fit[0][0], diagrams)
+            future.add_done_callback(partial(self.emit_fitted_diagrams, generation, 0, len(self._data_to_fit)))
+            self.futures.append(future)
+        elif self.tracking:
+            # The peaks of the first diagram are looked for, the next diagrams start from them once fitted
+            self.submit_fits(generation, 0, 1)
+        else:
+            self.submit_fits(generation, 0, len(self._data_to_fit))
+        self.plot_fit()
+
+    def start_stack_fit(self):
+        # The peaks of all the diagrams are fitted together in one process, with parameters varying smoothly
+        if not self._data_to_fit:
+            return
+        self.start_automatic_fit(stack=True)
+
+    def restart_automatic_fit(self):
+        if self._data_to_fit:
+            self.start_automatic_fit()
+
+    def create_executor(self):
+        # Spawned processes, as for the flatfield, each one fitting with its own FitManager
+        self.executor = ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=get_context("spawn"))
+
+    def submit(self, function, *args):
+        """Submit a fit to the pool, started again when one of its processes died since the last fit."""
+        try:
+            return self.executor.submit(function, *args)
+        except BrokenProcessPool as error:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.create_executor()
+            # Shown once the submissions are done
+            QTimer.singleShot(0, partial(self.show_pool_error, f"The processes of the automatic fit stopped "
+                                                               f"({error}) and were started again."))
+            return self.executor.submit(function, *args)
+
+    def submit_fits(self, generation: int, start: int, stop: int):
+        for index in range(start, stop):
+            data = self._data_to_fit[index]
+            future = self.submit(fit_diagram_peaks_in_process, data[0], data[1])
+            future.add_done_callback(partial(self.emit_fitted_diagram, generation, index))
+            self.futures.append(future)
+
+    def submit_tracking(self, generation: int, start: int):
+        # The block starts from the last parameters of the peaks, found in the previous diagrams: the next block is
+        # submitted once its last diagram is fitted, see add_fitted_diagram. The peaks keep the numbers they have in
+        # the first diagram
+        stop = min(start + TRACKING_BLOCK_SIZE, len(self._data_to_fit))
+        x = self._data_to_fit[0][0]
+        diagrams = numpy.array([data[1] for data in self._data_to_fit[start: stop]])
+        future = self.submit(track_diagram_peaks_in_process, x, diagrams, list(self.tracking_parameters))
+        future.add_done_callback(partial(self.emit_fitted_diagrams, generation, start, stop))
+        self.futures.append(future)
+        self.tracked_block = (start, stop)
+
+    def emit_fitted_diagram(self, generation: int, index: int, future):
+        # Called by a thread of the pool, the signal brings the result to the gui thread
+        if future.cancelled():
+            return
+        try:
+            peaks = future.result()
+        except BrokenProcessPool as error:
+            # The diagram was not fitted, nor the others waiting in the pool
+            self.poolLost.emit(generation, str(error))
+            return
+        except Exception as error:
+            print(f"The fit of the diagram {index} failed: {error!r}")
+            peaks = []
+        self.diagramFitted.emit(generation, index, peaks)
+
+    def emit_fitted_diagrams(self, generation: int, start: int, stop: int, future):
+        if future.cancelled():
+            return
+        try:
+            diagrams_peaks = future.result()
+        except BrokenProcessPool as error:
+            self.poolLost.emit(generation, str(error))
+            return
+        except Exception as error:
+            print(f"The fit of the diagrams {start} to {stop - 1} failed: {error!r}")
+            diagrams_peaks = [[] for _ in range(start, stop)]
+        for index, peaks in enumerate(diagrams_peaks, start=start):
+            self.diagramFitted.emit(generation, index, peaks)
+
+    def add_fitted_diagram(self, generation: int, index: int, peaks: list):
+        # Results of a cancelled fit are dropped
+        if generation != self.fit_generation:
+            return
+        self._fitted_peaks[index] = peaks
+        self.nb_fitted += 1
+        self.progress.increase_progress()
+        if index == self.fitting_data_selector.selection()[0]:
+            self.plot_fit()
+        if self.tracking:
+            self.track_next_block(generation, index, peaks)
+        if self.nb_fitted == len(self._fitted_peaks):
+            self.futures = []
+            self.close_progress()
+            print("Fitting done.")
+
+    def track_next_block(self, generation: int, index: int, peaks: list):
+        if index == 0:
+            if not peaks:
+                # Nothing to track, each diagram is searched for peaks
+                self.submit_fits(generation, 1, len(self._fitted_peaks))
+                return
+            self.tracking_parameters = [parameters for _, _, parameters in peaks]
+            next_start = 1
+        else:
+            # A peak lost in this diagram goes on from its last known parameters
+            for number, peak in enumerate(peaks):
+                if peak is not None:
+                    self.tracking_parameters[number] = peak[2]
+            if self.tracked_block is None or index != self.tracked_block[1] - 1:
+                return
+            next_start = self.tracked_block[1]
+        self.tracked_block = None
+        if next_start < len(self._fitted_peaks):
+            self.submit_tracking(generation, next_start)
+
+    def handle_pool_lost(self, generation: int, error: str):
+        # The fits waiting in the dead pool are all lost, the next fit starts a new pool
+        if generation != self.fit_generation:
+            return
+        self.cancel_automatic_fit()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        self.show_pool_error(f"The processes of the automatic fit stopped ({error}). "
+                             "The fit was cancelled, start it again to fit the diagrams.")
+
+    def show_pool_error(self, message: str):
+        print(message)
+        QMessageBox(QMessageBox.Icon.Critical, "Automatic fit failed", message).exec()
+
+    def cancel_automatic_fit(self):
+        # Queued fits are cancelled, the running ones end in their process but are ignored
+        for future in self.futures:
+            future.cancel()
+        self.futures = []
+        self.fit_generation += 1
+        self.close_progress()
+
+    def shutdown_automatic_fit(self):
+        self.cancel_automatic_fit()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def close_progress(self):
+        self.cancel_button.setEnabled(False)
+        if self.progress is not None:
+            self.progress.deleteLater()
+            self.progress = None
@@ -1,11 +1,12 @@
-from pathlib import Path
 from PyQt5.QtCore import pyqtSignal
 from PyQt5.QtWidgets import QMessageBox
 from silx.gui.plot.actions import PlotAction
 
 from constants import SAVING_PATH
+from utils.exportFunctions import save_unfolded_stack, save_unfolded_text_files
 
-import numpy
+import os
+import threading
 
 
 class UnfoldWithFlatfield(PlotAction):
@@ -40,7 +41,45 @@ class Unfold(PlotAction):
         self.unfoldClicked.emit()
 
 
+class LevelOfDetail(PlotAction):
+    def __init__(self, plot, parent=None):
+        PlotAction.__init__(self,
+                            plot,
+                            icon='aggregation-mode',
+                            text='Level of detail',
+                            tooltip='Display the unfolded images with many points as images of the view, '
+                                    'computed again on zoom, instead of drawing every point',
+                            triggered=self.toggle_level_of_detail,
+                            checkable=True,
+                            parent=parent)
+        self.setChecked(True)
+
+    def toggle_level_of_detail(self):
+        self.parent().update_view()
+
+
+class DiskCache(PlotAction):
+    diskCacheToggled = pyqtSignal(bool)
+
+    def __init__(self, plot, parent=None):
+        PlotAction.__init__(self,
+                            plot,
+                            icon='document-save',
+                            text='Keep unfolded scans on disk',
+                            tooltip='Save the unfolded scans in the cache directory of the user, so that they are '
+                                    'not unfolded again in a new session',
+                            triggered=self.toggle_disk_cache,
+                            checkable=True,
+                            parent=parent)
+
+    def toggle_disk_cache(self, checked: bool):
+        self.diskCacheToggled.emit(checked)
+
+
 class SaveAction(PlotAction):
+    # Message of a saving that failed, emitted by the saving thread
+    savingFailed = pyqtSignal(str)
+
     def __init__(self, plot, parent):
         PlotAction.__init__(self,
                             plot,
@@ -50,23 +89,43 @@ class SaveAction(PlotAction):
                             triggered=self.save_images,
                             parent=parent)
         self.parent = parent
+        self.savingFailed.connect(self.show_saving_error)
 
     def save_images(self):
-        saved = QMessageBox(QMessageBox.Question, 'Saving unfolded data ?',
-                            "Do you want to save the unfolded images ?",
-                            QMessageBox.Ok | QMessageBox.Cancel).exec_()
-        if saved == QMessageBox.Ok:
-            path = SAVING_PATH + "\\unfolded_data"
-            for index, image in enumerate(self.parent.get_scatter_items()):
-                self.save_unfolded_data(image, index, path)
-                print(f"Saved unfolded image number {index} in {path} path")
-
-    def save_unfolded_data(self, image: numpy.ndarray, index: int, path: str):
-        Path(path).mkdir(parents=True, exist_ok=True)
-        xyz_line = ""
-        for i in range(len(image[0])):
-            xyz_line += "" + str(image[0][i]) + " " + str(image[1][i]) + " " + str(image[2][i]) + "\n"
-
-        xyz_log_filename = f"raw_{index}.txt"  # modifier cette valeur selon le découpage...
-        with open(path + "/" + xyz_log_filename, "w") as saveFile:
-            saveFile.write(xyz_line)
+        images = list(self.parent.get_scatter_items())
+        if len(images) == 0:
+            return
+        question = QMessageBox(QMessageBox.Question, 'Saving unfolded data ?',
+                               "Do you want to save the unfolded images in a NeXus file or in text files ?",
+                               QMessageBox.Cancel)
+        nexus_button = question.addButton("NeXus", QMessageBox.AcceptRole)
+        text_button = question.addButton("Text", QMessageBox.AcceptRole)
+        question.exec_()
+        path = os.path.join(SAVING_PATH, "unfolded_data")
+        if question.clickedButton() == nexus_button:
+            target = self.save_nexus
+        elif question.clickedButton() == text_button:
+            target = self.save_text
+        else:
+            return
+        # Saving a whole scan takes a while, it should not freeze the interface
+        threading.Thread(target=self.run_saving, args=(target, images, path)).start()
+
+    def run_saving(self, target, images: list, path: str):
+        # The error is shown by the gui thread, the signal is queued to it
+        try:
+            target(images, path)
+        except Exception as error:
+            self.savingFailed.emit(f"The unfolded images could not be saved in {path}: {error}")
+
+    def show_saving_error(self, message: str):
+        print(message)
+        QMessageBox(QMessageBox.Icon.Critical, "Can't save unfolded data", message).exec()
+
+    def save_nexus(self, images: list, path: str):
+        save_unfolded_stack(images, path + ".nxs")
+        print(f"Saved {len(images)} unfolded images in {path}.nxs")
+
+    def save_text(self, images: list, path: str):
+        save_unfolded_text_files(images, path)
+        print(f"Saved {len(images)} unfolded images in {path} path")
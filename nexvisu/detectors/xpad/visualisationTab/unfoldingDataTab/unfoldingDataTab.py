@@ -1,11 +1,32 @@
-from PyQt5.QtCore import QTimer, pyqtSignal
-from PyQt5.QtWidgets import QWidget, QVBoxLayout, QLineEdit, QInputDialog, QMessageBox
+from PyQt5.QtCore import QSettings, QStandardPaths, QThreadPool, pyqtSignal
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QLineEdit, QInputDialog, QMessageBox
 from detectors.xpad.visualisationTab.unfoldingDataTab.unfoldingViewer import UnfoldedDataViewer
-from utils.imageProcessing import compute_geometry, correct_and_unfold_data, extract_diffraction_diagram, get_angles
+from detectors.xpad.visualisationTab.unfoldingDataTab.unfoldingWorker import UnfoldingSignals, UnfoldingWorker
+from utils.imageProcessing import compute_geometry, DISPLAY_DTYPE
 from utils.progressWidget import ProgressWidget
-from utils.cacheFunctions import memoisation
+from utils.cacheFunctions import UnfoldingCache, unfolding_key
+from utils.exportFunctions import save_unfolded_text
+from utils.unfoldedStack import UnfoldedStack
+
+import os
+import threading
+
+# Number of images unfolded by a worker, small chunks keep the memory used by the concurrent workers low
+WORKER_CHUNK_SIZE = 4
+# Memory used by the unfolded scans kept in the cache
+UNFOLDING_CACHE_SIZE = 2 * 1024 ** 3
+# The unfolded scans are only saved on the disk if the user asks for it, in GB in the cache directory of the user
+UNFOLDING_DISK_CACHE_SIZE = 20
+UNFOLDING_CACHE_PATH = os.path.join(QStandardPaths.writableLocation(QStandardPaths.GenericCacheLocation), "nexVisu",
+                                    "unfolding_cache")
+DISK_CACHE_SETTING = "unfolding/disk_cache"
+DISK_CACHE_SIZE_SETTING = "unfolding/disk_cache_size"
+
 
 class UnfoldingDataTab(QWidget):
+    unfoldingStarted = pyqtSignal()
+    # Range [start, stop) of the images unfolded since the last emission, in the order of the scan
+    imagesUnfolded = pyqtSignal(int, int)
     unfoldingFinished = pyqtSignal()
 
     def __init__(self, parent=None):
@@ -14,11 +35,18 @@ class UnfoldingDataTab(QWidget):
         self.layout = QVBoxLayout(self)
         self.viewer = UnfoldedDataViewer(self)
 
-        self.timer = QTimer(self, interval=1)
+        self.thread_pool = QThreadPool(self)
 
+        # Geometry of the unfolded images, displayed and turned into diagrams
         self.geometry = {}
         self.calibration = {}
-        self.cache = {}
+        self.settings = QSettings("nexVisu", "nexVisu")
+        self.cache = UnfoldingCache(UNFOLDING_CACHE_SIZE)
+        # A scan still being saved at exit would delay it, its incomplete file is dropped
+        QApplication.instance().aboutToQuit.connect(self.cache.cancel_writes)
+        # Key of the unfolded scan and its full resolution images, shared with the viewer and the cache
+        self.cache_key = None
+        self.unfolded_images = UnfoldedStack()
 
         self.flatfield = None
         self.images = None
@@ -34,10 +62,19 @@ class UnfoldingDataTab(QWidget):
         self.path = None
 
         self.is_unfolding = False
+        # The scan is still being written, new images are unfolded as they come
+        self.live = False
 
-        self.data_iterator = None
-        self.index_iterator = None
+        # Index of the next image to display, and chunks unfolded ahead of it
+        self.next_index = 0
+        # Number of images given to the workers
+        self.nb_queued = 0
+        self.chunk_size = WORKER_CHUNK_SIZE
+        self.unfolded_chunks = {}
         self.progress = None
+        # Signals and cancellation flag of the running unfolding
+        self.signals = None
+        self.cancelled = threading.Event()
 
         self.use_flatfield = True
 
@@ -45,10 +82,34 @@ class UnfoldingDataTab(QWidget):
 
     def init_ui(self):
         self.layout.addWidget(self.viewer)
-        self.timer.timeout.connect(self.unfold_data)
 
         self.viewer.get_unfold_action().unfoldClicked.connect(self.remove_flatfield)
         self.viewer.get_unfold_with_flatfield_action().unfoldWithFlatfieldClicked.connect(self.add_flatfield)
+        self.viewer.get_disk_cache_action().diskCacheToggled.connect(self.toggle_disk_cache)
+        self.viewer.get_disk_cache_action().setChecked(self.settings.value(DISK_CACHE_SETTING, False, type=bool))
+        self.apply_disk_cache_settings()
+
+    def toggle_disk_cache(self, enabled: bool):
+        if enabled:
+            size, validate_button = QInputDialog.getInt(self, "Keep unfolded scans on disk",
+                                                        f"Largest size of the unfolded scans kept in "
+                                                        f"{UNFOLDING_CACHE_PATH}, in GB",
+                                                        self.settings.value(DISK_CACHE_SIZE_SETTING,
+                                                                            UNFOLDING_DISK_CACHE_SIZE, type=int),
+                                                        1, 100000)
+            if not validate_button:
+                self.viewer.get_disk_cache_action().setChecked(False)
+                return
+            self.settings.setValue(DISK_CACHE_SIZE_SETTING, size)
+        self.settings.setValue(DISK_CACHE_SETTING, enabled)
+        self.apply_disk_cache_settings()
+
+    def apply_disk_cache_settings(self):
+        if self.settings.value(DISK_CACHE_SETTING, False, type=bool):
+            size = self.settings.value(DISK_CACHE_SIZE_SETTING, UNFOLDING_DISK_CACHE_SIZE, type=int)
+            self.cache.set_directory(UNFOLDING_CACHE_PATH, size * 1024 ** 3)
+        else:
+            self.cache.set_directory(None)
 
     def start_unfolding(self):
         self.viewer.reset_scatter_view()
@@ -70,68 +131,154 @@ class UnfoldingDataTab(QWidget):
             if self.scatter_factor <= 0:
                 self.scatter_factor = 1
 
-            if memoisation(self.calibration, self.use_flatfield) not in self.cache:
-                # Create geometry of the detector
-                self.compute_geometry()
+            # Create geometry of the detector, the diagrams need it even when the unfolded data are cached
+            self.compute_geometry()
 
-                # Collect the angles
-                self.delta_array, self.gamma_array = get_angles(self.path)
+            self.cache_key = unfolding_key(self.path, self.calibration,
+                                           self.flatfield if self.use_flatfield else None, self.median_filter,
+                                           self.geometry["dtype"])
+            cached_images = self.cache.get(self.cache_key)
+            self.unfoldingStarted.emit()
+            if cached_images is None:
+                # Collect the angles, through the file opened by the stack: a scan being written in SWMR mode can't
+                # be opened twice
+                self.delta_array, self.gamma_array = self.images.get_angles()
 
-                # Populate the iterators that will help running the unfolding of data
-                self.data_iterator = iter([image for image in self.images])
-                self.index_iterator = iter([i for i in range(self.images.shape[0])])
                 self.progress = ProgressWidget('Unfolding data', self.images.shape[0])
-                # Start the timer and the unfolding
-                self.timer.start()
                 self.is_unfolding = True
+                self.unfold_data()
             else:
-                self.get_cached_data()
-                self.unfoldingFinished.emit()
+                self.get_cached_data(cached_images)
+                self.imagesUnfolded.emit(0, len(cached_images))
+                if not self.live:
+                    self.unfoldingFinished.emit()
+            if self.live:
+                # The file changes while it is written, what is unfolded from now on is not cached
+                self.cache_key = None
 
-    def get_cached_data(self):
-        print("hello cached")
-        index_data = memoisation(self.calibration, self.use_flatfield)
-        self.geometry = self.cache[index_data]['geometry']
-        for image in self.cache[index_data]['images']:
-            self.viewer.add_scatter(image, 1)
+    def get_cached_data(self, cached_images: UnfoldedStack):
+        # The images unfolded while the scan is written must not be added to the cached scan
+        self.unfolded_images = cached_images.copy() if self.live else cached_images
+        self.next_index = self.nb_queued = len(cached_images)
+        self.viewer.set_stack(self.unfolded_images, self.scatter_factor)
+        self.viewer.update_stack()
 
     def compute_geometry(self):
-        calib = memoisation(self.calibration, self.use_flatfield)
-        if self.use_flatfield:
-            self.geometry = compute_geometry(self.calibration, self.flatfield, self.images)
-        else:
-            print('hello no flat')
-            self.geometry = compute_geometry(self.calibration, None, self.images)
-        self.cache[calib] = {}
-        self.cache[calib]['geometry'] = self.geometry
+        flatfield = self.flatfield if self.use_flatfield else None
+        self.geometry = compute_geometry(self.calibration, flatfield, self.images, DISPLAY_DTYPE)
 
     def unfold_data(self):
-        try:
-            image = next(self.data_iterator)
-            index = next(self.index_iterator)
-            delta = self.delta_array[index] if len(self.delta_array) > 1 else self.delta_array[0]
-            gamma = self.gamma_array[index] if len(self.gamma_array) > 1 else self.gamma_array[0]
-            # Correct and unfold raw data
-            unfolded_data = correct_and_unfold_data(self.geometry, image, delta, gamma, self.median_filter)
-
-            # Add the unfolded image to the scatter stack of image.
-            self.viewer.add_scatter(unfolded_data, self.scatter_factor)
+        """Queue the chunks of images in the thread pool, they are displayed in order as they come back."""
+        self.next_index = 0
+        self.nb_queued = 0
+        self.unfolded_chunks = {}
+        self.unfolded_images = UnfoldedStack(self.images.shape[0])
+        self.viewer.set_stack(self.unfolded_images, self.scatter_factor)
+        self.cancelled = threading.Event()
+        self.create_signals()
+        self.queue_images(0, self.images.shape[0])
+
+    def create_signals(self):
+        self.signals = UnfoldingSignals()
+        self.signals.chunkUnfolded.connect(self.add_unfolded_chunk)
+        self.signals.unfoldingFailed.connect(self.unfolding_failed)
+
+    def queue_images(self, first: int, last: int):
+        for start in range(first, last, self.chunk_size):
+            stop = min(start + self.chunk_size, last)
+            delta = self.delta_array[start: stop] if len(self.delta_array) > 1 else self.delta_array[0]
+            gamma = self.gamma_array[start: stop] if len(self.gamma_array) > 1 else self.gamma_array[0]
+            self.thread_pool.start(UnfoldingWorker(self.signals, self.cancelled, self.geometry, self.images,
+                                                   start, stop, delta, gamma, self.median_filter))
+        self.nb_queued = last
+
+    def unfold_new_images(self, nb_images: int):
+        """Unfold the images written in the scan since the last call, if the scan was unfolded."""
+        if self.nb_queued == 0 or self.geometry == {}:
+            return
+        self.delta_array, self.gamma_array = self.images.get_angles()
+        # The motor positions of the last images may not be written yet, those images wait for the next call
+        for angles in (self.delta_array, self.gamma_array):
+            if len(angles) > 1:
+                nb_images = min(nb_images, len(angles))
+        if nb_images <= self.nb_queued:
+            return
+        if self.signals is None:
+            # The images of the previous calls are all unfolded
+            self.create_signals()
+        self.is_unfolding = True
+        self.queue_images(self.nb_queued, nb_images)
+
+    def set_live(self, live: bool):
+        """While the scan is written, the unfolded images are shown as they come but the unfolding only finishes once
+        the scan is no longer followed."""
+        self.live = live
+        if live:
+            # The file changes while it is written, the unfolded scan is not cached, and the images already unfolded
+            # may be in the cache: they are copied before images are added to them
+            self.cache_key = None
+            if self.nb_queued > 0 and not self.is_unfolding:
+                self.unfolded_images = self.unfolded_images.copy()
+                self.viewer.set_stack(self.unfolded_images, self.scatter_factor)
+        elif self.nb_queued > 0 and not self.is_unfolding:
+            self.finish_unfolding()
+
+    def add_unfolded_chunk(self, start: int, unfolded_chunk: tuple):
+        # Chunks of a cancelled unfolding may still be waiting in the event queue
+        if self.sender() is not self.signals:
+            return
+        self.unfolded_chunks[start] = unfolded_chunk
+        first_index = self.next_index
+        while self.next_index in self.unfolded_chunks:
+            start = self.next_index
+            unfolded_chunk = self.unfolded_chunks.pop(start)
+            stop = start + len(unfolded_chunk[0])
+            self.unfolded_images.extend(*unfolded_chunk)
             if self.save_data:
-                self.save_unfolded_data(unfolded_data, index, "../saved_data")
-                print(f"Saved unfolded image number {index} of {self.path} scan in '../saved_data' path")
-            self.progress.increase_progress()
+                for index in range(start, stop):
+                    save_unfolded_text(self.unfolded_images[index], os.path.join("../saved_data", f"raw_{index}.txt"))
+                    print(f"Saved unfolded image number {index} of {self.path} scan in '../saved_data' path")
+            self.next_index = stop
+            if self.progress is not None:
+                self.progress.increase_progress(stop - start)
+        if self.next_index > first_index:
+            # The viewer shows the stack, it is told that images were added
+            self.viewer.update_stack()
+            self.imagesUnfolded.emit(first_index, self.next_index)
 
-        except StopIteration:
-            self.timer.stop()
+        if self.next_index == self.nb_queued:
             self.is_unfolding = False
-            self.progress.deleteLater()
-            self.progress = None
-            self.cache[memoisation(self.calibration, self.use_flatfield)]['images'] = self.viewer.get_scatter_items()
-            self.unfoldingFinished.emit()
+            self.signals = None
+            if self.progress is not None:
+                self.progress.deleteLater()
+                self.progress = None
+            if not self.live:
+                self.finish_unfolding()
+
+    def finish_unfolding(self):
+        if self.cache_key is not None:
+            self.cache.put(self.cache_key, self.unfolded_images)
+        self.unfoldingFinished.emit()
+
+    def unfolding_failed(self, message: str):
+        if self.sender() is not self.signals:
+            return
+        self.reset_unfolding()
+        QMessageBox(QMessageBox.Icon.Critical, "Unfolding failed", message).exec()
 
     def reset_unfolding(self):
         self.is_unfolding = False
-        self.timer.stop()
+        # Running workers drop their chunk, queued ones are removed from the pool
+        self.cancelled.set()
+        self.thread_pool.clear()
+        self.signals = None
+        self.next_index = 0
+        self.nb_queued = 0
+        self.unfolded_chunks = {}
+        self.unfolded_images = UnfoldedStack()
+        if self.progress is not None:
+            self.progress.deleteLater()
+            self.progress = None
 
         """
         image = numpy.asarray((image[0], image[1])) #image[2]))
@@ -1,12 +1,21 @@
+from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import QWidget, QVBoxLayout
 from silx.gui.colors import Colormap
 from silx.gui.data.NumpyAxesSelector import NumpyAxesSelector
 from silx.gui.qt import QToolBar
 from silx.gui.plot.ScatterView import ScatterView
-from detectors.xpad.visualisationTab.unfoldingDataTab.unfoldingActions import Unfold, UnfoldWithFlatfield, SaveAction
+from detectors.xpad.visualisationTab.unfoldingDataTab.unfoldingActions import Unfold, UnfoldWithFlatfield, SaveAction, \
+    LevelOfDetail, DiskCache
+from utils.imageProcessing import rasterize_scatter
+from utils.unfoldedStack import UnfoldedStack
 
 import numpy
-import time
+
+# Number of points in the view above which the image is displayed as a raster of the view instead of a scatter
+LEVEL_OF_DETAIL_THRESHOLD = 20000
+# Time after the last zoom or pan before the raster of the view is computed again, in milliseconds
+LEVEL_OF_DETAIL_DELAY = 100
+LEVEL_OF_DETAIL_LEGEND = "level of detail"
 
 
 class UnfoldedDataViewer(QWidget):
@@ -33,9 +42,18 @@ class UnfoldedDataViewer(QWidget):
         self.layout.addWidget(self.scatter_view)
         self.layout.addWidget(self.scatter_selector)
 
-        self.stack = []
+        # Unfolded images of the unfolding tab, displayed with one point out of scatter_factor
+        self.stack = UnfoldedStack()
+        self.scatter_factor = 1
 
         self.initial_data_flag = True
+        # True while the displayed image is the raster of the view, else the index of the image drawn as a scatter
+        self.rasterized = False
+        self.scattered_item = None
+        self.level_of_detail_timer = QTimer(self)
+        self.level_of_detail_timer.setSingleShot(True)
+        self.level_of_detail_timer.setInterval(LEVEL_OF_DETAIL_DELAY)
+        self.level_of_detail_timer.timeout.connect(self.update_view)
 
         self.toolbar = QToolBar("Custom toolbar 1")
         self.scatter_view.addToolBar(self.toolbar)
@@ -43,19 +61,26 @@ class UnfoldedDataViewer(QWidget):
         self.action_unfold = Unfold(self.plot, parent=self)
         self.action_unfold_with_flatfield = UnfoldWithFlatfield(self.plot, parent=self)
         self.action_save = SaveAction(self.plot, parent=self)
+        self.action_level_of_detail = LevelOfDetail(self.plot, parent=self)
+        self.action_disk_cache = DiskCache(self.plot, parent=self)
 
         self.toolbar.addAction(self.action_unfold)
         self.toolbar.addAction(self.action_unfold_with_flatfield)
         self.toolbar.addAction(self.action_save)
+        self.toolbar.addAction(self.action_level_of_detail)
+        self.toolbar.addAction(self.action_disk_cache)
 
         self.scatter_selector.selectionChanged.connect(self.change_displayed_data)
+        self.plot.getXAxis().sigLimitsChanged.connect(self.level_of_detail_timer.start)
+        self.plot.getYAxis().sigLimitsChanged.connect(self.level_of_detail_timer.start)
+
+    def set_stack(self, stack: UnfoldedStack, scatter_factor: int):
+        self.stack = stack
+        self.scatter_factor = scatter_factor
 
-    def add_scatter(self, scatter_image: tuple, scatter_factor: int):
-        # Add an image to the stack. If it is the first, emit the selectionChanged signal to plot the first image
-        self.stack.append((scatter_image[0][::scatter_factor],
-                           scatter_image[1][::scatter_factor],
-                           scatter_image[2][::scatter_factor]))
-        if self.initial_data_flag:
+    def update_stack(self):
+        # Images were added to the stack. If they are the first, emit the selectionChanged signal to plot the first one
+        if self.initial_data_flag and len(self.stack) > 0:
             self.scatter_selector.selectionChanged.emit()
             self.initial_data_flag = False
 
@@ -68,30 +93,75 @@ class UnfoldedDataViewer(QWidget):
         # If there is at least one unfolded image, clear the view, unpack the data and plot a scatter view of the image
         if len(self.stack) > 0:
             self.clear_scatter_view()
-            tth_array, psi_array, intensity = self.stack[self.scatter_selector.selection()[0]]
-            self.plot.setGraphXLimits(min(tth_array) - 0.0, max(tth_array) + 0.0)
-            self.plot.setGraphYLimits(min(psi_array) - 5.0, max(psi_array) + 5.0)
-            start = time.time()
+            tth_array, psi_array, _ = self.get_displayed_item()
+            self.plot.setGraphXLimits(numpy.nanmin(tth_array), numpy.nanmax(tth_array))
+            self.plot.setGraphYLimits(numpy.nanmin(psi_array) - 5.0, numpy.nanmax(psi_array) + 5.0)
+            self.update_view()
+
+    def get_displayed_index(self) -> int:
+        return min(self.scatter_selector.selection()[0], len(self.stack) - 1)
+
+    def get_displayed_item(self) -> tuple:
+        return self.get_scatter_item(self.get_displayed_index())
+
+    def update_view(self):
+        # Draw the points of the image, or when the view holds too many of them, its raster at the size of the view
+        self.level_of_detail_timer.stop()
+        if len(self.stack) == 0:
+            return
+        index = self.get_displayed_index()
+        tth_array, psi_array, intensity = self.get_scatter_item(index)
+        x_range = self.plot.getXAxis().getLimits()
+        y_range = self.plot.getYAxis().getLimits()
+        in_view = None
+        if self.action_level_of_detail.isChecked() and len(tth_array) > LEVEL_OF_DETAIL_THRESHOLD:
+            in_view = (tth_array >= x_range[0]) & (tth_array <= x_range[1]) \
+                & (psi_array >= y_range[0]) & (psi_array <= y_range[1])
+        if in_view is not None and numpy.count_nonzero(in_view) > LEVEL_OF_DETAIL_THRESHOLD:
+            _, _, width, height = self.plot.getPlotBoundsInPixels()
+            width, height = max(width, 1), max(height, 1)
+            raster = rasterize_scatter(tth_array, psi_array, intensity, x_range, y_range, (height, width))
+            if not self.rasterized:
+                self.scatter_view.setData(None, None, None)
+                self.scattered_item = None
+            self.plot.addImage(raster, legend=LEVEL_OF_DETAIL_LEGEND, origin=(x_range[0], y_range[0]),
+                               scale=((x_range[1] - x_range[0]) / width, (y_range[1] - y_range[0]) / height),
+                               colormap=self.scatter_view.getColormap(), resetzoom=False, copy=False)
+            self.rasterized = True
+        elif in_view is not None:
+            # zoomed in enough to draw the points, only the ones in the view are
+            self.plot.remove(legend=LEVEL_OF_DETAIL_LEGEND, kind='image')
+            self.scatter_view.setData(tth_array[in_view], psi_array[in_view], intensity[in_view], copy=False)
+            self.rasterized = False
+            self.scattered_item = None
+        elif self.rasterized or self.scattered_item != index:
+            self.plot.remove(legend=LEVEL_OF_DETAIL_LEGEND, kind='image')
             self.scatter_view.setData(tth_array, psi_array, intensity, copy=False)
-            end = time.time()
-            print("Setting the data took :", (end - start) * 1000.0, " ms")
+            self.rasterized = False
+            self.scattered_item = index
 
     def clear_scatter_view(self):
+        self.plot.remove(legend=LEVEL_OF_DETAIL_LEGEND, kind='image')
+        self.rasterized = False
+        self.scattered_item = None
         self.scatter_view.setData(None, None, None)
 
     def reset_scatter_view(self):
         self.clear_scatter_view()
-        self.stack = []
+        self.stack = UnfoldedStack()
         self.initial_data_flag = True
 
     def get_scatter_item(self, index: int) -> tuple:
-        return self.stack[index]
+        return tuple(array[::self.scatter_factor] for array in self.stack.get_scatter_item(index))
 
     def get_scatter_items(self) -> list:
-        return self.stack
+        return [self.get_scatter_item(index) for index in range(len(self.stack))]
 
     def get_unfold_action(self):
         return self.action_unfold
 
     def get_unfold_with_flatfield_action(self):
         return self.action_unfold_with_flatfield
+
+    def get_disk_cache_action(self):
+        return self.action_disk_cache
@@ -0,0 +1,43 @@
+from PyQt5.QtCore import QObject, QRunnable, pyqtSignal
+
+from utils.imageProcessing import correct_and_unfold_images
+
+import threading
+
+
+class UnfoldingSignals(QObject):
+    """Signals of the unfolding workers, delivered in the GUI thread."""
+    # Index of the first image of the chunk and its (angle keys, angle maps, intensities), see UnfoldedStack.extend
+    chunkUnfolded = pyqtSignal(int, object)
+    unfoldingFailed = pyqtSignal(str)
+
+
+class UnfoldingWorker(QRunnable):
+    """Correct and unfold a chunk of images in a thread of a QThreadPool."""
+    def __init__(self, signals: UnfoldingSignals, cancelled: threading.Event, geometry: dict, images,
+                 start: int, stop: int, delta, gamma, median_filter_flag: bool):
+        super().__init__()
+        self.signals = signals
+        self.cancelled = cancelled
+        self.geometry = geometry
+        self.images = images
+        self.start = start
+        self.stop = stop
+        self.delta = delta
+        self.gamma = gamma
+        self.median_filter_flag = median_filter_flag
+
+    def run(self) -> None:
+        if self.cancelled.is_set():
+            return
+        try:
+            unfolded_chunk = correct_and_unfold_images(self.geometry, self.images[self.start: self.stop],
+                                                       self.delta, self.gamma, self.median_filter_flag,
+                                                       self.stop - self.start)
+        except Exception as exception:
+            # An exception raised in a thread of the pool would be lost and the unfolding would never end
+            if not self.cancelled.is_set():
+                self.signals.unfoldingFailed.emit(f"Images {self.start} to {self.stop - 1}: {exception}")
+            return
+        if not self.cancelled.is_set():
+            self.signals.chunkUnfolded.emit(self.start, unfolded_chunk)
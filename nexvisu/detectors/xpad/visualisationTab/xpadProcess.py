@@ -1,21 +1,23 @@
 import math
 
-from h5py import File
-
-from PyQt5.QtWidgets import QWidget, QTabWidget, QVBoxLayout, QToolBar
+from PyQt5.QtWidgets import QWidget, QTabWidget, QVBoxLayout, QToolBar, QHBoxLayout, QLabel, QLineEdit, QCheckBox, \
+    QPushButton, QApplication, QMessageBox
 from PyQt5.QtCore import pyqtSlot, pyqtSignal
 from scipy.signal import find_peaks
 from silx.gui.data.NumpyAxesSelector import NumpyAxesSelector
-from silx.gui.plot import Plot1D
+from silx.gui.colors import Colormap
+from silx.gui.plot import Plot1D, Plot2D
+from silx.gui.utils import blockSignals
 
 from detectors.xpad.visualisationTab.fittingDataTab.fittingDataTab import FittingDataTab
 from detectors.xpad.visualisationTab.unfoldingDataTab.unfoldingDataTab import UnfoldingDataTab
 
-from constants import DataPath
 from utils.dataViewers import RawDataViewer
 from utils.fitAction import FitAction
-from utils.imageProcessing import compute_geometry, correct_and_unfold_data, get_angles, extract_diffraction_diagram
-from utils.nexusNavigation import get_dataset
+from utils.imageProcessing import compute_geometry, correct_and_unfold_data, get_angles, extract_diffraction_diagrams
+from utils.lazyImageStack import MemmapImageStack, open_image_stack, save_frame_sidecar
+from utils.progressWidget import ProgressWidget
+from utils.scanWatcher import ScanWatcher
 
 
 import numpy
@@ -32,7 +34,15 @@ class XpadVisualisation(QWidget):
         self.flatfield_image = None
         self.path = None
         self.diagram_data_array = []
+        self.diagram_two_theta = None
+        self.diagram_matrix = None
+        # 2θ columns of the diagram matrix holding data in at least one diagram
+        self.diagram_columns = None
+        # Number of diagrams given to the automatic fit, None until the whole scan is unfolded
+        self.nb_diagrams_to_fit = None
         self.angles = []
+        # Follows the scan while it is written
+        self.scan_watcher = None
 
         # Initialize tab screen
         self.tabs = QTabWidget()
@@ -45,9 +55,16 @@ class XpadVisualisation(QWidget):
         # Create raw data display tab
         self.raw_data_tab.layout = QVBoxLayout(self.raw_data_tab)
         self.raw_data_viewer = RawDataViewer(self.raw_data_tab)
+        self.raw_data_options_layout = QHBoxLayout()
+        self.live_box = QCheckBox("Follow the scan while it is written")
+        self.save_frames_button = QPushButton("Save the frames for a fast reopening")
 
         # Create diagram plot data tab
         self.diagram_tab.layout = QVBoxLayout(self.diagram_tab)
+        self.diagram_waterfall = Plot2D(self.diagram_tab)
+        self.diagram_overlay_layout = QHBoxLayout()
+        self.diagram_overlay_label = QLabel("Diagrams to plot (e.g. 0, 10-20), the displayed image if empty : ")
+        self.diagram_overlay_input = QLineEdit()
         self.diagram_data_plot = Plot1D(self.diagram_tab)
 
         # Create fitting curve tab
@@ -63,6 +80,8 @@ class XpadVisualisation(QWidget):
 
         self.unfolded_data_tab.viewer.get_unfold_with_flatfield_action().unfoldWithFlatfieldClicked.connect(self.get_calibration)
         self.unfolded_data_tab.viewer.get_unfold_action().unfoldClicked.connect(self.get_calibration)
+        self.unfolded_data_tab.unfoldingStarted.connect(self.reset_diagrams)
+        self.unfolded_data_tab.imagesUnfolded.connect(self.add_diagrams)
         self.unfolded_data_tab.unfoldingFinished.connect(self.create_diagram_array)
 
         self.init_UI()
@@ -79,9 +98,22 @@ class XpadVisualisation(QWidget):
         self.tabs.addTab(self.automatic_fit_tab, "Automatic fit")
 
         self.raw_data_tab.layout.addWidget(self.raw_data_viewer)
-
+        self.raw_data_options_layout.addWidget(self.live_box)
+        self.raw_data_options_layout.addWidget(self.save_frames_button)
+        self.raw_data_tab.layout.addLayout(self.raw_data_options_layout)
+
+        self.diagram_overlay_layout.addWidget(self.diagram_overlay_label)
+        self.diagram_overlay_layout.addWidget(self.diagram_overlay_input)
+        self.diagram_tab.layout.addWidget(self.diagram_waterfall)
+        self.diagram_tab.layout.addLayout(self.diagram_overlay_layout)
         self.diagram_tab.layout.addWidget(self.diagram_data_plot)
 
+        self.diagram_waterfall.setGraphTitle("Diagrams of the stack")
+        self.diagram_waterfall.setGraphXLabel("two-theta (°)")
+        self.diagram_waterfall.setGraphYLabel("image")
+        self.diagram_waterfall.setKeepDataAspectRatio(False)
+        self.diagram_waterfall.setDefaultColormap(Colormap("viridis", normalization='log'))
+
         self.diagram_data_plot.setGraphTitle(f"Diagram diffraction")
         self.diagram_data_plot.setGraphXLabel("two-theta (°)")
         self.diagram_data_plot.setGraphYLabel("intensity")
@@ -111,6 +143,9 @@ class XpadVisualisation(QWidget):
         self.fitting_data_selector.selectionChanged.connect(self.fitting_curve)
         self.fitting_data_plot.getCurvesRoiWidget().sigROIWidgetSignal.connect(self.get_roi_list)
         self.unfolded_data_tab.viewer.scatter_selector.selectionChanged.connect(self.synchronize_visualisation)
+        self.diagram_overlay_input.editingFinished.connect(self.plot_diagram)
+        self.live_box.toggled.connect(self.set_live)
+        self.save_frames_button.clicked.connect(self.save_frames)
 
 
     @pyqtSlot()
@@ -121,8 +156,15 @@ class XpadVisualisation(QWidget):
 
     def set_data(self, path: str) -> None:
         self.path = path
-        with File(os.path.join(path), mode='r') as h5file:
-            self.raw_data = get_dataset(h5file, DataPath.IMAGE_INTERPRETATION.value)[:]
+        if self.scan_watcher is not None:
+            self.scan_watcher.stop()
+            self.scan_watcher = None
+        # The workers must not read the images of the previous scan once its file is closed
+        self.unfolded_data_tab.reset_unfolding()
+        if self.raw_data is not None:
+            self.raw_data.close()
+        # The images are only read when they are displayed or unfolded, from their sidecar if they were saved
+        self.raw_data = open_image_stack(os.path.join(path))
         # We put the raw data in the dataviewer
         self.raw_data_viewer.set_movie(self.raw_data, self.flatfield_image)
         self.unfolded_data_tab.images = self.raw_data
@@ -130,6 +172,42 @@ class XpadVisualisation(QWidget):
         # We allocate a number of view in the stack of unfolded data and fitting data
         self.unfolded_data_tab.viewer.set_stack_slider(self.raw_data.shape[0])
         self.fitting_data_selector.setData(numpy.zeros((self.raw_data.shape[0], 1, 1)))
+        self.set_live(self.live_box.isChecked())
+
+    def set_live(self, live: bool):
+        # The frames written in the scan are displayed, unfolded and turned into diagrams as they land on the disk
+        if self.scan_watcher is not None:
+            # The last frames written are not left out
+            self.scan_watcher.poll()
+            self.scan_watcher.stop()
+            self.scan_watcher = None
+            self.unfolded_data_tab.unfold_new_images(self.raw_data.shape[0])
+        if live and self.raw_data is not None:
+            self.scan_watcher = ScanWatcher(self.raw_data, parent=self)
+            self.scan_watcher.framesAdded.connect(self.add_frames)
+        self.unfolded_data_tab.set_live(self.scan_watcher is not None)
+        if self.scan_watcher is not None:
+            self.scan_watcher.start()
+
+    def save_frames(self):
+        # The next openings of the scan map the saved frames in memory instead of decompressing them
+        if self.raw_data is None or isinstance(self.raw_data, MemmapImageStack):
+            return
+        progress = ProgressWidget('Saving the frames', self.raw_data.shape[0])
+        try:
+            frames_path = save_frame_sidecar(self.raw_data, lambda nb_frames: (progress.increase_progress(nb_frames),
+                                                                               QApplication.processEvents()))
+            print(f"Saved the frames of {self.path} into {frames_path}")
+        except OSError as error:
+            QMessageBox(QMessageBox.Icon.Critical, "Can't save the frames", str(error)).exec()
+        finally:
+            progress.deleteLater()
+
+    def add_frames(self, start: int, stop: int):
+        self.raw_data_viewer.update_movie(stop)
+        set_selector_size(self.unfolded_data_tab.viewer.scatter_selector, stop)
+        set_selector_size(self.fitting_data_selector, stop)
+        self.unfolded_data_tab.unfold_new_images(stop)
 
     def set_calibration(self, calibration):
         # Check if there is a empty list of coordinate in the direct beam calibration
@@ -143,28 +221,81 @@ class XpadVisualisation(QWidget):
     def get_calibration(self):
         self.unfoldButtonClicked.emit()
 
-    def create_diagram_array(self):
+    def reset_diagrams(self):
         self.diagram_data_array = []
+        self.nb_diagrams_to_fit = None
+        self.diagram_two_theta = None
+        self.diagram_matrix = None
+        self.diagram_columns = None
+        self.diagram_waterfall.clear()
+        self.diagram_data_plot.clear()
+
+    def add_diagrams(self, start: int, stop: int):
+        """Extract the diagrams of the images just unfolded, and show them without waiting for the whole scan."""
         numpy.seterr(divide='ignore', invalid='ignore')
-        for image in self.unfolded_data_tab.viewer.get_scatter_items():
-            self.diagram_data_array.append(extract_diffraction_diagram(image[0],
-                                                                       image[1],
-                                                                       image[2],
-                                                                       1.0 / self.unfolded_data_tab.geometry["calib"],
-                                                                       -100,
-                                                                       100,
-                                                                       patch_data_flag=True))
-        self.plot_diagram()
-        self.automatic_fit_tab.set_data_to_fit(self.diagram_data_array)
+        # All the patched diagrams share the same 2θ grid, one row of the matrix per image
+        self.diagram_two_theta, diagram_matrix = extract_diffraction_diagrams(
+            self.unfolded_data_tab.unfolded_images[start: stop], 1.0 / self.unfolded_data_tab.geometry["calib"],
+            -100, 100)
+        if self.diagram_matrix is None:
+            self.diagram_matrix = numpy.full((self.raw_data.shape[0], diagram_matrix.shape[1]), numpy.nan)
+            self.diagram_columns = numpy.zeros(diagram_matrix.shape[1], dtype=bool)
+        elif stop > self.diagram_matrix.shape[0]:
+            # Images were written in the scan since it was opened
+            new_rows = numpy.full((self.raw_data.shape[0] - self.diagram_matrix.shape[0], diagram_matrix.shape[1]),
+                                  numpy.nan)
+            self.diagram_matrix = numpy.concatenate((self.diagram_matrix, new_rows))
+        self.diagram_matrix[start: stop] = diagram_matrix
+        self.diagram_columns |= numpy.isfinite(diagram_matrix).any(axis=0)
+        self.diagram_data_array += [(self.diagram_two_theta, diagram) for diagram in self.diagram_matrix[start: stop]]
+        if self.nb_diagrams_to_fit is not None:
+            # The scan is followed after its unfolding, the automatic fit gets the new diagrams
+            self.automatic_fit_tab.add_data_to_fit(self.diagram_data_array[self.nb_diagrams_to_fit:])
+            self.nb_diagrams_to_fit = len(self.diagram_data_array)
+        self.plot_waterfall(reset_zoom=start == 0)
+        if any(start <= index < stop for index in self.get_plotted_diagrams()):
+            self.plot_diagram()
+        if start <= self.fitting_data_selector.selection()[0] < stop:
+            self.fitting_data_selector.selectionChanged.emit()
+
+    def create_diagram_array(self):
+        # The diagrams were extracted while the images were unfolded. The fit keeps its own list, the diagrams of a
+        # scan being written are added to it afterwards
+        self.automatic_fit_tab.set_data_to_fit(list(self.diagram_data_array))
+        self.nb_diagrams_to_fit = len(self.diagram_data_array)
         self.fitting_data_selector.selectionChanged.emit()
-        set_plot_limits(self.diagram_data_plot, self.diagram_data_plot.getActiveCurve())
 
-    def plot_diagram(self, images_to_remove=[-1]):
-        self.diagram_data_plot.setGraphTitle(f"Diagram diffraction of {self.path.split('/')[-1]}")
-        for index, curve in enumerate(self.diagram_data_array):
-            if index not in images_to_remove:
-                self.diagram_data_plot.addCurve(curve[0], curve[1], f'Data of image {index}',
-                                                color="#0000FF", replace=False, symbol='o')
+    def plot_waterfall(self, reset_zoom: bool = False):
+        # The whole stack is a single image, one row per diagram, cropped to the 2θ range holding data
+        columns = numpy.flatnonzero(self.diagram_columns)
+        if len(columns) == 0:
+            return
+        first, last = columns[0], columns[-1] + 1
+        step = self.diagram_two_theta[1] - self.diagram_two_theta[0]
+        self.diagram_waterfall.addImage(self.diagram_matrix[:, first: last], legend="diagrams",
+                                        origin=(self.diagram_two_theta[first] - step / 2.0, 0), scale=(step, 1),
+                                        resetzoom=reset_zoom, copy=False)
+
+    def get_plotted_diagrams(self) -> list:
+        # The diagrams asked by the user, or the one of the displayed unfolded image
+        text = self.diagram_overlay_input.text()
+        if not text.strip():
+            return [self.unfolded_data_tab.viewer.scatter_selector.selection()[0]]
+        return parse_image_indexes(text)
+
+    def plot_diagram(self):
+        # Only the selected diagrams are plotted as curves, the stack is in the waterfall image
+        self.diagram_data_plot.clear()
+        self.diagram_data_plot.setGraphTitle(f"Diagram diffraction of {os.path.basename(self.path or '')}")
+        plotted_curves = []
+        for index in self.get_plotted_diagrams():
+            if 0 <= index < len(self.diagram_data_array):
+                curve = self.diagram_data_array[index]
+                self.diagram_data_plot.addCurve(curve[0], curve[1], f'Data of image {index}', replace=False,
+                                                symbol='o', resetzoom=False)
+                plotted_curves.append(curve)
+        if plotted_curves:
+            set_plot_limits(self.diagram_data_plot, plotted_curves[0])
 
     def get_flatfield(self, flat_img: numpy.ndarray):
         self.flatfield_image = flat_img
@@ -174,9 +305,12 @@ class XpadVisualisation(QWidget):
     def synchronize_visualisation(self):
         # When user change the unfolded view, it set the raw image to the same frame
         self.raw_data_viewer.setFrameNumber(self.unfolded_data_tab.viewer.scatter_selector.selection()[0])
+        if not self.diagram_overlay_input.text().strip():
+            self.plot_diagram()
 
     def fitting_curve(self):
-        if len(self.diagram_data_array) > 0:
+        # The diagram of the selected image may not be extracted yet
+        if self.fitting_data_selector.selection()[0] < len(self.diagram_data_array):
             self.clear_plot_fitting_widget()
             curve = self.diagram_data_array[self.fitting_data_selector.selection()[0]]
             self.fitting_data_plot.addCurve(curve[0], curve[1], symbol='o')
@@ -192,13 +326,37 @@ class XpadVisualisation(QWidget):
 
 def set_plot_limits(plot, curve):
     if curve is not None and plot is not None:
-        print(min(curve[0]), max(curve[0]), min(curve[1]), max(curve[1]))
-        indexes_not_nan = numpy.where(numpy.logical_and(~numpy.isnan(curve[1]), ~numpy.isinf(curve[1])))[0]
+        indexes_not_nan = numpy.flatnonzero(numpy.isfinite(curve[1]))
+        if len(indexes_not_nan) == 0:
+            return
         index_x_min = indexes_not_nan[0]
         index_x_max = indexes_not_nan[-1]
-
-        index_y_min = int(numpy.floor(min(curve[1][indexes_not_nan[0]: indexes_not_nan[-1] + 1])))
-        index_y_max = int(numpy.ceil(max(curve[1][indexes_not_nan[0]: indexes_not_nan[-1] + 1])))
-
-        print(curve[0][index_x_min], curve[0][index_x_max], curve[1][index_y_min], curve[1][index_y_max])
-        plot.setLimits(curve[0][index_x_min], curve[0][index_x_max], index_y_min, index_y_max)
+        intensities = curve[1][indexes_not_nan]
+        plot.setLimits(curve[0][index_x_min], curve[0][index_x_max], int(numpy.floor(intensities.min())),
+                       int(numpy.ceil(intensities.max())))
+
+
+def set_selector_size(selector: NumpyAxesSelector, nb_images: int):
+    # Images were added to the scan, the selected image stays selected without notifying the change
+    selection = selector.selection()
+    with blockSignals(selector):
+        selector.setData(numpy.zeros((nb_images, 1, 1)))
+        selector.setSelection(selection)
+
+
+def parse_image_indexes(text: str) -> list:
+    """Return the indexes of images given as "0, 4, 10-20", ranges included, ignoring what is not understood."""
+    indexes = []
+    for part in text.split(","):
+        bounds = part.split("-")
+        try:
+            if len(bounds) == 1:
+                indexes.append(int(bounds[0]))
+            elif len(bounds) == 2:
+                indexes += list(range(int(bounds[0]), int(bounds[1]) + 1))
+            else:
+                raise ValueError
+        except ValueError:
+            if part.strip():
+                print(f"{part.strip()} is not an image or a range of images")
+    return indexes
@@ -0,0 +1,217 @@
+"""Headless processing of XPAD scans: flatfield, unfolding, diffraction diagrams and peak fitting, without display.
+
+Example:
+    python nexVisu_batch.py "/data/beamtime/scan_*.nxs" --calibration calibration.json --flatfield flat.nxs \
+        --output /data/beamtime/processed --workers 16
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
+from multiprocessing import get_context
+from h5py import File
+
+from constants import DataPath
+from utils.exportFunctions import UnfoldedStackWriter
+from utils.fitFunctions import PEARSON7_PARAMETERS, create_pearson7_fit_manager, fit_diagram_peaks
+from utils.imageProcessing import compute_geometry, correct_and_unfold_stack, extract_diffraction_diagrams, \
+    gen_flatfield, UNFOLDING_CHUNK_SIZE, UNFOLDING_DTYPE
+from utils.lazyImageStack import open_image_stack
+from utils.nexusNavigation import get_dataset
+
+import argparse
+import glob
+import json
+import numpy
+import os
+import sys
+import time
+
+# Psi sector integrated in the diagrams, as in the gui
+PSI_MIN = -100
+PSI_MAX = 100
+
+
+def process_scan(path: str, calibration: dict, flatfield: numpy.ndarray, output_directory: str,
+                 median_filter_flag: bool = False, fit_flag: bool = True, save_unfolded_flag: bool = False,
+                 dtype=UNFOLDING_DTYPE) -> dict:
+    """Unfold all the images of a scan, extract their diffraction diagrams and fit their peaks.
+    The diagrams and the fitted peaks are saved in output_directory/<scan>_diagrams.nxs."""
+    start_time = time.perf_counter()
+    scan_name = os.path.splitext(os.path.basename(path))[0]
+    images = open_image_stack(path)
+    try:
+        nb_images = images.shape[0]
+        geometry = compute_geometry(calibration, flatfield, images, dtype)
+        delta_array, gamma_array = images.get_angles()
+        two_theta = None
+        diagrams = []
+        # The unfolded images file is removed when the scan can't be processed entirely
+        unfolded_path = os.path.join(output_directory, f"{scan_name}_unfolded.nxs")
+        with UnfoldedStackWriter(unfolded_path, nb_images) if save_unfolded_flag else nullcontext() as writer, \
+                numpy.errstate(divide='ignore', invalid='ignore'):
+            for start in range(0, nb_images, UNFOLDING_CHUNK_SIZE):
+                stop = min(start + UNFOLDING_CHUNK_SIZE, nb_images)
+                delta = delta_array[start: stop] if len(delta_array) > 1 else delta_array[0]
+                gamma = gamma_array[start: stop] if len(gamma_array) > 1 else gamma_array[0]
+                unfolded_chunk = correct_and_unfold_stack(geometry, images[start: stop], delta, gamma,
+                                                          median_filter_flag)
+                unfolded_images = [tuple(array[index] for array in unfolded_chunk) for index in range(stop - start)]
+                if writer is not None:
+                    for index, unfolded_data in enumerate(unfolded_images, start=start):
+                        writer.write(index, unfolded_data)
+                two_theta, diagram_matrix = extract_diffraction_diagrams(unfolded_images, 1.0 / geometry["calib"],
+                                                                         PSI_MIN, PSI_MAX)
+                diagrams.append(diagram_matrix)
+    finally:
+        images.close()
+    diagram_matrix = numpy.concatenate(diagrams) if diagrams else numpy.zeros((0, 0))
+
+    peaks = []
+    # Reasons why the fits of the diagrams stopped early, counted rather than printed for each peak
+    fit_errors = []
+    if fit_flag:
+        fit = create_pearson7_fit_manager()
+        for index, diagram in enumerate(diagram_matrix):
+            for _, _, parameters in fit_diagram_peaks(two_theta, diagram, fit, fit_errors):
+                peaks.append([index] + list(parameters))
+
+    save_diagrams(os.path.join(output_directory, f"{scan_name}_diagrams.nxs"), path, calibration, two_theta,
+                  diagram_matrix, peaks)
+    return {"scan": path, "images": nb_images, "peaks": len(peaks), "fit_errors": len(fit_errors),
+            "time": time.perf_counter() - start_time}
+
+
+def save_diagrams(path: str, scan_path: str, calibration: dict, two_theta: numpy.ndarray,
+                  diagram_matrix: numpy.ndarray, peaks: list) -> None:
+    try:
+        _write_diagrams(path, scan_path, calibration, two_theta, diagram_matrix, peaks)
+    except Exception:
+        # A half written file is not left behind
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+
+def _write_diagrams(path: str, scan_path: str, calibration: dict, two_theta: numpy.ndarray,
+                    diagram_matrix: numpy.ndarray, peaks: list) -> None:
+    with File(path, mode='w') as h5file:
+        entry = h5file.create_group("entry")
+        entry.attrs["NX_class"] = "NXentry"
+        entry.attrs["default"] = "diagrams"
+        h5file.attrs["default"] = "entry"
+        entry["scan"] = os.path.abspath(scan_path)
+        entry["calibration"] = json.dumps(calibration)
+
+        data = entry.create_group("diagrams")
+        data.attrs["NX_class"] = "NXdata"
+        data.attrs["signal"] = "intensity"
+        data.attrs["axes"] = [".", "two_theta"]
+        # The patched diagrams all share the same two theta grid
+        data.create_dataset("two_theta", data=two_theta if two_theta is not None else numpy.zeros(0))
+        data.create_dataset("intensity", data=diagram_matrix, compression="gzip", compression_opts=1, shuffle=True)
+
+        fit = entry.create_group("fit")
+        fit.attrs["NX_class"] = "NXcollection"
+        peaks = numpy.array(peaks, dtype=float).reshape(-1, len(PEARSON7_PARAMETERS) + 1)
+        fit.create_dataset("frame", data=peaks[:, 0].astype(int))
+        parameters = fit.create_dataset("parameters", data=peaks[:, 1:])
+        parameters.attrs["names"] = PEARSON7_PARAMETERS
+
+
+def read_flatfield(path: str) -> numpy.ndarray:
+    """Read a flatfield saved by the gui."""
+    data = numpy.zeros((240, 560))
+    with File(path, mode='r') as h5file:
+        data += get_dataset(h5file, DataPath.SAVED_IMAGE.value)
+    return data
+
+
+def get_scan_paths(patterns: list) -> list:
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            print(f"No scan matches {pattern}")
+        paths += [match for match in matches if match not in paths]
+    return paths
+
+
+def parse_arguments(arguments: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Unfold XPAD scans, extract their diffraction diagrams and fit "
+                                                 "their peaks, without display.")
+    parser.add_argument("scans", nargs="+", help="nexus scan files, or glob patterns of scan files")
+    parser.add_argument("--calibration", required=True,
+                        help="calibration.json file written by the direct beam calibration")
+    parser.add_argument("--flatfield", help="flatfield file saved by the gui")
+    parser.add_argument("--flatfield-scan", help="a scan of the flatfield series, to compute the flatfield")
+    parser.add_argument("--flatfield-range", nargs=2, type=int, metavar=("FIRST", "LAST"),
+                        help="numbers of the first and last scans of the flatfield series")
+    parser.add_argument("--output", default=".", help="directory of the processed files")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="number of scans processed at the same time")
+    parser.add_argument("--median-filter", action="store_true", help="apply a 3x3 median filter on the images")
+    parser.add_argument("--no-fit", action="store_true", help="do not fit the peaks of the diagrams")
+    parser.add_argument("--save-unfolded", action="store_true", help="also save the unfolded images")
+    parser.add_argument("--dtype", choices=("float32", "float64"), default=numpy.dtype(UNFOLDING_DTYPE).name,
+                        help="floating point type of the unfolded images")
+    parsed = parser.parse_args(arguments)
+    if (parsed.flatfield_scan is None) != (parsed.flatfield_range is None):
+        parser.error("--flatfield-scan and --flatfield-range go together")
+    if parsed.flatfield is not None and parsed.flatfield_scan is not None:
+        parser.error("--flatfield can not be used with --flatfield-scan")
+    return parsed
+
+
+def main(arguments: list = None) -> int:
+    parsed = parse_arguments(sys.argv[1:] if arguments is None else arguments)
+    with open(parsed.calibration, "r") as infile:
+        calibration = json.load(infile)
+    scan_paths = get_scan_paths(parsed.scans)
+    if not scan_paths:
+        return 1
+    os.makedirs(parsed.output, exist_ok=True)
+    workers = max(1, min(parsed.workers, len(scan_paths)))
+
+    flatfield = None
+    if parsed.flatfield is not None:
+        flatfield = read_flatfield(parsed.flatfield)
+    elif parsed.flatfield_scan is not None:
+        first_scan, last_scan = sorted(parsed.flatfield_range)
+        print(f"Computing the flatfield of scans {first_scan} to {last_scan}")
+        flatfield = gen_flatfield(first_scan, last_scan, parsed.flatfield_scan, workers=parsed.workers)
+
+    options = (calibration, flatfield, parsed.output, parsed.median_filter, not parsed.no_fit, parsed.save_unfolded,
+               numpy.dtype(parsed.dtype))
+    failures = 0
+    if workers == 1:
+        results = []
+        for path in scan_paths:
+            try:
+                results.append(process_scan(path, *options))
+            except Exception as error:
+                # A bad scan must not stop the processing of the others
+                print(f"{path} failed: {error!r}")
+                failures += 1
+                continue
+            print_result(results[-1])
+    else:
+        # Spawned processes, as for the flatfield, so that no hdf5 file is inherited
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as executor:
+            futures = {executor.submit(process_scan, path, *options): path for path in scan_paths}
+            for future in as_completed(futures):
+                try:
+                    print_result(future.result())
+                except Exception as error:
+                    print(f"{futures[future]} failed: {error!r}")
+                    failures += 1
+    print(f"Processed {len(scan_paths) - failures} of {len(scan_paths)} scans in {parsed.output}")
+    return 1 if failures else 0
+
+
+def print_result(result: dict) -> None:
+    stopped_fits = f" ({result['fit_errors']} fits stopped early)" if result['fit_errors'] else ""
+    print(f"{result['scan']}: {result['images']} images, {result['peaks']} fitted peaks{stopped_fits} "
+          f"in {result['time']:.1f} s")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
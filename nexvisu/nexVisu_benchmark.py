@@ -0,0 +1,315 @@
+"""Benchmarks of the processing of XPAD scans, on synthetic XPAD S-140 scans (240x560 images) of several sizes.
+
+Each benchmark is timed over a few runs, and the peak of the memory it allocates is recorded with tracemalloc.
+The results can be saved as a baseline, and a later run compared to it to catch the regressions.
+
+Example:
+    python nexVisu_benchmark.py --sizes 10 100 --output baseline.json
+    python nexVisu_benchmark.py --sizes 10 100 --compare baseline.json
+"""
+from h5py import File
+from PyQt5.QtCore import QEventLoop
+from PyQt5.QtWidgets import QApplication
+
+from detectors.xpad.visualisationTab.fittingDataTab.fittingDataTab import FittingDataTab
+from utils.fitFunctions import create_pearson7_fit_manager, fit_diagram_peaks, fit_diagram_stack, pearson7bg
+from utils.imageProcessing import clear_angles_cache, compute_angles, compute_geometry, correct_and_unfold_data, \
+    correct_and_unfold_images, extract_diffraction_diagram, extract_diffraction_diagrams, gen_flatfield, get_angles, \
+    patch_data, UNFOLDING_DTYPE
+from utils.lazyImageStack import LazyImageStack
+from utils.nexusNavigation import clear_file_indexes
+
+import argparse
+import json
+import numpy
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Calibration of the synthetic scans, the detector stays at DELTA, GAMMA during a scan
+CALIBRATION = {"distance": [76.78], "x": [300.0], "y": [120.0], "delta_position": [10.0], "gamma_position": [3.0]}
+DELTA = 20.0
+GAMMA = 0.0
+
+# Diffraction rings of the synthetic images: position in the 2θ range seen by the detector, amplitude, fwhm and
+# exposant of their pearson7, and drift of their 2θ from one image to the next
+RINGS = ((0.2, 800., 0.1, 1.5), (0.45, 500., 0.12, 1.5), (0.7, 1000., 0.08, 2.0), (0.85, 300., 0.15, 1.2))
+RING_DRIFT = 0.001
+BACKGROUND = 20.
+
+# Psi sector integrated in the diagrams, as in the gui
+PSI_MIN = -100
+PSI_MAX = 100
+
+# Positions of the scan whose detector moves, to time the computation of the 2θ/ψ maps of every image
+MOVING_DELTA_RANGE = (10.0, 30.0)
+
+# Number of scans of the flatfield series, copies of the synthetic scan, and of processes summing them in parallel
+FLATFIELD_NB_SCANS = 4
+FLATFIELD_WORKERS = 4
+
+BENCHMARKS = ("gen_flatfield", "gen_flatfield_parallel", "get_angles", "get_angles_indexed", "compute_geometry",
+              "correct_and_unfold_data",
+              "correct_and_unfold_images", "unfold_moving_detector", "extract_diffraction_diagram", "patch_data",
+              "fit_diagram_peaks", "fit_diagram_stack", "automatic_fit", "automatic_fit_tracking")
+
+
+class SyntheticScan:
+    """Synthetic scan of nb_images images written in a NeXus file of directory, and what its benchmarks start from:
+    its images, geometry, unfolded images and diagrams."""
+    def __init__(self, directory: str, nb_images: int, seed: int = 0):
+        self.nb_images = nb_images
+        # scan_1.nxs is also the first scan of a flatfield series, the next ones being links to it
+        self.path = os.path.join(directory, "scan_1.nxs")
+        self.geometry = compute_geometry(CALIBRATION, None, numpy.zeros((1, 240, 560)))
+        write_synthetic_scan(self.path, self.geometry, nb_images, seed)
+        for number in range(2, FLATFIELD_NB_SCANS + 1):
+            copy_path = os.path.join(directory, f"scan_{number}.nxs")
+            try:
+                os.link(self.path, copy_path)
+            except OSError:
+                shutil.copyfile(self.path, copy_path)
+        stack = LazyImageStack(self.path)
+        try:
+            self.images = stack[:]
+        finally:
+            stack.close()
+        # The images of the static detector all share the same 2θ/ψ maps
+        angle_keys, angle_maps, intensities = correct_and_unfold_images(self.geometry, self.images, DELTA, GAMMA)
+        two_theta, psi = angle_maps[angle_keys[0]]
+        self.unfolded_images = [(two_theta, psi, intensity) for intensity in intensities]
+        self.step = 1.0 / self.geometry["calib"]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            self.raw_diagrams = [extract_diffraction_diagram(*image, self.step, PSI_MIN, PSI_MAX,
+                                                             patch_data_flag=False)
+                                 for image in self.unfolded_images]
+            self.two_theta, self.diagrams = extract_diffraction_diagrams(self.unfolded_images, self.step, PSI_MIN,
+                                                                         PSI_MAX)
+
+
+def write_synthetic_scan(path: str, geometry: dict, nb_images: int, seed: int = 0) -> None:
+    """Write a scan of diffraction rings in a NeXus file laid out as the scans of the beamline: the images and the
+    static delta and gamma of the detector, found by the paths of constants."""
+    rng = numpy.random.default_rng(seed)
+    two_theta, _ = compute_angles(geometry, DELTA, GAMMA)
+    # 2θ of each raw pixel, from the corrected pixel it is gathered into
+    raw_two_theta = numpy.full(240 * 560, numpy.nan)
+    raw_two_theta[geometry["remap_index"]] = two_theta
+    raw_two_theta[numpy.isnan(raw_two_theta)] = numpy.nanmean(raw_two_theta)
+    two_theta_min, two_theta_max = two_theta.min(), two_theta.max()
+    with File(path, mode='w') as h5file:
+        scan_data = h5file.create_group("scan/scan_data")
+        dataset = scan_data.create_dataset("data_01", shape=(nb_images, 240, 560), dtype=numpy.int32,
+                                           chunks=(1, 240, 560), compression="gzip", compression_opts=1)
+        dataset.attrs["interpretation"] = numpy.bytes_(b"image")
+        for index in range(nb_images):
+            image = numpy.full(raw_two_theta.shape, BACKGROUND)
+            for position, amplitude, fwhm, exposant in RINGS:
+                center = two_theta_min + position * (two_theta_max - two_theta_min) + RING_DRIFT * index
+                image += pearson7bg(raw_two_theta, 0., 0., amplitude, center, fwhm, exposant)
+            dataset[index] = rng.poisson(image).reshape(240, 560)
+        h5file["scan/D13-1-CX1__EX__DIF.1-DELTA__#1/raw_value"] = numpy.array([DELTA])
+        h5file["scan/D13-1-CX1__EX__DIF.1-GAMMA__#1/raw_value"] = numpy.array([GAMMA])
+    clear_angles_cache()
+
+
+class AutomaticFit:
+    """Automatic fit of the diagrams of the scan by the fitting tab of the gui, in its pool of spawned processes, with
+    or without tracking the peaks. The pool is started by the first run and kept for the next ones, as in the gui.
+    The peak memory is the one of the gui process only."""
+    def __init__(self, scan: SyntheticScan, tracking: bool):
+        self.application = get_application()
+        self.data_to_fit = [(scan.two_theta, diagram) for diagram in scan.diagrams]
+        self.tab = FittingDataTab(None)
+        self.tab.tracking_box.setChecked(tracking)
+
+    def __call__(self) -> list:
+        self.tab.set_data_to_fit(list(self.data_to_fit))
+        while self.tab.progress is not None:
+            # The fitted diagrams come back as queued signals
+            self.application.processEvents(QEventLoop.WaitForMoreEvents)
+        return self.tab._fitted_peaks
+
+    def close(self) -> None:
+        self.tab.shutdown_automatic_fit()
+        self.tab.deleteLater()
+
+
+def get_application() -> QApplication:
+    application = QApplication.instance()
+    if application is None:
+        # The benchmarks run without display
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        application = QApplication([])
+    return application
+
+
+def get_benchmark(name: str, scan: SyntheticScan):
+    """Return the function running the benchmark of the given name on the scan."""
+    if name == "gen_flatfield":
+        return lambda: gen_flatfield(1, FLATFIELD_NB_SCANS, scan.path)
+    if name == "gen_flatfield_parallel":
+        return lambda: gen_flatfield(1, FLATFIELD_NB_SCANS, scan.path, workers=FLATFIELD_WORKERS)
+    if name == "get_angles":
+        def get_angles_of_new_file():
+            # The index of the paths of the file is built again at each run, as for a file opened the first time
+            clear_file_indexes()
+            return get_angles(scan.path)
+        return get_angles_of_new_file
+    if name == "get_angles_indexed":
+        return lambda: get_angles(scan.path)
+    if name == "compute_geometry":
+        return lambda: compute_geometry(CALIBRATION, None, scan.images)
+    if name == "correct_and_unfold_data":
+        def unfold_images():
+            # The 2θ/ψ maps are computed again at each run
+            clear_angles_cache()
+            return [correct_and_unfold_data(scan.geometry, image, DELTA, GAMMA) for image in scan.images]
+        return unfold_images
+    if name == "correct_and_unfold_images":
+        def unfold_stack():
+            clear_angles_cache()
+            return correct_and_unfold_images(scan.geometry, scan.images, DELTA, GAMMA)
+        return unfold_stack
+    if name == "unfold_moving_detector":
+        delta_array = numpy.linspace(*MOVING_DELTA_RANGE, scan.nb_images)
+
+        def unfold_moving_stack():
+            clear_angles_cache()
+            return correct_and_unfold_images(scan.geometry, scan.images, delta_array, GAMMA)
+        return unfold_moving_stack
+    if name == "extract_diffraction_diagram":
+        def extract_diagrams():
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                return [extract_diffraction_diagram(*image, scan.step, PSI_MIN, PSI_MAX)
+                        for image in scan.unfolded_images]
+        return extract_diagrams
+    if name == "patch_data":
+        def patch_diagrams():
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                return [patch_data(*diagram) for diagram in scan.raw_diagrams]
+        return patch_diagrams
+    if name == "fit_diagram_peaks":
+        def fit_diagrams():
+            fit = create_pearson7_fit_manager()
+            return [fit_diagram_peaks(scan.two_theta, diagram, fit) for diagram in scan.diagrams]
+        return fit_diagrams
+    if name == "fit_diagram_stack":
+        return lambda: fit_diagram_stack(scan.two_theta, scan.diagrams)
+    if name == "automatic_fit":
+        return AutomaticFit(scan, tracking=False)
+    if name == "automatic_fit_tracking":
+        return AutomaticFit(scan, tracking=True)
+    raise ValueError(f"Unknown benchmark {name}")
+
+
+def run_benchmark(function, repeat: int) -> dict:
+    """Time repeat runs of function, then run it once more to record the peak of the memory it allocates:
+    tracemalloc slows the allocations down, the timed runs are not traced."""
+    durations = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start_time)
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"best": min(durations), "median": float(numpy.median(durations)), "peak_memory": peak}
+
+
+def run_benchmarks(sizes: list, names: list, repeat: int) -> list:
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for nb_images in sizes:
+            scan_directory = os.path.join(directory, str(nb_images))
+            os.makedirs(scan_directory)
+            print(f"Writing a synthetic scan of {nb_images} images")
+            scan = SyntheticScan(scan_directory, nb_images)
+            for name in names:
+                result = {"benchmark": name, "images": nb_images}
+                function = get_benchmark(name, scan)
+                try:
+                    result.update(run_benchmark(function, repeat))
+                finally:
+                    if hasattr(function, "close"):
+                        function.close()
+                print_result(result)
+                results.append(result)
+    return results
+
+
+def get_environment() -> dict:
+    return {"python": platform.python_version(), "numpy": numpy.__version__, "machine": platform.machine(),
+            "processor": platform.processor(), "cpus": os.cpu_count(), "dtype": numpy.dtype(UNFOLDING_DTYPE).name}
+
+
+def compare_results(results: list, baseline: list, tolerance: float) -> int:
+    """Print the ratios of the results to the baseline ones, return the number of benchmarks slower or using more
+    memory than the baseline by more than tolerance."""
+    reference = {(result["benchmark"], result["images"]): result for result in baseline}
+    regressions = 0
+    for result in results:
+        base = reference.get((result["benchmark"], result["images"]))
+        if base is None:
+            continue
+        time_ratio = result["best"] / base["best"]
+        memory_ratio = result["peak_memory"] / base["peak_memory"] if base["peak_memory"] else 1.0
+        regression = time_ratio > 1 + tolerance or memory_ratio > 1 + tolerance
+        regressions += regression
+        print(f"{result['benchmark']:>28} {result['images']:>6} images: time x{time_ratio:.2f}, "
+              f"memory x{memory_ratio:.2f}{'  REGRESSION' if regression else ''}")
+    return regressions
+
+
+def print_result(result: dict) -> None:
+    print(f"{result['benchmark']:>28} {result['images']:>6} images: best {result['best'] * 1000:9.1f} ms, "
+          f"median {result['median'] * 1000:9.1f} ms, peak memory {result['peak_memory'] / 1024 ** 2:8.1f} MB")
+
+
+def parse_arguments(arguments: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Time the processing of synthetic XPAD scans and record the peaks "
+                                                 "of its memory.")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10, 100], help="numbers of images of the scans")
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS),
+                        help="benchmarks to run, all of them by default")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs of each benchmark")
+    parser.add_argument("--output", help="json file the results are saved in, to be used as a baseline")
+    parser.add_argument("--compare", help="json file of baseline results the results are compared to")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="relative increase of the time or of the memory reported as a regression")
+    parsed = parser.parse_args(arguments)
+    if parsed.repeat < 1 or min(parsed.sizes) < 1:
+        parser.error("--repeat and --sizes must be positive")
+    return parsed
+
+
+def main(arguments: list = None) -> int:
+    parsed = parse_arguments(sys.argv[1:] if arguments is None else arguments)
+    baseline = None
+    if parsed.compare is not None:
+        # Read before running, a missing baseline should not waste a whole run
+        with open(parsed.compare, "r") as infile:
+            baseline = json.load(infile)
+    results = run_benchmarks(parsed.sizes, parsed.benchmarks, parsed.repeat)
+    if parsed.output is not None:
+        with open(parsed.output, "w") as outfile:
+            json.dump({"environment": get_environment(), "results": results}, outfile, indent=2)
+        print(f"Saved the results in {parsed.output}")
+    if baseline is not None:
+        if baseline["environment"] != get_environment():
+            print(f"The baseline was run in another environment: {baseline['environment']}")
+        regressions = compare_results(results, baseline["results"], parsed.tolerance)
+        print(f"{regressions} regressions compared to {parsed.compare}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+from h5py import File
+from unittest import mock
+
+from nexVisu_batch import process_scan
+
+import nexVisu_batch
+import numpy
+import os
+import tempfile
+import unittest
+
+CALIBRATION = {"distance": [76.78], "x": [300.0], "y": [120.0], "delta_position": [10.0], "gamma_position": [3.0]}
+NB_IMAGES = 3
+
+
+def write_scan(path: str) -> None:
+    rng = numpy.random.default_rng(0)
+    with File(path, mode='w') as h5file:
+        dataset = h5file.create_dataset("scan/scan_data/data_01", data=rng.poisson(50., (NB_IMAGES, 240, 560)),
+                                        dtype=numpy.int32)
+        dataset.attrs["interpretation"] = numpy.bytes_(b"image")
+        h5file["scan/D13-1-CX1__EX__DIF.1-DELTA__#1/raw_value"] = numpy.array([20.])
+        h5file["scan/D13-1-CX1__EX__DIF.1-GAMMA__#1/raw_value"] = numpy.array([0.])
+
+
+class TestProcessScan(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "scan_1.nxs")
+        self.output = os.path.join(self.directory.name, "processed")
+        os.makedirs(self.output)
+        write_scan(self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_outputs(self):
+        result = process_scan(self.path, CALIBRATION, None, self.output, fit_flag=False, save_unfolded_flag=True)
+        self.assertEqual(result["images"], NB_IMAGES)
+        self.assertEqual(sorted(os.listdir(self.output)), ["scan_1_diagrams.nxs", "scan_1_unfolded.nxs"])
+        with File(os.path.join(self.output, "scan_1_unfolded.nxs"), mode='r') as h5file:
+            self.assertEqual(h5file["entry/unfolded_data/intensity"].shape[0], NB_IMAGES)
+        with File(os.path.join(self.output, "scan_1_diagrams.nxs"), mode='r') as h5file:
+            self.assertEqual(h5file["entry/diagrams/intensity"].shape[0], NB_IMAGES)
+
+    def test_failed_scan_leaves_no_output(self):
+        with mock.patch.object(nexVisu_batch, "extract_diffraction_diagrams", side_effect=MemoryError):
+            with self.assertRaises(MemoryError):
+                process_scan(self.path, CALIBRATION, None, self.output, fit_flag=False, save_unfolded_flag=True)
+        self.assertEqual(os.listdir(self.output), [])
+        # The scan file was closed, it can be written again
+        with File(self.path, mode='a'):
+            pass
+
+
+if __name__ == "__main__":
+    unittest.main()
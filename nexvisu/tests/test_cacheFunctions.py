@@ -0,0 +1,125 @@
+from utils.cacheFunctions import evict_files, get_nbytes, LRUCache, unfolding_key, UnfoldingCache
+from utils.unfoldedStack import UnfoldedStack
+
+import numpy
+import os
+import tempfile
+import time
+import unittest
+
+CALIBRATION = {"distance": [76.78], "x": [300.0], "y": [120.0], "delta_position": [10.0], "gamma_position": [3.0]}
+
+
+def get_stack() -> UnfoldedStack:
+    angle_maps = {(1.0, 0.0): (numpy.arange(6.), numpy.arange(6.) + 10), (2.0, 0.0): (numpy.ones(6), numpy.zeros(6))}
+    stack = UnfoldedStack(3)
+    stack.extend([(1.0, 0.0), (2.0, 0.0), (1.0, 0.0)], angle_maps, numpy.arange(18.).reshape(3, 6))
+    return stack
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(3 * 80)
+        for key in "abc":
+            cache.put(key, numpy.zeros(10))
+        self.assertIsNotNone(cache.get("a"))
+        cache.put("d", numpy.zeros(10))
+        self.assertNotIn("b", cache)
+        self.assertIn("a", cache)
+        self.assertIn("d", cache)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.size, 3 * 80)
+
+    def test_replace_and_oversize(self):
+        cache = LRUCache(100)
+        cache.put("a", numpy.zeros(5))
+        cache.put("a", numpy.zeros(10))
+        self.assertEqual(cache.size, 80)
+        cache.put("b", numpy.zeros(100))
+        self.assertNotIn("b", cache)
+        self.assertEqual(cache.get("b", "missing"), "missing")
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_get_nbytes(self):
+        self.assertEqual(get_nbytes(numpy.zeros(4)), 32)
+        self.assertEqual(get_nbytes((numpy.zeros(4), [numpy.zeros(2, dtype=numpy.float32)])), 40)
+        self.assertEqual(get_nbytes(None), 0)
+        self.assertEqual(get_nbytes(get_stack()), 2 * 2 * 48 + 3 * 48)
+
+
+class TestUnfoldingKey(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "scan.nxs")
+        with open(self.path, "wb") as scan_file:
+            scan_file.write(b"scan")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_key_changes_with_the_parameters(self):
+        flatfield = numpy.ones((2, 2))
+        key = unfolding_key(self.path, CALIBRATION)
+        self.assertEqual(key, unfolding_key(self.path, dict(CALIBRATION)))
+        other_calibration = dict(CALIBRATION, x=[301.0])
+        other_flatfield = flatfield.copy()
+        other_flatfield[0, 0] = 2.
+        keys = [key, unfolding_key(self.path, other_calibration), unfolding_key(self.path, CALIBRATION, flatfield),
+                unfolding_key(self.path, CALIBRATION, other_flatfield),
+                unfolding_key(self.path, CALIBRATION, median_filter_flag=True),
+                unfolding_key(self.path, CALIBRATION, dtype=numpy.float32)]
+        self.assertEqual(len(set(keys)), len(keys))
+
+    def test_key_changes_with_the_file(self):
+        key = unfolding_key(self.path, CALIBRATION)
+        with open(self.path, "ab") as scan_file:
+            scan_file.write(b" data")
+        self.assertNotEqual(key, unfolding_key(self.path, CALIBRATION))
+
+
+class TestUnfoldingCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_memory_only_by_default(self):
+        cache = UnfoldingCache(1024 ** 2)
+        cache.put("key", get_stack())
+        self.assertIsNotNone(cache.get("key"))
+        self.assertIsNone(cache.directory)
+
+    def test_disk_round_trip(self):
+        stack = get_stack()
+        UnfoldingCache(1024 ** 2)._write("key", stack, self.directory.name, None)
+        self.assertEqual(os.listdir(self.directory.name), ["key.h5"])
+        read = UnfoldingCache(1024 ** 2, self.directory.name).get("key")
+        self.assertEqual(read.angle_keys, stack.angle_keys)
+        self.assertEqual(len(read.angle_maps), 2)
+        for read_item, item in zip(read, stack):
+            for read_array, array in zip(read_item, item):
+                numpy.testing.assert_array_equal(read_array, array)
+        self.assertIsNone(UnfoldingCache(1024 ** 2, self.directory.name).get("other key"))
+
+    def test_cancelled_write_leaves_no_file(self):
+        cache = UnfoldingCache(1024 ** 2)
+        cache.cancel_writes()
+        cache._write("key", get_stack(), self.directory.name, None)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_evict_files(self):
+        for index, name in enumerate(("old.h5", "recent.h5", "newest.h5")):
+            path = os.path.join(self.directory.name, name)
+            with open(path, "wb") as cache_file:
+                cache_file.write(bytes(100))
+            modification_time = time.time() - 100 + index
+            os.utime(path, (modification_time, modification_time))
+        evict_files(self.directory.name, 250)
+        self.assertEqual(sorted(os.listdir(self.directory.name)), ["newest.h5", "recent.h5"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+from h5py import File
+
+from utils.exportFunctions import save_unfolded_stack, save_unfolded_text, save_unfolded_text_files, \
+    UnfoldedStackWriter
+
+import numpy
+import os
+import tempfile
+import unittest
+
+
+def get_images(nb_images: int = 3) -> list:
+    rng = numpy.random.default_rng(0)
+    return [(rng.uniform(10., 50., 100), rng.uniform(-90., 90., 100), rng.uniform(0., 1e4, 100) / 3.)
+            for _ in range(nb_images)]
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_text_round_trip(self):
+        image = get_images(1)[0]
+        path = os.path.join(self.directory.name, "raw_0.txt")
+        save_unfolded_text(image, path)
+        numpy.testing.assert_array_equal(numpy.loadtxt(path), numpy.column_stack(image))
+        with open(path) as text_file:
+            first_line = text_file.readline().split()
+        self.assertEqual([float(value) for value in first_line], [array[0] for array in image])
+
+    def test_text_files(self):
+        images = get_images()
+        save_unfolded_text_files(images, os.path.join(self.directory.name, "unfolded_data"))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.directory.name, "unfolded_data"))),
+                         ["raw_0.txt", "raw_1.txt", "raw_2.txt"])
+
+    def test_nexus_round_trip(self):
+        images = get_images()
+        path = os.path.join(self.directory.name, "unfolded_data.nxs")
+        save_unfolded_stack(images, path)
+        with File(path, mode='r') as h5file:
+            data = h5file["entry/unfolded_data"]
+            for position, name in enumerate(("two_theta", "psi", "intensity")):
+                numpy.testing.assert_array_equal(data[name][()], [image[position] for image in images])
+
+    def test_failed_nexus_is_removed(self):
+        path = os.path.join(self.directory.name, "unfolded_data.nxs")
+        with self.assertRaises(ValueError):
+            with UnfoldedStackWriter(path, 2) as writer:
+                writer.write(0, get_images(1)[0])
+                raise ValueError("unfolding failed")
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == "__main__":
+    unittest.main()
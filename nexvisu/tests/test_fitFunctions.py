@@ -0,0 +1,92 @@
+from utils.fitFunctions import estimate_pearson7, fit_diagram_peaks, pearson7bg, pearson7bg_derivative, \
+    PEARSON7_PARAMETERS
+
+import contextlib
+import io
+import numpy
+import unittest
+
+# backgr, slopeline, amplitude, center, fwhm, exposant
+PARAMETERS = [5.0, 0.2, 100.0, 30.0, 0.4, 1.7]
+
+
+class TestPearson7(unittest.TestCase):
+    def test_derivative_matches_finite_differences(self):
+        x = numpy.linspace(28., 32., 401)
+        for index, name in enumerate(PEARSON7_PARAMETERS):
+            with self.subTest(name):
+                step = 1e-6 * max(abs(PARAMETERS[index]), 1.0)
+                upper = list(PARAMETERS)
+                lower = list(PARAMETERS)
+                upper[index] += step
+                lower[index] -= step
+                expected = (pearson7bg(x, *upper) - pearson7bg(x, *lower)) / (2 * step)
+                numpy.testing.assert_allclose(pearson7bg_derivative(x, PARAMETERS, index), expected,
+                                              rtol=1e-5, atol=1e-6 * numpy.abs(expected).max())
+
+    def test_far_from_peak_does_not_overflow(self):
+        with numpy.errstate(over='raise'):
+            values = pearson7bg(numpy.array([0., 1e300]), 1., 0., 10., 30., 1e-200, 2.)
+        numpy.testing.assert_array_equal(values, [1., 1.])
+
+    def test_estimate(self):
+        x = numpy.linspace(28., 32., 71)
+        y = pearson7bg(x, *PARAMETERS)
+        params, constraints = estimate_pearson7(x, y)
+        self.assertEqual(params.shape, (len(PEARSON7_PARAMETERS),))
+        self.assertEqual(constraints.shape, (len(PEARSON7_PARAMETERS), 3))
+        backgr, _, amplitude, center, fwhm, exposant = params
+        self.assertAlmostEqual(backgr, numpy.mean(numpy.concatenate((y[:5], y[-5:]))))
+        self.assertAlmostEqual(center, 30.0)
+        self.assertAlmostEqual(amplitude, y.max() - backgr)
+        self.assertGreater(fwhm, 0.)
+        self.assertEqual(exposant, 2.0)
+
+    def test_estimate_without_width(self):
+        x = numpy.linspace(28., 32., 71)
+        y = numpy.zeros_like(x)
+        y[35] = 1.
+        with self.assertRaises(IndexError):
+            estimate_pearson7(x, y)
+
+
+class TestFitDiagramPeaks(unittest.TestCase):
+    def test_fits_the_peaks(self):
+        x = numpy.arange(0., 30., 0.05)
+        y = pearson7bg(x, 2., 0., 100., 10., 0.3, 1.5) + pearson7bg(x, 0., 0., 60., 20., 0.4, 2.)
+        y_copy = y.copy()
+        peaks = fit_diagram_peaks(x, y)
+        self.assertEqual(len(peaks), 2)
+        numpy.testing.assert_array_equal(y, y_copy)
+        centers = [parameters[3] for _, _, parameters in peaks]
+        numpy.testing.assert_allclose(centers, [10., 20.], atol=1e-3)
+        numpy.testing.assert_allclose([parameters[2] for _, _, parameters in peaks], [100., 60.], rtol=1e-2)
+        for x_peak, y_peak, _ in peaks:
+            self.assertEqual(x_peak.shape, y_peak.shape)
+
+    def test_all_nan_diagram(self):
+        self.assertEqual(fit_diagram_peaks(numpy.arange(10.), numpy.full(10, numpy.nan)), [])
+
+    def test_errors_are_returned(self):
+        x = numpy.arange(0., 30., 0.05)
+        # A single point peak: its width can't be estimated
+        y = numpy.zeros_like(x)
+        y[300] = 10.
+        errors = []
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            peaks = fit_diagram_peaks(x, y, errors=errors)
+        self.assertEqual(peaks, [])
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(output.getvalue(), "")
+
+    def test_errors_are_logged(self):
+        x = numpy.arange(0., 30., 0.05)
+        y = numpy.zeros_like(x)
+        y[300] = 10.
+        with self.assertLogs("utils.fitFunctions", level="WARNING"):
+            fit_diagram_peaks(x, y)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,154 @@
+from utils.imageProcessing import check_unfolding_accuracy, clear_angles_cache, compute_geometry, \
+    correct_and_unfold_data, correct_and_unfold_images, correct_and_unfold_stack, extract_diffraction_diagram, \
+    extract_diffraction_diagrams, integrate_two_theta, patch_data, patch_data_stack
+
+import numpy
+import os
+import unittest
+
+# Output of the first version of the unfolding, one pixel out of REFERENCE_STEP, for the images below
+REFERENCE_PATH = os.path.join(os.path.dirname(__file__), "data", "unfolding_reference.npz")
+REFERENCE_STEP = 211
+# (delta, gamma) positions of the reference
+POSITIONS = ((15.5, 0.0), (25.0, 2.0))
+CALIBRATION = {"distance": [76.78], "x": [300.0], "y": [120.0], "delta_position": [10.0], "gamma_position": [3.0]}
+
+
+def get_images(nb_images: int = 1) -> numpy.ndarray:
+    pixels = numpy.arange(nb_images * 240 * 560)
+    return ((pixels * 7919) % 1000).reshape(nb_images, 240, 560).astype(numpy.int32)
+
+
+def get_flatfield() -> numpy.ndarray:
+    pixels = numpy.arange(240 * 560)
+    return (800 + (pixels * 104729) % 400).reshape(240, 560).astype(numpy.float64)
+
+
+class TestUnfolding(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with numpy.load(REFERENCE_PATH) as reference:
+            cls.reference = dict(reference)
+
+    def setUp(self):
+        clear_angles_cache()
+
+    def test_float64_unfolding_matches_reference(self):
+        images = get_images()
+        for flat_name, flatfield in (("no_flat", None), ("flat", get_flatfield())):
+            geometry = compute_geometry(CALIBRATION, flatfield, images, numpy.float64)
+            for position, (delta, gamma) in enumerate(POSITIONS):
+                prefix = f"{flat_name}_{position}_"
+                with self.subTest(prefix):
+                    two_theta, psi, intensity = correct_and_unfold_data(geometry, images[0], delta, gamma)
+                    self.assertEqual(two_theta.dtype, numpy.float64)
+                    self.assertEqual(intensity.dtype, numpy.float64)
+                    # The angles are computed with arctan2 instead of arctan, which moves them by less than 1e-9
+                    numpy.testing.assert_allclose(two_theta[::REFERENCE_STEP], self.reference[prefix + "two_theta"],
+                                                  rtol=0, atol=1e-8)
+                    numpy.testing.assert_allclose(psi[::REFERENCE_STEP], self.reference[prefix + "psi"],
+                                                  rtol=0, atol=1e-8)
+                    numpy.testing.assert_allclose(intensity[::REFERENCE_STEP], self.reference[prefix + "intensity"],
+                                                  rtol=1e-12)
+
+    def test_diagram_matches_reference(self):
+        images = get_images()
+        geometry = compute_geometry(CALIBRATION, None, images, numpy.float64)
+        for position, (delta, gamma) in enumerate(POSITIONS):
+            prefix = f"no_flat_{position}_"
+            with self.subTest(prefix):
+                two_theta, psi, intensity = correct_and_unfold_data(geometry, images[0], delta, gamma)
+                diagram_two_theta, diagram = extract_diffraction_diagram(two_theta, psi, intensity, 1 / 76.78, -100,
+                                                                         100, patch_data_flag=False)
+                numpy.testing.assert_allclose(diagram_two_theta, self.reference[prefix + "diagram_two_theta"],
+                                              rtol=0, atol=1e-8)
+                numpy.testing.assert_allclose(diagram, self.reference[prefix + "diagram"], rtol=1e-9)
+                _, patched = patch_data(diagram_two_theta, diagram)
+                numpy.testing.assert_allclose(patched, self.reference[prefix + "patched"], rtol=1e-9)
+
+    def test_stack_matches_images(self):
+        images = get_images(5)
+        geometry = compute_geometry(CALIBRATION, get_flatfield(), images, numpy.float64)
+        delta_array = numpy.array([15.5, 15.5, 25.0, 15.5, 25.0])
+        gamma_array = numpy.array([0.0, 0.0, 2.0, 0.0, 2.0])
+        two_theta_stack, psi_stack, intensity_stack = correct_and_unfold_stack(geometry, images, delta_array,
+                                                                               gamma_array, chunk_size=2)
+        keys, angle_maps, intensities = correct_and_unfold_images(geometry, images, delta_array, gamma_array,
+                                                                  chunk_size=2)
+        self.assertEqual(len(angle_maps), 2)
+        for index, image in enumerate(images):
+            two_theta, psi, intensity = correct_and_unfold_data(geometry, image, delta_array[index],
+                                                                gamma_array[index])
+            numpy.testing.assert_array_equal(two_theta_stack[index], two_theta)
+            numpy.testing.assert_array_equal(psi_stack[index], psi)
+            numpy.testing.assert_array_equal(intensity_stack[index], intensity)
+            numpy.testing.assert_array_equal(angle_maps[keys[index]][0], two_theta)
+            numpy.testing.assert_array_equal(angle_maps[keys[index]][1], psi)
+            numpy.testing.assert_array_equal(intensities[index], intensity)
+
+    def test_float32_unfolding_accuracy(self):
+        images = get_images(2)
+        geometry = compute_geometry(CALIBRATION, get_flatfield(), images, numpy.float32)
+        keys, angle_maps, intensities = correct_and_unfold_images(geometry, images, 15.5, 0.0)
+        self.assertEqual(intensities.dtype, numpy.float32)
+        self.assertTrue(all(array.dtype == numpy.float32 for maps in angle_maps.values() for array in maps))
+        accuracy = check_unfolding_accuracy(CALIBRATION, get_flatfield(), images, [15.5, 25.0], [0.0, 2.0],
+                                            numpy.float32)
+        self.assertLess(accuracy["two_theta"], 1e-4)
+        self.assertLess(accuracy["psi"], 5e-3)
+        self.assertLess(accuracy["intensity"], 1e-6)
+        # The pixels close to the edges of the 2θ bins change a few bins of the diagrams
+        self.assertLess(accuracy["diagram"], 5e-2)
+        self.assertLess(accuracy["diagram_mean"], 1e-3)
+
+
+class TestIntegration(unittest.TestCase):
+    def test_integrate_two_theta_matches_loop(self):
+        rng = numpy.random.default_rng(0)
+        two_theta = rng.uniform(10., 20., 5000)
+        intensity = rng.uniform(0., 100., 5000)
+        selection = rng.random(5000) > 0.3
+        two_theta_min, step, nb_of_bins = 12., 0.1, 50
+        sums, counts, squares = integrate_two_theta(two_theta, intensity, two_theta_min, step, nb_of_bins, selection,
+                                                    squares_flag=True)
+        expected_sums = numpy.zeros(nb_of_bins)
+        expected_counts = numpy.zeros(nb_of_bins, dtype=int)
+        expected_squares = numpy.zeros(nb_of_bins)
+        for angle, value, selected in zip(two_theta, intensity, selection):
+            index = int(numpy.floor((angle - two_theta_min) / step))
+            if selected and 0 <= index < nb_of_bins:
+                expected_sums[index] += value
+                expected_counts[index] += 1
+                expected_squares[index] += value * value
+        numpy.testing.assert_allclose(sums, expected_sums)
+        numpy.testing.assert_array_equal(counts, expected_counts)
+        numpy.testing.assert_allclose(squares, expected_squares)
+
+    def test_patch_data_stack_matches_patch_data(self):
+        rng = numpy.random.default_rng(1)
+        diagrams = []
+        for start, length in ((10., 400), (12.5, 300), (30., 0), (20., 500)):
+            two_theta = start + numpy.arange(length) * 0.013
+            intensity = rng.uniform(-10., 100., length)
+            diagrams.append((two_theta, intensity))
+        two_theta_grid, intensity_matrix = patch_data_stack(diagrams)
+        self.assertEqual(intensity_matrix.shape, (len(diagrams), len(two_theta_grid)))
+        for diagram, intensity_row in zip(diagrams, intensity_matrix):
+            two_theta_patched, intensity_patched = patch_data(*diagram)
+            numpy.testing.assert_array_equal(two_theta_patched, two_theta_grid)
+            numpy.testing.assert_array_equal(intensity_row, intensity_patched)
+
+    def test_extract_diffraction_diagrams_matches_diagram(self):
+        clear_angles_cache()
+        images = get_images(3)
+        geometry = compute_geometry(CALIBRATION, None, images, numpy.float64)
+        unfolded = [correct_and_unfold_data(geometry, image, 15.5, 0.0) for image in images]
+        two_theta_grid, intensity_matrix = extract_diffraction_diagrams(unfolded, 1 / 76.78, -100, 100)
+        for image, intensity_row in zip(unfolded, intensity_matrix):
+            two_theta, intensity = extract_diffraction_diagram(*image, 1 / 76.78, -100, 100)
+            numpy.testing.assert_array_equal(two_theta, two_theta_grid)
+            numpy.testing.assert_array_equal(intensity, intensity_row)
+
+
+if __name__ == "__main__":
+    unittest.main()
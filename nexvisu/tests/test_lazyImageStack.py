@@ -0,0 +1,109 @@
+from h5py import File
+
+from utils.lazyImageStack import get_sidecar_paths, LazyImageStack, MemmapImageStack, open_image_stack, \
+    save_frame_sidecar
+
+import contextlib
+import io
+import numpy
+import os
+import tempfile
+import unittest
+
+NB_FRAMES = 20
+
+
+def write_scan(path: str) -> (numpy.ndarray, numpy.ndarray):
+    """Write a small scan laid out as the scans of the beamline, return its frames and delta angles."""
+    frames = numpy.arange(NB_FRAMES * 6 * 8, dtype=numpy.int32).reshape(NB_FRAMES, 6, 8)
+    delta_array = numpy.linspace(10., 20., NB_FRAMES)
+    with File(path, mode='w') as h5file:
+        scan_data = h5file.create_group("scan/scan_data")
+        dataset = scan_data.create_dataset("data_01", data=frames, chunks=(1, 6, 8), compression="gzip")
+        dataset.attrs["interpretation"] = numpy.bytes_(b"image")
+        delta = scan_data.create_dataset("actuator_1_1", data=delta_array)
+        delta.attrs["interpretation"] = numpy.bytes_(b"Delta")
+        h5file["scan/D13-1-CX1__EX__DIF.1-GAMMA__#1/raw_value"] = numpy.array([3.])
+    return frames, delta_array
+
+
+class TestImageStacks(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "scan.nxs")
+        self.frames, self.delta_array = write_scan(self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_lazy_stack(self):
+        images = LazyImageStack(self.path, cache_size=4, read_ahead=3)
+        try:
+            self.assertEqual(images.shape, self.frames.shape)
+            self.assertEqual(len(images), NB_FRAMES)
+            for index in (0, 5, 1, -1, 19, 7):
+                numpy.testing.assert_array_equal(images[index], self.frames[index])
+            self.assertLessEqual(len(images._frames), 4)
+            self.assertFalse(images[2].flags.writeable)
+            numpy.testing.assert_array_equal(images[3:9], self.frames[3:9])
+            numpy.testing.assert_array_equal(images[4, 1:3], self.frames[4, 1:3])
+            numpy.testing.assert_array_equal(numpy.asarray(images), self.frames)
+            with self.assertRaises(IndexError):
+                images[NB_FRAMES]
+            delta_array, gamma_array = images.get_angles()
+            numpy.testing.assert_array_equal(delta_array, self.delta_array)
+            numpy.testing.assert_array_equal(gamma_array, [3.])
+        finally:
+            images.close()
+
+    def test_sidecar_is_mapped(self):
+        images = LazyImageStack(self.path)
+        progress = []
+        try:
+            save_frame_sidecar(images, progress.append)
+        finally:
+            images.close()
+        self.assertEqual(sum(progress), NB_FRAMES)
+        images = open_image_stack(self.path)
+        self.assertIsInstance(images, MemmapImageStack)
+        self.assertEqual(images.shape, self.frames.shape)
+        self.assertEqual(images.dtype, self.frames.dtype)
+        numpy.testing.assert_array_equal(images[4], self.frames[4])
+        numpy.testing.assert_array_equal(images[2:7], self.frames[2:7])
+        delta_array, gamma_array = images.get_angles()
+        numpy.testing.assert_array_equal(delta_array, self.delta_array)
+        numpy.testing.assert_array_equal(gamma_array, [3.])
+        images.close()
+
+    def test_sidecar_of_a_changed_scan_is_not_used(self):
+        images = LazyImageStack(self.path)
+        try:
+            save_frame_sidecar(images)
+        finally:
+            images.close()
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        with contextlib.redirect_stdout(io.StringIO()):
+            images = open_image_stack(self.path)
+        try:
+            self.assertIsInstance(images, LazyImageStack)
+            numpy.testing.assert_array_equal(images[4], self.frames[4])
+        finally:
+            images.close()
+
+    def test_sidecar_without_header_is_not_used(self):
+        images = LazyImageStack(self.path)
+        try:
+            save_frame_sidecar(images)
+        finally:
+            images.close()
+        os.remove(get_sidecar_paths(self.path)[1])
+        images = open_image_stack(self.path)
+        try:
+            self.assertIsInstance(images, LazyImageStack)
+        finally:
+            images.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
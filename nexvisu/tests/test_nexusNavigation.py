@@ -0,0 +1,80 @@
+from concurrent.futures import ThreadPoolExecutor
+from h5py import File
+
+from utils.nexusNavigation import clear_file_indexes, DatasetPathContains, DatasetPathWithAttribute, FileIndex, \
+    get_dataset, get_file_index, INDEX_CACHE_SIZE
+
+import numpy
+import os
+import tempfile
+import unittest
+
+
+class TestFileIndex(unittest.TestCase):
+    def setUp(self):
+        clear_file_indexes()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "scan.nxs")
+        with File(self.path, mode='w') as h5file:
+            scan_data = h5file.create_group("scan/scan_data")
+            scan_data["data_01"] = numpy.zeros((2, 3, 4))
+            scan_data["data_01"].attrs["interpretation"] = numpy.bytes_(b"image")
+            h5file["scan/D13-1-CX1__EX__DIF.1-DELTA__#1/raw_value"] = numpy.array([1.])
+            h5file["scan/D13-1-CX1__EX__DIF.1-GAMMA__#1/raw_value"] = numpy.array([2.])
+
+    def tearDown(self):
+        clear_file_indexes()
+        self.directory.cleanup()
+
+    def test_whole_components_are_indexed(self):
+        with File(self.path, mode='r') as h5file:
+            file_index = FileIndex(h5file)
+        self.assertEqual(file_index.find_name_containing("D13-1-CX1__EX__DIF.1-GAMMA__#1/raw_value"),
+                         "scan/D13-1-CX1__EX__DIF.1-GAMMA__#1/raw_value")
+        self.assertEqual(file_index.find_name_containing("scan_data"), "scan/scan_data")
+        self.assertEqual(file_index.find_name_containing("/data"), "scan/scan_data/data_01")
+        self.assertIsNone(file_index.find_name_containing("d13-1-cx1__ex__dif.1-delta/raw_value"))
+        self.assertEqual(file_index.find_attribute("interpretation", b"image"), "scan/scan_data/data_01")
+
+    def test_get_dataset(self):
+        with File(self.path, mode='r') as h5file:
+            delta = get_dataset(h5file, DatasetPathContains("D13-1-CX1__EX__DIF.1-DELTA__#1/raw_value"))
+            numpy.testing.assert_array_equal(delta[()], [1.])
+            images = get_dataset(h5file, DatasetPathWithAttribute("interpretation", b"image"))
+            self.assertEqual(images.shape, (2, 3, 4))
+            self.assertIsNone(get_dataset(h5file, DatasetPathContains("missing")))
+
+    def test_index_is_shared_by_threads(self):
+        with File(self.path, mode='r') as h5file:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                file_indexes = list(executor.map(lambda _: get_file_index(h5file), range(64)))
+        self.assertTrue(all(file_index is file_indexes[0] for file_index in file_indexes))
+
+    def test_changed_file_is_indexed_again(self):
+        with File(self.path, mode='r') as h5file:
+            file_index = get_file_index(h5file)
+        with File(self.path, mode='a') as h5file:
+            h5file["scan/new"] = numpy.zeros(3)
+        with File(self.path, mode='r') as h5file:
+            self.assertIsNot(get_file_index(h5file), file_index)
+            self.assertEqual(get_file_index(h5file).find_name_containing("new"), "scan/new")
+
+    def test_number_of_indexes_is_bounded(self):
+        paths = []
+        for index in range(INDEX_CACHE_SIZE + 2):
+            path = os.path.join(self.directory.name, f"scan_{index}.nxs")
+            with File(path, mode='w') as h5file:
+                h5file["data"] = numpy.zeros(1)
+            paths.append(path)
+        file_indexes = []
+        for path in paths:
+            with File(path, mode='r') as h5file:
+                file_indexes.append(get_file_index(h5file))
+        with File(paths[0], mode='r') as h5file:
+            self.assertIsNot(get_file_index(h5file), file_indexes[0])
+        with File(paths[-1], mode='r') as h5file:
+            self.assertIs(get_file_index(h5file), file_indexes[-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+from utils.unfoldedStack import UnfoldedStack
+
+import numpy
+import unittest
+
+ANGLE_MAPS = {(1.0, 0.0): (numpy.arange(4.), numpy.arange(4.) + 10), (2.0, 0.0): (numpy.ones(4), numpy.zeros(4))}
+
+
+class TestUnfoldedStack(unittest.TestCase):
+    def test_extend_shares_the_maps(self):
+        stack = UnfoldedStack()
+        stack.extend([(1.0, 0.0), (1.0, 0.0), (2.0, 0.0)], ANGLE_MAPS, numpy.arange(12.).reshape(3, 4))
+        self.assertEqual(len(stack), 3)
+        self.assertIs(stack[0][0], stack[1][0])
+        self.assertIs(stack[2][1], ANGLE_MAPS[(2.0, 0.0)][1])
+        numpy.testing.assert_array_equal(stack[1][2], [4., 5., 6., 7.])
+        numpy.testing.assert_array_equal(stack[-1][2], [8., 9., 10., 11.])
+        self.assertEqual(len(stack[0:2]), 2)
+        self.assertEqual(len(list(stack)), 3)
+        self.assertEqual(stack.nbytes, 2 * 2 * 32 + 3 * 32)
+
+    def test_out_of_range(self):
+        stack = UnfoldedStack()
+        with self.assertRaises(IndexError):
+            stack.get_scatter_item(0)
+        stack.extend([(1.0, 0.0)], ANGLE_MAPS, numpy.zeros((1, 4)))
+        with self.assertRaises(IndexError):
+            stack[1]
+        with self.assertRaises(IndexError):
+            stack[-2]
+
+    def test_takes_ownership_of_the_first_intensities(self):
+        intensities = numpy.zeros((2, 4))
+        stack = UnfoldedStack(2)
+        stack.extend([(1.0, 0.0), (1.0, 0.0)], ANGLE_MAPS, intensities)
+        self.assertIs(stack.intensities, intensities)
+
+    def test_grows_chunk_by_chunk(self):
+        stack = UnfoldedStack(4)
+        first = numpy.zeros((1, 4))
+        stack.extend([(1.0, 0.0)], ANGLE_MAPS, first)
+        self.assertIsNot(stack.intensities, first)
+        self.assertEqual(stack.intensities.shape, (4, 4))
+        for index in range(1, 10):
+            stack.extend([(2.0, 0.0)], ANGLE_MAPS, numpy.full((1, 4), float(index)))
+        self.assertEqual(len(stack), 10)
+        self.assertGreaterEqual(stack.intensities.shape[0], 10)
+        self.assertEqual(stack.nbytes, 2 * 2 * 32 + 10 * 32)
+        numpy.testing.assert_array_equal([item[2][0] for item in stack], numpy.arange(10.))
+
+    def test_copy_is_independent(self):
+        stack = UnfoldedStack()
+        stack.extend([(1.0, 0.0)], ANGLE_MAPS, numpy.zeros((1, 4)))
+        copy = stack.copy()
+        copy.extend([(2.0, 0.0)], ANGLE_MAPS, numpy.ones((1, 4)))
+        copy.intensities[0] = 5.
+        self.assertEqual(len(stack), 1)
+        self.assertEqual(list(stack.angle_maps), [(1.0, 0.0)])
+        numpy.testing.assert_array_equal(stack[0][2], numpy.zeros(4))
+        self.assertIs(copy[0][0], stack[0][0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,3 +1,13 @@
+from collections import OrderedDict
+from h5py import File
+
+from utils.unfoldedStack import UnfoldedStack
+
+import hashlib
+import numpy
+import os
+import threading
+
 
 def memoisation(calibration: dict, use_flatfield: bool = None):
     index = []
@@ -6,3 +16,192 @@ def memoisation(calibration: dict, use_flatfield: bool = None):
     if use_flatfield is not None:
         index.append(use_flatfield)
     return tuple(index)
+
+
+class LRUCache:
+    """Least recently used cache of numpy arrays (or tuples of arrays), bounded by the memory they use.
+    It can be shared by several threads."""
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._items
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key, value) -> None:
+        nbytes = get_nbytes(value)
+        with self._lock:
+            if key in self._items:
+                self.size -= self._items.pop(key)[1]
+            # An item larger than the whole cache is not kept
+            if nbytes > self.max_bytes:
+                return
+            self._items[key] = (value, nbytes)
+            self.size += nbytes
+            while self.size > self.max_bytes:
+                _, (_, evicted_nbytes) = self._items.popitem(last=False)
+                self.size -= evicted_nbytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+def get_nbytes(value) -> int:
+    # arrays, and containers of arrays such as UnfoldedStack
+    if hasattr(value, "nbytes"):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(get_nbytes(item) for item in value)
+    return 0
+
+
+def unfolding_key(path: str, calibration: dict, flatfield: numpy.ndarray = None, median_filter_flag: bool = False,
+                  dtype=numpy.float64) -> str:
+    """Return the key of an unfolded scan, built from the scan file and its version on the disk, the calibration,
+    the content of the flatfield, the median filter flag and the floating point type of the unfolded images."""
+    stat = os.stat(path)
+    key = hashlib.sha1()
+    key.update(repr((os.path.realpath(path), stat.st_mtime_ns, stat.st_size)).encode())
+    key.update(repr(sorted((name, list(value)) for name, value in calibration.items())).encode())
+    if flatfield is None:
+        key.update(b"no flatfield")
+    else:
+        flatfield = numpy.ascontiguousarray(flatfield)
+        key.update(repr((flatfield.shape, flatfield.dtype.str)).encode())
+        key.update(flatfield.tobytes())
+    key.update(repr(bool(median_filter_flag)).encode())
+    key.update(numpy.dtype(dtype).str.encode())
+    return key.hexdigest()
+
+
+class UnfoldingCache:
+    """Unfolded scans, as UnfoldedStack, kept in a memory bounded LRU cache and optionally saved as hdf5 files in a
+    directory, itself bounded, so that they are found again in a new session."""
+    def __init__(self, max_bytes: int, directory: str = None, max_disk_bytes: int = None):
+        self.memory = LRUCache(max_bytes)
+        self.directory = None
+        self.max_disk_bytes = None
+        # Set when the scans being saved must be dropped, at exit
+        self._cancelled = threading.Event()
+        self.set_directory(directory, max_disk_bytes)
+
+    def set_directory(self, directory: str = None, max_disk_bytes: int = None) -> None:
+        """Save the unfolded scans in directory from now on, or only keep them in memory if directory is None."""
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        if directory is not None:
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except OSError as error:
+                print(f"Unfolded data will not be saved on the disk: {error}")
+                self.directory = None
+
+    def get(self, key: str):
+        images = self.memory.get(key)
+        if images is None and self.directory is not None:
+            images = self._read(key)
+            if images is not None:
+                self.memory.put(key, images)
+        return images
+
+    def put(self, key: str, images: UnfoldedStack) -> None:
+        self.memory.put(key, images)
+        if self.directory is not None and not self._cancelled.is_set():
+            # Writing a whole scan takes a while, it should not freeze the interface. The thread is not a daemon:
+            # a daemon killed at exit while holding the hdf5 lock would hang the interpreter, the exit rather cancels
+            # the write with cancel_writes
+            threading.Thread(target=self._write, args=(key, images, self.directory, self.max_disk_bytes)).start()
+
+    def clear(self) -> None:
+        self.memory.clear()
+
+    def cancel_writes(self) -> None:
+        """Stop saving the scans being written on the disk and drop their incomplete files, no scan is saved after."""
+        self._cancelled.set()
+
+    def _read(self, key: str):
+        path = os.path.join(self.directory, key + ".h5")
+        if not os.path.isfile(path):
+            return None
+        try:
+            with File(path, mode='r') as h5file:
+                angle_keys = [tuple(angle_key) for angle_key in h5file["angle_keys"][()].tolist()]
+                angle_maps = dict(zip(angle_keys, zip(h5file["two_theta"][()], h5file["psi"][()])))
+                angle_index = h5file["angle_index"][()]
+                images = UnfoldedStack(len(angle_index))
+                images.extend([angle_keys[index] for index in angle_index.tolist()], angle_maps,
+                              h5file["intensity"][()])
+            # Mark the file as recently used
+            os.utime(path)
+        except (OSError, KeyError) as error:
+            print(f"Can't read the unfolded data of {path}: {error}")
+            return None
+        return images
+
+    def _write(self, key: str, images: UnfoldedStack, directory: str, max_disk_bytes: int) -> None:
+        # The directory may change while the scan is saved, the thread keeps the one it started with
+        path = os.path.join(directory, key + ".h5")
+        temporary_path = path + ".tmp"
+        angle_keys = list(images.angle_maps)
+        key_index = {angle_key: index for index, angle_key in enumerate(angle_keys)}
+        try:
+            with File(temporary_path, mode='w') as h5file:
+                # The maps of each position are saved once, and the position of each image
+                h5file["angle_keys"] = numpy.array(angle_keys, dtype=numpy.float64).reshape(len(angle_keys), 2)
+                h5file["angle_index"] = numpy.array([key_index[angle_key] for angle_key in images.angle_keys])
+                for position, name in enumerate(("two_theta", "psi")):
+                    maps = [images.angle_maps[angle_key][position] for angle_key in angle_keys]
+                    dataset = h5file.create_dataset(name, shape=(len(maps),) + maps[0].shape, dtype=maps[0].dtype,
+                                                    chunks=(1,) + maps[0].shape, compression="lzf")
+                    for index, angle_map in enumerate(maps):
+                        dataset[index] = angle_map
+                intensities = images.intensities[:len(images)]
+                dataset = h5file.create_dataset("intensity", shape=intensities.shape, dtype=intensities.dtype,
+                                                chunks=(1,) + intensities.shape[1:], compression="lzf")
+                # Image by image, the scan is not copied as a whole
+                for index, intensity in enumerate(intensities):
+                    if self._cancelled.is_set():
+                        break
+                    dataset[index] = intensity
+            if self._cancelled.is_set():
+                os.remove(temporary_path)
+                return
+            # The file only appears once complete
+            os.replace(temporary_path, path)
+        except OSError as error:
+            print(f"Can't save the unfolded data in {path}: {error}")
+            return
+        if max_disk_bytes is not None:
+            evict_files(directory, max_disk_bytes)
+
+
+def evict_files(directory: str, max_disk_bytes: int) -> None:
+    """Remove the least recently used unfolded scans of directory until they fit in max_disk_bytes."""
+    try:
+        paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".h5")]
+        stats = sorted(((os.stat(path), path) for path in paths), key=lambda item: item[0].st_mtime)
+        size = sum(stat.st_size for stat, _ in stats)
+        for stat, path in stats:
+            if size <= max_disk_bytes:
+                break
+            os.remove(path)
+            size -= stat.st_size
+    except OSError as error:
+        # Another session may be evicting the same files
+        print(f"Can't evict the unfolded data of {directory}: {error}")
@@ -53,6 +53,13 @@ class RawDataViewer(StackView):
         else:
             self.setStack(None)
 
+    def update_movie(self, nb_images: int):
+        # Frames were written in the scan, the stack is shown again at the same frame and zoom
+        index_image = self.getFrameNumber()
+        self.action_movie.set_movie_size(nb_images)
+        self.setStack(self.action_use_flatfield.get_displayed_images(), reset=False)
+        self.setFrameNumber(index_image)
+
     def update_pause_button(self):
         if self.toolbar.actions()[-1] == self.action_pause:
             self.toolbar.removeAction(self.action_pause)
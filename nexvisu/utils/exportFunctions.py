@@ -0,0 +1,89 @@
+from h5py import File
+from pathlib import Path
+
+import numpy
+import os
+
+UNFOLDED_DATASETS = ("two_theta", "psi", "intensity")
+# Enough significant digits for a float64 to be read back unchanged, as the str() of the first text export
+TEXT_FORMAT = "%.17g"
+
+
+class UnfoldedStackWriter:
+    """NeXus file of a stack of unfolded images, as (two theta, psi, intensity) arrays, written frame by frame.
+    Each dataset holds one frame per row, chunked by frame so that a frame is read alone.
+    A low gzip level with the shuffle filter compresses the angles nearly as well as the default level, much faster.
+    Used as a context manager, the file is removed when the writing fails."""
+    def __init__(self, path: str, nb_frames: int, compression: str = "gzip", compression_opts: int = 1):
+        Path(os.path.dirname(path) or ".").mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.nb_frames = nb_frames
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.h5file = File(path, mode='w')
+        entry = self.h5file.create_group("entry")
+        entry.attrs["NX_class"] = "NXentry"
+        entry.attrs["default"] = "unfolded_data"
+        self.h5file.attrs["default"] = "entry"
+        self.data = entry.create_group("unfolded_data")
+        self.data.attrs["NX_class"] = "NXdata"
+        self.data.attrs["signal"] = "intensity"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def write(self, index: int, image: tuple) -> None:
+        for position, name in enumerate(UNFOLDED_DATASETS):
+            array = numpy.asarray(image[position])
+            if name not in self.data:
+                # The datasets are shaped by the first written frame
+                self.data.create_dataset(name, shape=(self.nb_frames,) + array.shape, dtype=array.dtype,
+                                         chunks=(1,) + array.shape, compression=self.compression,
+                                         compression_opts=self.compression_opts,
+                                         shuffle=self.compression is not None)
+            self.data[name][index] = array
+
+    def close(self) -> None:
+        self.h5file.close()
+
+    def discard(self) -> None:
+        """Close and remove the file, of a stack that could not be written entirely."""
+        self.h5file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def save_unfolded_stack(images: list, path: str, compression: str = "gzip", compression_opts: int = 1) -> None:
+    """Save a stack of unfolded images in a NeXus file, see UnfoldedStackWriter."""
+    with UnfoldedStackWriter(path, len(images), compression, compression_opts) as writer:
+        for index, image in enumerate(images):
+            writer.write(index, image)
+
+
+def save_unfolded_text(image: tuple, path: str) -> None:
+    """Save an unfolded image as a text file of "two_theta psi intensity" lines, like numpy.savetxt does
+    but formatted in a single operation instead of line by line."""
+    Path(os.path.dirname(path) or ".").mkdir(parents=True, exist_ok=True)
+    data = numpy.column_stack(image)
+    line_format = " ".join([TEXT_FORMAT] * data.shape[1]) + "\n"
+    text = (line_format * data.shape[0]) % tuple(data.ravel().tolist())
+    try:
+        with open(path, "w") as text_file:
+            text_file.write(text)
+    except OSError:
+        # A half written file is not left behind
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+
+def save_unfolded_text_files(images: list, directory: str) -> None:
+    """Save each unfolded image of the stack as a raw_{index}.txt text file of the directory."""
+    for index, image in enumerate(images):
+        save_unfolded_text(image, os.path.join(directory, f"raw_{index}.txt"))
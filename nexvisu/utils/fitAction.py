@@ -1,17 +1,16 @@
 from __future__ import division
 
 import logging
-import statistics
 
 import numpy
 
-from scipy.stats import linregress
-
 from silx.gui.plot.actions.PlotToolAction import PlotToolAction
 from silx.gui.plot import items
 from silx.gui import qt
 from silx.math.fit import FitManager
 
+from utils.fitFunctions import create_pearson7_derivative, pearson7bg, estimate_pearson7
+
 _logger = logging.getLogger(__name__)
 
 
@@ -71,7 +70,8 @@ class FitAction(PlotToolAction):
                       parameters=["backgr", "slopeline",
                                   "amplitude", "center",
                                   "fwhm", "exposant"],
-                      estimate=estimate_pearson7)
+                      estimate=estimate_pearson7,
+                      derivative=create_pearson7_derivative(fit))
 
         window = FitWidget(parent=self.plot, fitmngr=fit)
         window.setWindowFlags(qt.Qt.Dialog)
@@ -316,31 +316,3 @@ class FitAction(PlotToolAction):
         if ddict["event"] in ["FitStarted", "FitFailed"]:
             if fit_curve is not None:
                 fit_curve.setVisible(False)
-
-
-def pearson7bg(x, backgr, slopeline, amplitude, center, fwhmlike, exposant):
-    # print(x, backgr, slopeline, amplitude, center, fwhmlike, exposant)
-    return backgr + slopeline * x + amplitude * (1 + ((x-center) / fwhmlike) ** 2.0) ** (-exposant)
-
-
-def estimate_pearson7(x, y):
-    backgr = statistics.mean(y[:5] + y[-5:])
-    slopeline, _, _, _, _ = linregress(x, y)
-    amplitude = max(y) - backgr
-    center = x[numpy.argmax(y)]
-    upper_points = [index for index in range(len(x)) if y[index] > max(y)/2.0]
-    fwhm = []
-
-    for i in range(1, len(upper_points)):
-        if upper_points[i] - upper_points[i - 1] > 10:
-            fwhm.append(x[upper_points[i - 1]])
-            break
-        fwhm.append(x[upper_points[i - 1]])
-
-    fwhm = fwhm[-1] - fwhm[0]
-    exposant = 2.0
-
-    # params = [1.95029979e+04, -2.60909223e+03, 3.52252164e+02, 1.33957258e+01, 1.69597427e-01, 1.90484157e+00]
-    params = numpy.array([backgr, slopeline, amplitude, center, fwhm, exposant])
-    constraints = numpy.zeros(shape=(len(params), 3))
-    return params, constraints
@@ -0,0 +1,408 @@
+import logging
+import numpy
+
+from scipy.linalg import solveh_banded
+from scipy.stats import linregress
+
+from silx.math.fit import FitManager
+
+PEARSON7_PARAMETERS = ["backgr", "slopeline", "amplitude", "center", "fwhm", "exposant"]
+# Peaks lower than this fraction of the highest one are not fitted
+PEAK_HEIGHT_FRACTION = 1.0 / 4.0
+# Number of points on each side of a peak used to fit it
+PEAK_HALF_WIDTH = 35
+
+# Weight of the differences between the parameters of consecutive diagrams in the stack fit
+STACK_SMOOTHNESS = 1.0
+# Maximum number of iterations of the stack fit, and relative decrease of its cost under which it stops
+STACK_MAX_ITERATIONS = 100
+STACK_TOLERANCE = 1e-8
+# Levenberg-Marquardt damping of the stack fit at its start, and above which it gives up
+STACK_INITIAL_DAMPING = 1e-3
+STACK_MAX_DAMPING = 1e10
+# Lower bounds of the amplitude, fwhm and exposant of the peaks in the stack fit
+STACK_PEAK_LOWER_BOUNDS = (0., 1e-6, 0.1)
+
+logger = logging.getLogger(__name__)
+
+# FitManager of a process of a pool, created by its first fit
+_process_fit_manager = None
+# FitManager and seeded estimation of a process of a pool, created by its first tracking
+_process_tracking_fit = None
+
+
+def pearson7bg(x, backgr, slopeline, amplitude, center, fwhmlike, exposant):
+    # far from a narrow peak the power overflows, the peak is 0 there
+    with numpy.errstate(over='ignore'):
+        return backgr + slopeline * x + amplitude * (1 + ((x-center) / fwhmlike) ** 2.0) ** (-exposant)
+
+
+def pearson7bg_derivative(x, parameters, index):
+    """Derivative of pearson7bg with respect to its parameter of the given index, as called by the least squares."""
+    _, _, amplitude, center, fwhmlike, exposant = parameters
+    x = numpy.asarray(x, dtype=float)
+    if index == 0:
+        return numpy.ones_like(x)
+    if index == 1:
+        return x
+    u = (x - center) / fwhmlike
+    base = 1 + u ** 2.0
+    peak = base ** (-exposant)
+    if index == 2:
+        return peak
+    if index == 3:
+        return 2.0 * amplitude * exposant * u * peak / (base * fwhmlike)
+    if index == 4:
+        return 2.0 * amplitude * exposant * u ** 2.0 * peak / (base * fwhmlike)
+    return -amplitude * peak * numpy.log(base)
+
+
+def create_pearson7_derivative(fit: FitManager):
+    """Derivative of the pearson7 theory of a FitManager whose background theory can be changed: the background
+    parameters come first and are derived numerically, the pearson7 ones analytically."""
+    def derivative(x, parameters, index):
+        nb_background_parameters = len(parameters) - len(PEARSON7_PARAMETERS)
+        if index >= nb_background_parameters:
+            return pearson7bg_derivative(x, parameters[nb_background_parameters:], index - nb_background_parameters)
+        step = max(abs(parameters[index]) * 1e-6, 1e-9)
+        shifted = list(parameters)
+        shifted[index] += step
+        return (fit.fitfunction(x, *shifted) - fit.fitfunction(x, *parameters)) / step
+    return derivative
+
+
+def estimate_pearson7(x, y):
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    backgr = numpy.mean(numpy.concatenate((y[:5], y[-5:])))
+    slopeline, _, _, _, _ = linregress(x, y)
+    maximum = y.max()
+    amplitude = maximum - backgr
+    center = x[numpy.argmax(y)]
+    # the width goes from the first point above half of the maximum to the last one before a gap of more than 10
+    # points, the last point above half of the maximum being left out when there is no gap
+    upper_points = numpy.flatnonzero(y > maximum / 2.0)
+    if len(upper_points) < 2:
+        raise IndexError("The peak has less than two points above its half maximum")
+    gaps = numpy.flatnonzero(numpy.diff(upper_points) > 10)
+    last = gaps[0] if len(gaps) else len(upper_points) - 2
+    fwhm = x[upper_points[last]] - x[upper_points[0]]
+    exposant = 2.0
+
+    params = numpy.array([backgr, slopeline, amplitude, center, fwhm, exposant])
+    constraints = numpy.zeros(shape=(len(params), 3))
+    return params, constraints
+
+
+class SeededEstimate:
+    """Estimation of the pearson7 theory giving back the parameters it is seeded with, or the ones of
+    estimate_pearson7 when it is not seeded."""
+    def __init__(self):
+        self.seed = None
+
+    def __call__(self, x, y):
+        if self.seed is None:
+            return estimate_pearson7(x, y)
+        params = numpy.array(self.seed, dtype=float)
+        constraints = numpy.zeros(shape=(len(params), 3))
+        return params, constraints
+
+
+def create_pearson7_fit_manager(estimate=estimate_pearson7) -> FitManager:
+    fit = FitManager()
+    fit.addtheory("pearson7", function=pearson7bg, parameters=PEARSON7_PARAMETERS, estimate=estimate,
+                  derivative=pearson7bg_derivative)
+    fit.settheory("pearson7")
+    return fit
+
+
+def fit_diagram_peaks(x: numpy.ndarray, y: numpy.ndarray, fit: FitManager = None, errors: list = None) -> list:
+    """Fit the peaks of a diagram one after the other with a pearson7 on a linear background, from the highest one
+    down to a quarter of its height. Each fitted peak is erased before looking for the next one.
+    Return the list of (x of the peak, fitted y, fitted parameters) of the peaks. The reason why the fit stopped
+    early, if it did, is appended to errors when given, else logged."""
+    if fit is None:
+        fit = create_pearson7_fit_manager()
+    # the data are copied so that erasing the peaks does not change the arrays of the caller
+    x = numpy.array(x, dtype=float)
+    y = numpy.array(y, dtype=float)
+    peaks = []
+    if numpy.isnan(y).all():
+        return peaks
+    # get the max of the y array without any nan value
+    maximum = numpy.nanmax(y)
+    # current maximum / peak we are looking for (for the first iteration it will be the max)
+    current_maximum = maximum
+    background = None
+    try:
+        # a maximum at the level of the erased peaks is not a peak anymore
+        while current_maximum > maximum * PEAK_HEIGHT_FRACTION and current_maximum != background:
+            peak = numpy.where(y == current_maximum)[0][0]
+            left = max(peak - PEAK_HALF_WIDTH, 0)
+            right = min(peak + PEAK_HALF_WIDTH, len(x) - 1)
+            x_peak = x[left: right]
+            # fit only the peak, from a first guess of its parameters
+            fit.setdata(x=x_peak, y=y[left: right])
+            fit.estimate()
+            fit.runfit()
+            parameters = [param['fitresult'] for param in fit.fit_results]
+            peaks.append((x_peak, pearson7bg(x_peak, *parameters), parameters))
+
+            # erase the peak to make it easier to found other peaks.
+            background = numpy.mean(y[~numpy.isnan(y)])
+            y[left: right] = background
+            current_maximum = numpy.nanmax(y)
+    except (numpy.linalg.LinAlgError, TypeError):
+        _report_fit_error("Singular matrix error: fit is impossible with the given parameters", errors)
+    except IndexError:
+        _report_fit_error("The width of the peak can not be estimated, the fit stopped", errors)
+    return peaks
+
+
+def _report_fit_error(message: str, errors: list = None) -> None:
+    if errors is None:
+        logger.warning(message)
+    else:
+        errors.append(message)
+
+
+def fit_diagram_peaks_in_process(x: numpy.ndarray, y: numpy.ndarray) -> list:
+    """fit_diagram_peaks with the FitManager of the current process, to be submitted to a process pool."""
+    global _process_fit_manager
+    if _process_fit_manager is None:
+        _process_fit_manager = create_pearson7_fit_manager()
+    return fit_diagram_peaks(x, y, _process_fit_manager)
+
+
+def create_tracking_fit_manager() -> tuple:
+    """Return a FitManager estimating the peaks with a SeededEstimate, and this SeededEstimate."""
+    estimate = SeededEstimate()
+    return create_pearson7_fit_manager(estimate), estimate
+
+
+def track_diagram_peaks(x: numpy.ndarray, diagrams: numpy.ndarray, initial_parameters: list,
+                        fit: FitManager = None, estimate: SeededEstimate = None) -> list:
+    """Fit the peaks of consecutive diagrams, each peak starting from its fitted parameters in the previous diagram,
+    and from initial_parameters (as given by fit_diagram_peaks) in the first one. A peak is estimated again only when
+    its warm started fit fails.
+    Return, for each diagram, the list of (x of the peak, fitted y, fitted parameters) of the peaks in the order of
+    initial_parameters, with None for a peak lost in this diagram. Peaks appearing after the first diagram are not
+    looked for."""
+    if fit is None:
+        fit, estimate = create_tracking_fit_manager()
+    x = numpy.asarray(x, dtype=float)
+    previous_parameters = [list(parameters) for parameters in initial_parameters]
+    diagrams_peaks = []
+    for y in diagrams:
+        y = numpy.asarray(y, dtype=float)
+        peaks = []
+        for number, parameters in enumerate(previous_parameters):
+            peak = _fit_tracked_peak(fit, estimate, x, y, parameters)
+            peaks.append(peak)
+            # a lost peak starts again from its last known parameters
+            if peak is not None:
+                previous_parameters[number] = peak[2]
+        diagrams_peaks.append(peaks)
+    return diagrams_peaks
+
+
+def _fit_tracked_peak(fit: FitManager, estimate: SeededEstimate, x: numpy.ndarray, y: numpy.ndarray,
+                      parameters: list):
+    peak = int(numpy.clip(numpy.searchsorted(x, parameters[3]), 0, len(x) - 1))
+    left = max(peak - PEAK_HALF_WIDTH, 0)
+    right = min(peak + PEAK_HALF_WIDTH, len(x) - 1)
+    x_peak = x[left: right]
+    y_peak = y[left: right]
+    if len(x_peak) < len(PEARSON7_PARAMETERS) or numpy.isnan(y_peak).all():
+        return None
+    # the previous parameters first, the estimation when they do not converge
+    for seed in (parameters, None):
+        estimate.seed = seed
+        try:
+            fit.setdata(x=x_peak, y=y_peak)
+            fit.estimate()
+            fit.runfit()
+        except (numpy.linalg.LinAlgError, TypeError, IndexError, ValueError):
+            continue
+        fitted_parameters = [param['fitresult'] for param in fit.fit_results]
+        if _is_fitted_peak(fitted_parameters, x_peak):
+            return x_peak, pearson7bg(x_peak, *fitted_parameters), fitted_parameters
+    return None
+
+
+def _is_fitted_peak(parameters: list, x_peak: numpy.ndarray) -> bool:
+    _, _, amplitude, center, fwhm, _ = parameters
+    return bool(numpy.isfinite(parameters).all() and amplitude > 0 and fwhm != 0
+                and x_peak[0] <= center <= x_peak[-1])
+
+
+def track_diagram_peaks_in_process(x: numpy.ndarray, diagrams: numpy.ndarray, initial_parameters: list) -> list:
+    """track_diagram_peaks with the FitManager of the current process, to be submitted to a process pool."""
+    global _process_tracking_fit
+    if _process_tracking_fit is None:
+        _process_tracking_fit = create_tracking_fit_manager()
+    return track_diagram_peaks(x, diagrams, initial_parameters, *_process_tracking_fit)
+
+
+def fit_diagram_stack(x: numpy.ndarray, diagrams: numpy.ndarray, initial_parameters: list = None,
+                      smoothness: float = STACK_SMOOTHNESS) -> list:
+    """Fit all the diagrams of a stack at once with the same peaks, a pearson7 each, on a linear background shared by
+    the peaks of a diagram. The differences between the parameters of consecutive diagrams are penalised, weighted by
+    smoothness, so that the parameters vary smoothly along the stack.
+    All the diagrams start from the peaks of the first one found by fit_diagram_peaks, or from initial_parameters
+    given as returned by it. Only the points around these peaks are fitted.
+    Return, for each diagram, the list of (x of the peak, fitted y, fitted parameters) of the peaks, in the order of
+    the initial peaks, with the background of the diagram in the parameters of each peak."""
+    x = numpy.asarray(x, dtype=float)
+    diagrams = numpy.asarray(diagrams, dtype=float)
+    nb_diagrams = len(diagrams)
+    if initial_parameters is None and nb_diagrams:
+        initial_parameters = [parameters for _, _, parameters in fit_diagram_peaks(x, diagrams[0])]
+    if not nb_diagrams or not initial_parameters:
+        return [[] for _ in range(nb_diagrams)]
+    initial = numpy.array(initial_parameters, dtype=float)
+    nb_peaks = len(initial)
+    # parameters of a diagram: background and slope, then amplitude, center, fwhm and exposant of each peak
+    nb_parameters = 2 + 4 * nb_peaks
+
+    peaks_parameters = initial[:, 2:]
+    # the sign of the fwhm does not change the peak
+    peaks_parameters[:, 2] = numpy.abs(peaks_parameters[:, 2])
+
+    # the peaks may drift along the stack: in each diagram, a peak starts from the maximum within a fwhm of where it
+    # starts in the previous diagram, and all the points around these starts are fitted
+    step = numpy.mean(numpy.diff(x)) if len(x) > 1 else 1.
+    half_widths = numpy.maximum(numpy.rint(peaks_parameters[:, 2] / step).astype(int), 1)
+    centers = numpy.empty((nb_diagrams, nb_peaks), dtype=int)
+    centers[0] = numpy.searchsorted(x, peaks_parameters[:, 1]).clip(0, len(x) - 1)
+    with numpy.errstate(invalid='ignore'):
+        for diagram in range(1, nb_diagrams):
+            centers[diagram] = centers[diagram - 1]
+            for peak, half_width in enumerate(half_widths):
+                left = max(centers[diagram, peak] - half_width, 0)
+                window = diagrams[diagram, left: centers[diagram, peak] + half_width + 1]
+                if not numpy.isnan(window).all():
+                    centers[diagram, peak] = left + numpy.nanargmax(window)
+    fitted_points = numpy.zeros(len(x), dtype=bool)
+    for first_center, last_center in zip(centers.min(axis=0), centers.max(axis=0)):
+        fitted_points[max(first_center - PEAK_HALF_WIDTH, 0): last_center + PEAK_HALF_WIDTH] = True
+    x_fit = x[fitted_points]
+    y_fit = diagrams[:, fitted_points]
+    # the background is fitted around the middle of the points, where its level does not depend on its slope
+    x_middle = numpy.mean(x_fit)
+    x_centered = x_fit - x_middle
+    finite = numpy.isfinite(y_fit)
+    y_fit = numpy.where(finite, y_fit, 0.)
+
+    # the shared background starts as the regression of the first diagram without its peaks
+    first_finite = finite[0]
+    first_background = y_fit[0] - _stack_peaks(x_fit, peaks_parameters[None])[0].sum(axis=0)
+    slope, background, _, _, _ = linregress(x_centered[first_finite], first_background[first_finite])
+    lower_bounds = numpy.concatenate(([-numpy.inf, -numpy.inf],
+                                      numpy.tile([STACK_PEAK_LOWER_BOUNDS[0], -numpy.inf, STACK_PEAK_LOWER_BOUNDS[1],
+                                                  STACK_PEAK_LOWER_BOUNDS[2]], nb_peaks)))
+    parameters = numpy.tile(numpy.maximum(numpy.concatenate(([background, slope], peaks_parameters.ravel())),
+                                          lower_bounds), (nb_diagrams, 1))
+    parameters[1:, 3::4] = x[centers[1:]]
+
+    # a change of a parameter by its scale costs as much as a diagram misfitted by its noise on every point
+    noise = numpy.std(numpy.diff(y_fit[0][first_finite])) / numpy.sqrt(2.0)
+    amplitude = numpy.max(numpy.abs(peaks_parameters[:, 0]))
+    scales = numpy.concatenate(([amplitude, amplitude / max(numpy.ptp(x_fit), 1e-12)],
+                                numpy.column_stack((numpy.abs(peaks_parameters[:, 0]),
+                                                    numpy.abs(peaks_parameters[:, 2]),
+                                                    numpy.abs(peaks_parameters[:, 2]),
+                                                    numpy.abs(peaks_parameters[:, 3]))).ravel()))
+    smoothness_weights = smoothness * max(noise, 1e-12) * numpy.sqrt(len(x_fit)) / numpy.maximum(scales, 1e-12)
+
+    def residuals(parameters):
+        model = parameters[:, :1] + parameters[:, 1:2] * x_centered \
+            + _stack_peaks(x_fit, parameters[:, 2:].reshape(nb_diagrams, nb_peaks, 4)).sum(axis=1)
+        return numpy.where(finite, model - y_fit, 0.), numpy.diff(parameters, axis=0) * smoothness_weights
+
+    def cost(data_residuals, smoothness_residuals):
+        return numpy.sum(data_residuals ** 2) + numpy.sum(smoothness_residuals ** 2)
+
+    def jacobian(parameters):
+        # each point only depends on the parameters of its diagram: one (point, parameter) block per diagram
+        peaks = parameters[:, 2:].reshape(nb_diagrams, nb_peaks, 4)
+        peak_parameters = (0., 0.) + tuple(peaks[:, :, position, None] for position in range(4))
+        derivatives = numpy.empty((nb_diagrams, len(x_fit), nb_parameters))
+        derivatives[:, :, 0] = 1.
+        derivatives[:, :, 1] = x_centered
+        for position in range(4):
+            # (diagram, peak, point) derivatives, stored as the columns of the parameters of each peak
+            derivatives[:, :, 2 + position::4] = pearson7bg_derivative(x_fit, peak_parameters,
+                                                                       2 + position).transpose(0, 2, 1)
+        return derivatives * finite[:, :, None]
+
+    # Levenberg-Marquardt. With the smoothness, which only links consecutive diagrams, the normal matrix is block
+    # tridiagonal and its off diagonal blocks are diagonal: it is solved as a band matrix of nb_parameters bands.
+    data_residuals, smoothness_residuals = residuals(parameters)
+    current_cost = cost(data_residuals, smoothness_residuals)
+    damping = STACK_INITIAL_DAMPING
+    squared_weights = smoothness_weights ** 2
+    diagonal = numpy.arange(nb_parameters)
+    for _ in range(STACK_MAX_ITERATIONS):
+        derivatives = jacobian(parameters)
+        transposed = derivatives.transpose(0, 2, 1)
+        normal_blocks = transposed @ derivatives
+        gradient = (transposed @ data_residuals[:, :, None])[:, :, 0]
+        normal_blocks[:-1, diagonal, diagonal] += squared_weights
+        normal_blocks[1:, diagonal, diagonal] += squared_weights
+        gradient[:-1] -= smoothness_residuals * smoothness_weights
+        gradient[1:] += smoothness_residuals * smoothness_weights
+        while damping < STACK_MAX_DAMPING:
+            damped_blocks = normal_blocks.copy()
+            damped_blocks[:, diagonal, diagonal] *= 1. + damping
+            try:
+                step = solveh_banded(_block_tridiagonal_bands(damped_blocks, -squared_weights), -gradient.ravel())
+            except numpy.linalg.LinAlgError:
+                damping *= 10.
+                continue
+            new_parameters = numpy.maximum(parameters + step.reshape(parameters.shape), lower_bounds)
+            new_residuals = residuals(new_parameters)
+            new_cost = cost(*new_residuals)
+            if new_cost < current_cost:
+                break
+            damping *= 10.
+        else:
+            break
+        parameters = new_parameters
+        data_residuals, smoothness_residuals = new_residuals
+        damping = max(damping / 10., STACK_INITIAL_DAMPING * 1e-3)
+        converged = current_cost - new_cost <= STACK_TOLERANCE * current_cost
+        current_cost = new_cost
+        if converged:
+            break
+
+    diagrams_peaks = []
+    for diagram_parameters in parameters:
+        peaks = []
+        background = [diagram_parameters[0] - diagram_parameters[1] * x_middle, diagram_parameters[1]]
+        for peak_parameters in diagram_parameters[2:].reshape(nb_peaks, 4):
+            parameters = [float(value) for value in numpy.concatenate((background, peak_parameters))]
+            peak = int(numpy.clip(numpy.searchsorted(x, parameters[3]), 0, len(x) - 1))
+            x_peak = x[max(peak - PEAK_HALF_WIDTH, 0): min(peak + PEAK_HALF_WIDTH, len(x) - 1)]
+            peaks.append((x_peak, pearson7bg(x_peak, *parameters), parameters))
+        diagrams_peaks.append(peaks)
+    return diagrams_peaks
+
+
+def _block_tridiagonal_bands(diagonal_blocks: numpy.ndarray, off_diagonal: numpy.ndarray) -> numpy.ndarray:
+    """Upper bands, as expected by solveh_banded, of a symmetric block tridiagonal matrix whose diagonal blocks are
+    diagonal_blocks and whose off diagonal blocks are all the diagonal matrix of off_diagonal."""
+    nb_blocks, size, _ = diagonal_blocks.shape
+    bands = numpy.zeros((size + 1, nb_blocks * size))
+    for offset in range(size):
+        bands[size - offset].reshape(nb_blocks, size)[:, offset:] = \
+            diagonal_blocks[:, numpy.arange(size - offset), numpy.arange(offset, size)]
+    bands[0].reshape(nb_blocks, size)[1:] = off_diagonal
+    return bands
+
+
+def _stack_peaks(x: numpy.ndarray, peaks: numpy.ndarray) -> numpy.ndarray:
+    """Pearson7 peaks without background of (diagram, peak, amplitude center fwhm exposant) parameters, as
+    (diagram, peak, point) values."""
+    amplitude, center, fwhmlike, exposant = (peaks[:, :, position, None] for position in range(4))
+    return pearson7bg(x, 0., 0., amplitude, center, fwhmlike, exposant)
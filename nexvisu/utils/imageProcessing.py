@@ -1,15 +1,50 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context
 from scipy import ndimage
 
 from constants import DataPath, MetadataPath
 from h5py import File
 from PyQt5.QtWidgets import QMessageBox, QProgressBar, QApplication
+from utils.cacheFunctions import LRUCache
 from utils.nexusNavigation import get_dataset
 
 import numpy
 import os
 
+# Memory allowed to the 2θ/ψ maps kept for the already met (geometry, delta, gamma) positions
+ANGLES_CACHE_SIZE = 512 * 1024 ** 2
 
-def gen_flatfield(first_scan: int, last_scan: int, path: str, progress: QProgressBar, application: QApplication):
+# Number of frames read at once from a scan file when summing a flatfield
+FLATFIELD_CHUNK_SIZE = 64
+
+# Longest time the gui waits for a batch of flatfield scans before processing its events, in seconds
+FLATFIELD_POLL_INTERVAL = 0.05
+
+# Default number of frames processed at once by correct_and_unfold_stack
+UNFOLDING_CHUNK_SIZE = 16
+
+# Floating point type of the 2θ/ψ maps and of the corrected intensities
+UNFOLDING_DTYPE = numpy.float64
+# Floating point type of the unfolded images of the gui, which displays them and extracts their diagrams: float32 halves
+# their memory. A pixel closer to the edge of a 2θ bin than the float32 rounding of its 2θ may fall in the next bin,
+# which changes a few bins of a diagram (under 1 % of them) by up to 2 %, 3e-4 on average, under the counting noise.
+# The centers of the fitted peaks move by about 1e-6 degree (see check_unfolding_accuracy)
+DISPLAY_DTYPE = numpy.float32
+
+# Common 2θ grid of the patched diagrams, and number of points thrown at both ends of a diagram before patching it
+PATCH_TTH_MIN = 0.
+PATCH_TTH_MAX = 150.
+PATCH_TTH_STEP = 0.0105
+PATCH_POINTS_TO_THROW_BEGIN = 15
+PATCH_POINTS_TO_THROW_END = 15
+
+_angles_cache = LRUCache(ANGLES_CACHE_SIZE)
+
+
+def gen_flatfield(first_scan: int, last_scan: int, path: str, progress: QProgressBar = None,
+                  application: QApplication = None, workers: int = 1):
+    """Sum the images of the scans of the flatfield. Without application, the flatfield is computed headless:
+    the errors are printed instead of shown in message boxes."""
     flatfield = numpy.zeros((240, 560), dtype=numpy.int64)
     if os.path.basename(path).split('_')[-1].split('.')[-2] == "0001":
         extension = "_0001.nxs"
@@ -18,40 +53,117 @@ def gen_flatfield(first_scan: int, last_scan: int, path: str, progress: QProgres
     scan_name = os.path.basename(path).replace(extension, '').replace(str(first_scan), '').replace(str(last_scan), '')
     directory_path = os.path.dirname(path)
     completed = 0
-    progress.setVisible(True)
+    if progress is not None:
+        progress.setVisible(True)
+    if workers > 1:
+        filenames = [scan_name + f"{i + first_scan}" + extension for i in range(last_scan - first_scan + 1)]
+        return _gen_flatfield_parallel(flatfield, directory_path, filenames, progress, application, workers)
     for i in range(last_scan - first_scan + 1):
         filename = scan_name + f"{i + first_scan}" + extension
         try:
             with File(os.path.join(directory_path, filename), mode='r') as h5file:
-                for data in get_dataset(h5file, DataPath.IMAGE_INTERPRETATION.value):
-                    flatfield += data
+                _sum_images(get_dataset(h5file, DataPath.IMAGE_INTERPRETATION.value), flatfield)
             # Segment the progress bar according to number of scan
             completed += 100/(last_scan - first_scan + 1)
-            # Update the progress bar value
-            progress.setValue(completed)
-            # Update the gui and the progress bar
-            application.processEvents()
+            # Update the progress bar value and the gui
+            _update_progress(progress, application, completed)
         except ValueError:
-            QMessageBox(QMessageBox.Icon.Critical, "Failed",
-                        "You are running a flatfield on a different detector shape").exec()
+            _show_error(application, "You are running a flatfield on a different detector shape")
         except OSError:
-            if i > first_scan:
+            if i > 0:
                 # We need to update the progress bar even if we skip a scan
                 completed += 100 / (last_scan - first_scan + 1)
-                progress.setValue(completed)
-                application.processEvents()
+                _update_progress(progress, application, completed)
                 print(f"{filename} scan seems to not exist. It has been skipped in the flatfield computation")
             else:
-                QMessageBox(QMessageBox.Icon.Critical, "Failed", f"You selected {filename} file which does not "
-                                                                 f"exist in the {directory_path} location").exec()
+                _show_error(application, f"You selected {filename} file which does not exist in the "
+                                         f"{directory_path} location")
     if 99.0 < completed < 100:
         completed = 100.0
-        progress.setValue(completed)
-        application.processEvents()
+        _update_progress(progress, application, completed)
     return flatfield
 
 
-def compute_geometry(contextual_data: dict, flat_image: numpy.ndarray, images: numpy.ndarray):
+def _gen_flatfield_parallel(flatfield: numpy.ndarray, directory_path: str, filenames: list, progress: QProgressBar,
+                            application: QApplication, workers: int):
+    # Each process reduces a batch of consecutive scans to a partial sum, merged here as soon as it is done
+    batches = [list(batch) for batch in numpy.array_split(filenames, min(len(filenames), 4 * workers))]
+    missing_files = []
+    bad_shape_files = []
+    completed = 0
+    # Spawned processes do not inherit the hdf5 files and the Qt threads of the gui
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as executor:
+        futures = {executor.submit(sum_scan_files, [os.path.join(directory_path, filename) for filename in batch]):
+                   len(batch) for batch in batches}
+        pending = set(futures)
+        while pending:
+            # The gui keeps processing its events while the batches are summed
+            done, pending = wait(pending, timeout=FLATFIELD_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in done:
+                partial_sum, missing, bad_shape = future.result()
+                flatfield += partial_sum
+                missing_files += missing
+                bad_shape_files += bad_shape
+                completed += 100 * futures[future] / len(filenames)
+            _update_progress(progress, application, completed)
+    # The rounding of the segments may leave the progress bar just under 100
+    _update_progress(progress, application, 100)
+
+    if bad_shape_files:
+        _show_error(application, "You are running a flatfield on a different detector shape")
+    for filename in missing_files:
+        if os.path.basename(filename) == filenames[0]:
+            _show_error(application, f"You selected {filenames[0]} file which does not exist in the "
+                                     f"{directory_path} location")
+        else:
+            print(f"{os.path.basename(filename)} scan seems to not exist. "
+                  f"It has been skipped in the flatfield computation")
+    return flatfield
+
+
+def _update_progress(progress: QProgressBar, application: QApplication, completed: float) -> None:
+    if progress is not None:
+        progress.setValue(int(completed))
+    if application is not None:
+        application.processEvents()
+
+
+def _show_error(application: QApplication, message: str) -> None:
+    if application is None:
+        print(message)
+    else:
+        QMessageBox(QMessageBox.Icon.Critical, "Failed", message).exec()
+
+
+def sum_scan_files(paths: list, chunk_size: int = FLATFIELD_CHUNK_SIZE):
+    """Sum all the images of the given scan files, reading chunk_size frames at a time.
+    Return the sum, the files that could not be opened and the ones whose images do not have the detector shape."""
+    flatfield = numpy.zeros((240, 560), dtype=numpy.int64)
+    missing_files = []
+    bad_shape_files = []
+    for path in paths:
+        try:
+            with File(path, mode='r') as h5file:
+                _sum_images(get_dataset(h5file, DataPath.IMAGE_INTERPRETATION.value), flatfield, chunk_size)
+        except ValueError:
+            bad_shape_files.append(path)
+        except OSError:
+            missing_files.append(path)
+    return flatfield, missing_files, bad_shape_files
+
+
+def _sum_images(dataset, flatfield: numpy.ndarray, chunk_size: int = FLATFIELD_CHUNK_SIZE) -> None:
+    if dataset is None:
+        raise TypeError("The scan does not contain any image")
+    for start in range(0, dataset.shape[0], chunk_size):
+        flatfield += dataset[start: start + chunk_size].sum(axis=0, dtype=numpy.int64)
+
+
+def compute_geometry(contextual_data: dict, flat_image: numpy.ndarray, images: numpy.ndarray,
+                     dtype=UNFOLDING_DTYPE):
+    """Compute the tables unfolding the images of the detector. The unfolded arrays are of the given floating point
+    type."""
+    dtype = numpy.dtype(dtype)
     deg2rad = numpy.pi / 180
     inv_deg2rad = 1 / (numpy.pi / 180)
     calib = contextual_data["distance"][0]  # pixels in 1 deg.76.78
@@ -78,9 +190,10 @@ def compute_geometry(contextual_data: dict, flat_image: numpy.ndarray, images: n
         flat_image_inv = 1.0 / flat_image
         flat_image_inv[numpy.isnan(flat_image_inv)] = -10000000
         flat_image_inv[numpy.isinf(flat_image_inv)] = -10000000
+        flat_image_inv = flat_image_inv.astype(dtype)
         print("hello from flatimageinv computing")
     else:
-        flat_image_inv = numpy.ones_like(images[0], dtype=numpy.float32)
+        flat_image_inv = numpy.ones_like(images[0], dtype=dtype)
         factor_intensity_double_pixel = 2.3
 
     lines_to_remove = -3
@@ -136,7 +249,19 @@ def compute_geometry(contextual_data: dict, flat_image: numpy.ndarray, images: n
             new_y_array[new_y_index] = y
             new_y_array_module_id[new_y_index] = moduleIndex
 
+    # pixel coordinates of the corrected image, flattened column after column like the unfolded arrays
+    x_matrix = numpy.repeat(numpy.arange(image_corr1_size_x, dtype=dtype), image_corr1_size_y)
+    y_matrix = numpy.tile(numpy.arange(image_corr1_size_y, dtype=dtype), image_corr1_size_x)
+
+    # gather tables mapping the raw image onto the corrected (double pixels) image
+    remap = _build_intensity_remap(images.shape[2], new_x_array, new_x_ifactor_array, new_y_array,
+                                   between_chips, chip_size_y, factor_intensity_double_pixel)
+
     geometry = {
+        # identifies the 2θ/ψ maps of this geometry in the angles cache
+        "key": (distance, x_center_detector, y_center_detector, delta_position, gamma_position,
+                image_corr1_size_x, image_corr1_size_y, dtype.str),
+        "dtype": dtype,
         "deg2rad": deg2rad,
         "inv_deg2rad": inv_deg2rad,
         "distance": distance,
@@ -153,40 +278,231 @@ def compute_geometry(contextual_data: dict, flat_image: numpy.ndarray, images: n
         "new_x_array": new_x_array,
         "new_x_ifactor_array": new_x_ifactor_array,
         "flat_image_inv": flat_image_inv,
-        "between_chips": between_chips
+        "between_chips": between_chips,
+        "x_matrix": x_matrix,
+        "y_matrix": y_matrix,
+        "remap_index": remap[0],
+        "remap_weights": remap[1].astype(dtype),
+        "remap_extra_target": remap[2],
+        "remap_extra_index": remap[3],
+        "remap_extra_weights": remap[4].astype(dtype)
     }
 
     return geometry
 
 
+def _build_intensity_remap(raw_size_x: int, new_x_array: numpy.ndarray, new_x_ifactor_array: numpy.ndarray,
+                           new_y_array: numpy.ndarray, between_chips: list, chip_size_y: int,
+                           factor_intensity_double_pixel: float):
+    """Express the double pixels correction as gather tables on the flattened raw image.
+
+    Each pixel of the corrected image is a weighted sum of at most four raw pixels. The first contribution of every
+    pixel is given by (remap_index, remap_weights), already ordered like the unfolded arrays (column after column).
+    The few remaining contributions, coming from the averaged columns and lines between chips and modules, are listed
+    in (extra_target, extra_index, extra_weights)."""
+    size_x = new_x_array.shape[0]
+    size_y = new_y_array.shape[0]
+
+    # (raw column, weight) contributions of each corrected column
+    columns = []
+    for x in range(size_x):
+        weight = 1.0 / factor_intensity_double_pixel if -1 <= new_x_ifactor_array[x] < 0 else 1.0
+        columns.append([(int(new_x_array[x]), weight)])
+    for x in between_chips:
+        if new_x_ifactor_array[x] == -10:
+            # correct the double lines (last and 1st line of the modules, at their junction)
+            columns[x] = [(source, weight / 2.0) for source, weight in columns[x - 1] + columns[x + 1]]
+
+    # (raw line, weight) contributions of each corrected line
+    lines = [[(int(new_y_array[y]), 1.0)] for y in range(size_y)]
+    # last line of module1 = 119, is the 1st line to correct
+    line_index1 = chip_size_y - 1
+    last_line = [(source, weight / factor_intensity_double_pixel) for source, weight in lines[line_index1]]
+    first_line = [(source, weight / factor_intensity_double_pixel) for source, weight in lines[line_index1 + 4]]
+    # Last two lines of the first module and two first lines of the second module
+    lines[line_index1] = lines[line_index1 + 1] = last_line
+    lines[line_index1 + 3] = lines[line_index1 + 4] = first_line
+    # Line between the two modules (0.5 + 0.5 pixels)
+    lines[line_index1 + 2] = [(source, weight / 2.0) for source, weight in last_line + first_line]
+
+    column_sources = numpy.zeros((2, size_x), dtype=numpy.int64)
+    column_weights = numpy.zeros((2, size_x))
+    for x, contributions in enumerate(columns):
+        for k, (source, weight) in enumerate(contributions):
+            column_sources[k, x] = source
+            column_weights[k, x] = weight
+    line_sources = numpy.zeros((2, size_y), dtype=numpy.int64)
+    line_weights = numpy.zeros((2, size_y))
+    for y, contributions in enumerate(lines):
+        for k, (source, weight) in enumerate(contributions):
+            line_sources[k, y] = source
+            line_weights[k, y] = weight
+
+    # index of each contribution in the flattened raw image and in the flattened corrected image (column major)
+    sources = line_sources[None, :, None, :] * raw_size_x + column_sources[:, None, :, None]
+    weights = column_weights[:, None, :, None] * line_weights[None, :, None, :]
+    sources = sources.reshape(4, size_x * size_y)
+    weights = weights.reshape(4, size_x * size_y)
+    targets = numpy.broadcast_to(numpy.arange(size_x * size_y), (3, size_x * size_y))
+
+    extra = weights[1:] != 0
+    return sources[0], weights[0], targets[extra], sources[1:][extra], weights[1:][extra]
+
+
 def correct_and_unfold_data(geometry: dict, image: numpy.ndarray, delta: float, gamma: float, median_filter_flag=False):
+    # The angles only depend on the detector position, they are shared by all the frames recorded at that position
+    two_th_array, psi_array = compute_angles(geometry, delta, gamma)
+
+    intensity_array = _correct_intensities(geometry, image[numpy.newaxis], median_filter_flag)[0]
+    return two_th_array, psi_array, intensity_array
+
+
+def correct_and_unfold_stack(geometry: dict, images, delta_array, gamma_array, median_filter_flag=False,
+                             chunk_size: int = UNFOLDING_CHUNK_SIZE):
+    """Correct and unfold a whole (N, y, x) stack of images, chunk_size frames at a time.
+
+    delta_array and gamma_array hold one angle per image, or a single one for a static motor.
+    Return the (N, M) 2θ, ψ and intensity arrays, line i being what correct_and_unfold_data gives for image i."""
+    nb_images = images.shape[0]
+    delta_array, gamma_array = _broadcast_positions(delta_array, gamma_array, nb_images)
+    size = geometry["image_corr1_size_x"] * geometry["image_corr1_size_y"]
+    two_th_stack = numpy.empty((nb_images, size), dtype=geometry["dtype"])
+    psi_stack = numpy.empty((nb_images, size), dtype=geometry["dtype"])
+    intensity_stack = numpy.empty((nb_images, size), dtype=geometry["dtype"])
+    for start in range(0, nb_images, chunk_size):
+        stop = min(start + chunk_size, nb_images)
+        # The maps are computed once for each different position of the chunk
+        positions, inverse = numpy.unique(numpy.column_stack((delta_array[start:stop], gamma_array[start:stop])),
+                                          axis=0, return_inverse=True)
+        maps = _get_position_angles(geometry, positions[:, 0], positions[:, 1])
+        two_th_maps = numpy.stack([angles[0] for angles in maps])
+        psi_maps = numpy.stack([angles[1] for angles in maps])
+        numpy.take(two_th_maps, inverse.reshape(-1), axis=0, out=two_th_stack[start:stop])
+        numpy.take(psi_maps, inverse.reshape(-1), axis=0, out=psi_stack[start:stop])
+        intensity_stack[start:stop] = _correct_intensities(geometry, images[start:stop], median_filter_flag)
+    return two_th_stack, psi_stack, intensity_stack
+
+
+def correct_and_unfold_images(geometry: dict, images, delta_array, gamma_array, median_filter_flag=False,
+                              chunk_size: int = UNFOLDING_CHUNK_SIZE) -> (list, dict, numpy.ndarray):
+    """Correct and unfold a (N, y, x) stack of images like correct_and_unfold_stack, without repeating the 2θ and ψ
+    maps of the images recorded at the same position.
+
+    Return the (delta, gamma) key of each image, the read-only (2θ, ψ) maps of each key, shared with the angles cache,
+    and the (N, M) intensities. See UnfoldedStack."""
+    nb_images = images.shape[0]
+    delta_array, gamma_array = _broadcast_positions(delta_array, gamma_array, nb_images)
+    keys = list(zip(delta_array.tolist(), gamma_array.tolist()))
+    size = geometry["image_corr1_size_x"] * geometry["image_corr1_size_y"]
+    angle_maps = {}
+    intensity_stack = numpy.empty((nb_images, size), dtype=geometry["dtype"])
+    for start in range(0, nb_images, chunk_size):
+        stop = min(start + chunk_size, nb_images)
+        # The maps of a chunk are computed at once, chunk by chunk to bound the memory of the computation
+        positions = [key for key in dict.fromkeys(keys[start:stop]) if key not in angle_maps]
+        if positions:
+            deltas, gammas = numpy.array(positions).T
+            angle_maps.update(zip(positions, _get_position_angles(geometry, deltas, gammas)))
+        intensity_stack[start:stop] = _correct_intensities(geometry, images[start:stop], median_filter_flag)
+    return keys, angle_maps, intensity_stack
+
+
+def _broadcast_positions(delta_array, gamma_array, nb_images: int) -> (numpy.ndarray, numpy.ndarray):
+    # One angle per image, or a single one for a static motor
+    delta_array = numpy.broadcast_to(numpy.asarray(delta_array, dtype=numpy.float64).reshape(-1), (nb_images,))
+    gamma_array = numpy.broadcast_to(numpy.asarray(gamma_array, dtype=numpy.float64).reshape(-1), (nb_images,))
+    return delta_array, gamma_array
+
+
+def check_unfolding_accuracy(contextual_data: dict, flat_image: numpy.ndarray, images, delta_array, gamma_array,
+                             dtype=DISPLAY_DTYPE, psi1: float = -100, psi2: float = 100) -> dict:
+    """Unfold the images in dtype and in float64, and return the largest differences between both: on 2θ and ψ in
+    degrees, on the intensities and on the bins of the diagrams of the [psi1, psi2] sector relatively to the float64
+    ones. diagram_mean is the average relative difference of the bins of the diagrams."""
+    unfolded = []
+    diagrams = []
+    for unfolding_dtype in (dtype, numpy.float64):
+        geometry = compute_geometry(contextual_data, flat_image, images, unfolding_dtype)
+        unfolded.append(correct_and_unfold_stack(geometry, images, delta_array, gamma_array))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            diagrams.append(extract_diffraction_diagrams(zip(*unfolded[-1]), 1.0 / geometry["calib"], psi1, psi2)[1])
+    (two_th_array, psi_array, intensity_array), (two_th_reference, psi_reference, intensity_reference) = unfolded
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        diagram_difference = numpy.abs(diagrams[0] - diagrams[1]) / numpy.abs(diagrams[1])
+        return {"two_theta": float(numpy.nanmax(numpy.abs(two_th_array - two_th_reference))),
+                "psi": float(numpy.nanmax(numpy.abs(psi_array - psi_reference))),
+                "intensity": float(numpy.nanmax(numpy.abs(intensity_array - intensity_reference) /
+                                                numpy.abs(intensity_reference))),
+                "diagram": float(numpy.nanmax(diagram_difference)),
+                "diagram_mean": float(numpy.nanmean(diagram_difference))}
+
+
+def _correct_intensities(geometry: dict, images: numpy.ndarray, median_filter_flag=False) -> numpy.ndarray:
+    # dealing now with the intensities, the integer counts would otherwise be promoted to float64
+    these_images = numpy.multiply(geometry["flat_image_inv"], images, dtype=geometry["dtype"])
+    if median_filter_flag:
+        these_images = ndimage.median_filter(these_images, size=(1, 3, 3))
+    these_images = these_images.reshape(these_images.shape[0], -1)
+
+    # corrected intensity of each pixel, on the image having the new size, ordered like the angles
+    intensities = these_images[:, geometry["remap_index"]] * geometry["remap_weights"]
+    numpy.add.at(intensities, (slice(None), geometry["remap_extra_target"]),
+                 these_images[:, geometry["remap_extra_index"]] * geometry["remap_extra_weights"])
+    return intensities
+
+
+def compute_angles(geometry: dict, delta: float, gamma: float) -> (numpy.ndarray, numpy.ndarray):
+    """Return the 2θ and ψ maps of the detector at the (delta, gamma) position, from the cache when possible.
+    The returned arrays are shared between calls and thus read-only."""
+    key = (geometry["key"], float(delta), float(gamma))
+    angles = _angles_cache.get(key)
+    if angles is None:
+        angles = _unfold_angles(geometry, delta, gamma)
+        for array in angles:
+            array.setflags(write=False)
+        _angles_cache.put(key, angles)
+    return angles
+
+
+def clear_angles_cache() -> None:
+    _angles_cache.clear()
+
+
+def _get_position_angles(geometry: dict, deltas: numpy.ndarray, gammas: numpy.ndarray) -> list:
+    # Take the already known positions from the cache, and compute all the others at once
+    keys = [(geometry["key"], delta, gamma) for delta, gamma in zip(deltas.tolist(), gammas.tolist())]
+    maps = [_angles_cache.get(key) for key in keys]
+    missing = [index for index, angles in enumerate(maps) if angles is None]
+    if missing:
+        two_th_maps, psi_maps = _unfold_angles(geometry, deltas[missing, numpy.newaxis], gammas[missing, numpy.newaxis])
+        for index, two_th_array, psi_array in zip(missing, two_th_maps, psi_maps):
+            angles = (two_th_array.copy(), psi_array.copy())
+            for array in angles:
+                array.setflags(write=False)
+            _angles_cache.put(keys[index], angles)
+            maps[index] = angles
+    return maps
+
+
+def _unfold_angles(geometry: dict, delta, gamma) -> (numpy.ndarray, numpy.ndarray):
+    # delta and gamma may also be (n, 1) arrays, giving (n, M) maps
     # extracting the XY coordinates for the rest of the scan transformation
     # ========psiAve = 1, deltaPsi = 1=============================================
 
+    # The rotations are computed in float64, the maps in the type of the geometry: float64 scalars would promote them
+    dtype = geometry["dtype"]
+    delta = numpy.asarray(delta, dtype=numpy.float64)
+    gamma = numpy.asarray(gamma, dtype=numpy.float64)
     diffracto_delta_rad = (delta + geometry["delta_position"]) * geometry["deg2rad"]
-    sindelta = numpy.sin(diffracto_delta_rad)
-    cosdelta = numpy.cos(diffracto_delta_rad)
+    sindelta = numpy.sin(diffracto_delta_rad).astype(dtype)
+    cosdelta = numpy.cos(diffracto_delta_rad).astype(dtype)
     diffracto_gam_rad = (gamma + geometry["gamma_position"]) * geometry["deg2rad"]
-    singamma = numpy.sin(diffracto_gam_rad)
-    cosgamma = numpy.cos(diffracto_gam_rad)
-
-    # the array this_corrected_image contains the corrected image (double pixels corrections)
-    # two_th_array = numpy.zeros((image_corr1_size_y, image_corr1_size_x))
-    # psi_array = numpy.zeros((image_corr1_size_y, image_corr1_size_x))
-
-    x_line = numpy.linspace(0, geometry["image_corr1_size_x"] - 1, geometry["image_corr1_size_x"])
-    x_matrix = numpy.zeros((geometry["image_corr1_size_x"],  geometry["image_corr1_size_y"]))
-    for a in range(geometry["image_corr1_size_y"]):
-        x_matrix[:, a] = x_line[:]
-
-    y_line = numpy.linspace(0, geometry["image_corr1_size_y"] - 1, geometry["image_corr1_size_y"])
-    y_matrix = numpy.zeros((geometry["image_corr1_size_x"],  geometry["image_corr1_size_y"]))
-    for a in range(geometry["image_corr1_size_x"]):
-        y_matrix[a, :] = y_line[:]
-
-    corr_array_x = geometry["distance"]  # for xpad3.2 like
-    corr_array_z = geometry["y_center_detector"] - y_matrix  # for xpad3.2 like
-    corr_array_y = geometry["x_center_detector"] - x_matrix  # sign is reversed
+    singamma = numpy.sin(diffracto_gam_rad).astype(dtype)
+    cosgamma = numpy.cos(diffracto_gam_rad).astype(dtype)
+
+    corr_array_x = dtype.type(geometry["distance"])  # for xpad3.2 like
+    corr_array_z = dtype.type(geometry["y_center_detector"]) - geometry["y_matrix"]  # for xpad3.2 like
+    corr_array_y = dtype.type(geometry["x_center_detector"]) - geometry["x_matrix"]  # sign is reversed
     temp_x = corr_array_x
     temp_y = corr_array_z * (-1.0)
     temp_z = corr_array_y
@@ -199,164 +515,189 @@ def correct_and_unfold_data(geometry: dict, image: numpy.ndarray, delta: float,
     corr_array_x = x1 * cosgamma + y1 * singamma
     corr_array_y = -x1 * singamma + y1 * cosgamma
     corr_array_z = z1
-    # calculate the square values and normalization
-    corr_array_x2 = corr_array_x * corr_array_x
-    corr_array_y2 = corr_array_y * corr_array_y
-    corr_array_z2 = corr_array_z * corr_array_z
-    norm = numpy.sqrt(corr_array_x2 + corr_array_y2 + corr_array_z2)
-    # calculate the corresponding angles
+    # calculate the corresponding angles, with arctan2 rather than the arccos of the normalized vector: arccos loses
+    # its precision close to 0 and 180 degrees, by 0.02 degree around the direct beam in float32
     # delta = angle between vector(corr_array_x, corr_array_y, corr_array_z) and the vector(1,0,0)
-    this_delta = numpy.arccos(corr_array_x / norm) * geometry["inv_deg2rad"]
+    this_delta = numpy.arctan2(numpy.hypot(corr_array_y, corr_array_z), corr_array_x)
+    this_delta *= dtype.type(geometry["inv_deg2rad"])
 
     # psi = angle between vector(0, corr_array_y, corr_array_z) and the vector(0,1,0)
     sign = numpy.sign(corr_array_z)
-    cos_psi_rad = corr_array_y / numpy.sqrt(corr_array_y2 + corr_array_z2)
-    psi = numpy.arccos(cos_psi_rad) * geometry["inv_deg2rad"] * sign
+    psi = numpy.arctan2(numpy.abs(corr_array_z), corr_array_y) * dtype.type(geometry["inv_deg2rad"]) * sign
 
     psi[psi < 0] += 360
     psi -= 90
-    psi_array = psi.T
-    two_th_array = this_delta.T
+    return this_delta, psi
 
-    # ======================end geometry====================================
 
-    # dealing now with the intensitiespointIndex
-    this_image = geometry["flat_image_inv"] * image
-    if median_filter_flag:
-        this_image = ndimage.median_filter(this_image, size=3)
-
-    this_corrected_image = numpy.zeros((geometry["image_corr1_size_y"], geometry["image_corr1_size_x"]))
-    intensity_factor = geometry["new_x_ifactor_array"]  # x
-    new_y_array = geometry["new_y_array"].astype('int')
-    new_x_array = geometry["new_x_array"].astype('int')
-
-    for x in range(0, geometry["image_corr1_size_x"]):
-        this_corrected_image[:, x] = this_image[new_y_array[:], new_x_array[x]]
-        if -1 <= intensity_factor[x] < 0:
-            this_corrected_image[:, x] = this_image[new_y_array[:], new_x_array[x]] / geometry["factor_intensity_double_pixel"]
-    for x in geometry["between_chips"]:
-        if intensity_factor[x] == -10:
-            # correct the double lines (last and 1st line of the modules, at their junction)
-            this_corrected_image[:, x] = (this_corrected_image[:, x-1]
-                                          + this_corrected_image[:, x+1]) / 2.0
+def extract_diffraction_diagram(two_th_array, psi_array, intensity_array, step_two_th, psi1, psi2, patch_data_flag=True):
+    two_th_result, intensity_result = _integrate_diagram(two_th_array, psi_array, intensity_array, step_two_th,
+                                                         psi1, psi2)
+    if patch_data_flag:
+        two_th_result, intensity_result = patch_data(two_th_result, intensity_result)
 
-    # last line of module1 = 119, is the 1st line to correct
-    line_index1 = geometry["chip_size_y"] - 1
+    return two_th_result[1: -1], intensity_result[1: -1]
 
-    # Last two lines of the first module
-    this_corrected_image[line_index1: line_index1 + 2, :] = [this_corrected_image[line_index1, :] / geometry["factor_intensity_double_pixel"]] * 2
-    # Two first lines of the second module
-    this_corrected_image[line_index1 + 3: line_index1 + 5, :] = [this_corrected_image[line_index1 + 4, :] / geometry["factor_intensity_double_pixel"]] * 2
-    # Line between the two modules (0.5 + 0.5 pixels)
-    this_corrected_image[line_index1 + 2, :] = (this_corrected_image[line_index1, :] + this_corrected_image[line_index1 + 4, :]) / 2.0
-
-    # this is the corrected intensity of each pixel, on the image having the new size
-    """
-    tth = []
-    psi = []
-    corrected = []
-    for x in range(0, geometry["image_corr1_size_x"]):
-        for y in range(0, geometry["image_corr1_size_y"]):
-            tth.append(two_th_array[y, x])
-            psi.append(psi_array[y, x])
-            corrected.append(this_corrected_image[y, x])
-    """
-    intensity_array = this_corrected_image.T.reshape(geometry["image_corr1_size_x"] * geometry["image_corr1_size_y"])
-    psi_array = psi_array.T.reshape(geometry["image_corr1_size_x"] * geometry["image_corr1_size_y"])
-    two_th_array = two_th_array.T.reshape(geometry["image_corr1_size_x"] * geometry["image_corr1_size_y"])
-    return two_th_array, psi_array, intensity_array
 
+def extract_diffraction_diagrams(images, step_two_th, psi1, psi2) -> (numpy.ndarray, numpy.ndarray):
+    """Extract the patched diagrams of a stack of unfolded (two theta, psi, intensity) images.
+    Return the common 2θ grid and the (N, npoints) matrix of the diagrams, NaN where a diagram has no data."""
+    two_th_array, intensity_matrix = patch_data_stack([_integrate_diagram(*image, step_two_th, psi1, psi2)
+                                                       for image in images])
+    return two_th_array[1: -1], intensity_matrix[:, 1: -1]
 
-def extract_diffraction_diagram(two_th_array, psi_array, intensity_array, step_two_th, psi1, psi2, patch_data_flag=True):
-    mask_psi = numpy.ones(psi_array.shape)
-    mask_psi[psi_array < psi1] = 0.0
-    mask_psi[psi_array > psi2] = 0.0
 
+def _integrate_diagram(two_th_array, psi_array, intensity_array, step_two_th, psi1, psi2):
     two_th_min = two_th_array.min()
     two_th_max = two_th_array.max()
 
     nb_of_bins = int((0.0 + two_th_max - two_th_min) / step_two_th) + 1
 
     two_th_result = numpy.zeros(nb_of_bins + 1)  # generate the tables for radial integration, this is delta
-
-    for ii in range(0, nb_of_bins):
-        two_th_temp1 = two_th_min + ii * step_two_th
-        two_th_temp2 = two_th_temp1 + step_two_th
-        two_th_result[ii] = 0.5 * (two_th_temp1 + two_th_temp2)
-
-    this_bin_array = numpy.floor((two_th_array * mask_psi - two_th_min) / step_two_th)
-    this_bin_array = this_bin_array.astype('int')
-
-    intensity_result = numpy.zeros(nb_of_bins + 1)  # this will be the summed intensity
-    intensity_array = intensity_array * mask_psi
-
-    indexes_ = numpy.nonzero(intensity_array > 0)[0]
-    my_bin = this_bin_array[indexes_]
-
-    my_intensity = intensity_array[indexes_]
-    aggregated = numpy.zeros(nb_of_bins + 1)
-    for i in range(my_bin.max() + 1):
-        selected_intensities = my_intensity[my_bin == i]
-        intensity_result[i] = selected_intensities.mean()
-
-    intensity_result[numpy.isnan(intensity_result)] = -1
-
-    if patch_data_flag:
-        two_th_result, intensity_result = patch_data(two_th_result, intensity_result)
-
-    return two_th_result[1: -1], intensity_result[1: -1]
+    two_th_temp1 = two_th_min + numpy.arange(nb_of_bins) * step_two_th
+    two_th_temp2 = two_th_temp1 + step_two_th
+    two_th_result[:nb_of_bins] = 0.5 * (two_th_temp1 + two_th_temp2)
+
+    # only the pixels of the psi sector having a positive intensity are integrated
+    selection = intensity_array > 0
+    selection &= ~(psi_array < psi1)
+    selection &= ~(psi_array > psi2)
+    sums, counts = integrate_two_theta(two_th_array, intensity_array, two_th_min, step_two_th, nb_of_bins + 1,
+                                       selection)
+
+    # mean intensity of each bin up to the last filled one, the empty ones are flagged with -1
+    intensity_result = numpy.zeros(nb_of_bins + 1)
+    filled = numpy.nonzero(counts)[0]
+    last_bin = filled[-1] + 1 if filled.size > 0 else 0
+    intensity_result[:last_bin] = -1
+    intensity_result[filled] = sums[filled] / counts[filled]
+    return two_th_result, intensity_result
+
+
+def integrate_two_theta(two_th_array, intensity_array, two_th_min, step_two_th, nb_of_bins, selection=None,
+                        squares_flag=False):
+    """Histogram the intensities on regular 2θ bins starting at two_th_min, in a single pass over the pixels.
+
+    selection is an optional boolean mask of the pixels to integrate. Return the summed intensity and the number
+    of pixels of each bin, plus the summed squared intensity if squares_flag is set (for error bars)."""
+    if selection is not None:
+        two_th_array = two_th_array[selection]
+        intensity_array = intensity_array[selection]
+    bins = numpy.floor((two_th_array - two_th_min) / step_two_th).astype('int')
+    # pixels outside of the requested range are dropped
+    inside = (bins >= 0) & (bins < nb_of_bins)
+    if not inside.all():
+        bins = bins[inside]
+        intensity_array = intensity_array[inside]
+    sums = numpy.bincount(bins, weights=intensity_array, minlength=nb_of_bins)
+    counts = numpy.bincount(bins, minlength=nb_of_bins)
+    if squares_flag:
+        squares = numpy.bincount(bins, weights=intensity_array * intensity_array, minlength=nb_of_bins)
+        return sums, counts, squares
+    return sums, counts
 
 
 def patch_data(tth_data_array, intensity_data_array):
-    nb_points2throw_begin = 15
-    nb_points2throw_end = 15
-    tth1 = 0.
-    tth2 = 150.
-    tth_step = 0.0105
-    npoints = int(round((tth2 - tth1) / tth_step)) + 1
-    tth_array = numpy.linspace(tth1, tth2, npoints)
-    intensity_array = numpy.zeros(npoints)
-    n_intensity_array = numpy.zeros(npoints)
-    for uu in range(nb_points2throw_begin, tth_data_array.shape[0] - nb_points2throw_end):
-        tth_index = int(round((tth_data_array[uu] - tth1) / tth_step))
-        if intensity_data_array[uu] > 0:
-            intensity_array[tth_index] += intensity_data_array[uu]
-            n_intensity_array[tth_index] += 1.
-    intensity_array = intensity_array / n_intensity_array
-    return tth_array, intensity_array
+    tth_array, intensity_matrix = patch_data_stack([(tth_data_array, intensity_data_array)])
+    return tth_array, intensity_matrix[0]
+
+
+def patch_data_stack(diagrams: list) -> (numpy.ndarray, numpy.ndarray):
+    """Rebin a list of (2θ, intensity) diagrams, of any lengths, on the common 2θ grid in a single weighted bincount.
+    Each cell holds the mean of the positive intensities rounded to it, NaN if there is none.
+    Return the grid and the (N, npoints) matrix of the diagrams."""
+    npoints = int(round((PATCH_TTH_MAX - PATCH_TTH_MIN) / PATCH_TTH_STEP)) + 1
+    tth_array = numpy.linspace(PATCH_TTH_MIN, PATCH_TTH_MAX, npoints)
+    trimmed_tth = []
+    trimmed_intensity = []
+    frames = []
+    for frame, (tth_data_array, intensity_data_array) in enumerate(diagrams):
+        stop = max(len(tth_data_array) - PATCH_POINTS_TO_THROW_END, 0)
+        trimmed_tth.append(numpy.asarray(tth_data_array)[PATCH_POINTS_TO_THROW_BEGIN: stop])
+        trimmed_intensity.append(numpy.asarray(intensity_data_array)[PATCH_POINTS_TO_THROW_BEGIN: stop])
+        frames.append(numpy.full(len(trimmed_tth[-1]), frame, dtype=numpy.intp))
+    if not diagrams:
+        return tth_array, numpy.zeros((0, npoints))
+    tth_data = numpy.concatenate(trimmed_tth)
+    intensity_data = numpy.concatenate(trimmed_intensity)
+    frames = numpy.concatenate(frames)
+
+    tth_index = numpy.rint((tth_data - PATCH_TTH_MIN) / PATCH_TTH_STEP)
+    # points out of the grid are dropped
+    kept = (intensity_data > 0) & (tth_index >= 0) & (tth_index < npoints)
+    cells = frames[kept] * npoints + tth_index[kept].astype(numpy.intp)
+    size = len(diagrams) * npoints
+    sums = numpy.bincount(cells, weights=intensity_data[kept], minlength=size)
+    counts = numpy.bincount(cells, minlength=size)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        intensity_matrix = (sums / counts).reshape(len(diagrams), npoints)
+    return tth_array, intensity_matrix
+
+
+def rasterize_scatter(x_array: numpy.ndarray, y_array: numpy.ndarray, values: numpy.ndarray, x_range: tuple,
+                      y_range: tuple, shape: tuple) -> numpy.ndarray:
+    """Rasterise scattered points on a (rows, columns) image covering x_range and y_range, rows along y.
+    Each pixel holds the mean of the finite values of the points falling in it, NaN if there is none."""
+    rows, columns = shape
+    x_array = numpy.asarray(x_array)
+    y_array = numpy.asarray(y_array)
+    values = numpy.asarray(values)
+    column_index = numpy.floor((x_array - x_range[0]) * (columns / (x_range[1] - x_range[0])))
+    row_index = numpy.floor((y_array - y_range[0]) * (rows / (y_range[1] - y_range[0])))
+    # points out of the image are dropped
+    kept = (column_index >= 0) & (column_index < columns) & (row_index >= 0) & (row_index < rows) \
+        & numpy.isfinite(values)
+    pixels = row_index[kept].astype(numpy.intp) * columns + column_index[kept].astype(numpy.intp)
+    sums = numpy.bincount(pixels, weights=values[kept], minlength=rows * columns)
+    counts = numpy.bincount(pixels, minlength=rows * columns)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return (sums / counts).reshape(rows, columns)
 
 
 def get_angles(path: str) -> (numpy.ndarray, numpy.ndarray):
     with File(path, mode='r') as h5file:
-        # Collecting delta and gamma arrays
-        delta_array = None
-        gamma_array = None
-        for delta_path, gamma_path in zip(DataPath.Delta.value, DataPath.Gamma.value):
+        return read_angles(h5file)
+
+
+def read_angles(h5file: File) -> (numpy.ndarray, numpy.ndarray):
+    """return the delta and gamma arrays of an open scan file."""
+    # Collecting delta and gamma arrays
+    delta_array = None
+    gamma_array = None
+    for delta_path, gamma_path in zip(DataPath.Delta.value, DataPath.Gamma.value):
+        try:
+            if delta_array is None:
+                delta_array = _read_angle(h5file, delta_path.value)
+            if gamma_array is None:
+                gamma_array = _read_angle(h5file, gamma_path.value)
+        # This exception let the loop continue if one path is incorrect, and let the loop try unpacking data
+        except (AttributeError, TypeError):
+            pass
+
+    # If the delta array is empty, it means that delta is in static mode, so we search delta in metadata
+    if delta_array is None:
+        for delta_path in MetadataPath.Delta.value:
             try:
                 if delta_array is None:
-                    # We copy the data because we will use them after closing the file
-                    delta_array = get_dataset(h5file, delta_path.value)[:]
-                if gamma_array is None:
-                    gamma_array = get_dataset(h5file, gamma_path.value)[:]
-            # This exception let the loop continue if one path is incorrect, and let the loop try unpacking data
+                    delta_array = _read_angle(h5file, delta_path.value)
             except (AttributeError, TypeError):
                 pass
 
-        # If the delta array is empty, it means that delta is in static mode, so we search delta in metadata
-        if delta_array is None:
-            for delta_path in MetadataPath.Delta.value:
-                try:
-                    if delta_array is None:
-                        delta_array = get_dataset(h5file, delta_path.value)[:]
-                except (AttributeError, TypeError):
-                    pass
-
-        # If the gamma array is empty, it means that gamma is in static mode, so we search gamma in the metadata
-        if gamma_array is None:
-            for gamma_path in MetadataPath.Gamma.value:
-                try:
-                    if gamma_array is None:
-                        gamma_array = get_dataset(h5file, gamma_path.value)[:]
-                except (AttributeError, TypeError):
-                    pass
+    # If the gamma array is empty, it means that gamma is in static mode, so we search gamma in the metadata
+    if gamma_array is None:
+        for gamma_path in MetadataPath.Gamma.value:
+            try:
+                if gamma_array is None:
+                    gamma_array = _read_angle(h5file, gamma_path.value)
+            except (AttributeError, TypeError):
+                pass
     return delta_array, gamma_array
+
+
+def _read_angle(h5file: File, path: str) -> numpy.ndarray:
+    dataset = get_dataset(h5file, path)
+    # A file read in SWMR mode only shows the values written before the last refresh
+    if h5file.swmr_mode:
+        dataset.refresh()
+    # We copy the data because we will use them after closing the file
+    return dataset[:]
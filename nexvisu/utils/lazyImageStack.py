@@ -0,0 +1,333 @@
+from collections import OrderedDict
+from h5py import File
+from silx.io.utils import H5Type
+
+from constants import DataPath
+from utils.imageProcessing import read_angles
+from utils.nexusNavigation import get_dataset
+
+import json
+import numbers
+import numpy
+import os
+import threading
+import time
+
+# Number of frames kept in memory by a lazy stack
+FRAME_CACHE_SIZE = 64
+# Number of frames read at once when a frame is not in memory yet
+READ_AHEAD = 8
+# Attempts to open again a file being written, and the delay between them in seconds
+REOPEN_ATTEMPTS = 5
+REOPEN_DELAY = 0.05
+# Uncompressed copy of the frames of a scan, and its header, saved next to the scan
+SIDECAR_FRAMES_SUFFIX = ".frames.npy"
+SIDECAR_HEADER_SUFFIX = ".frames.json"
+# Number of frames copied at once in the sidecar
+SIDECAR_BLOCK_SIZE = 64
+
+
+class LazyImageStack:
+    """Stack of the images of a scan, read on demand from the image dataset of the scan file.
+
+    The file stays open until close is called. Recently read frames are kept in a small LRU cache and a missing frame
+    is read along with the next ones. Slices are read straight from the file. Like a h5py dataset, the stack can be
+    given to silx StackView, which then only reads the displayed frames.
+
+    A scan still being written is followed with refresh: a file written in SWMR mode is read in SWMR mode, any other
+    file is closed and opened again when it changed on the disk."""
+    # Tells silx to handle the stack as a dataset
+    h5_class = H5Type.DATASET
+
+    def __init__(self, path: str, cache_size: int = FRAME_CACHE_SIZE, read_ahead: int = READ_AHEAD):
+        self.path = path
+        self.cache_size = cache_size
+        self.read_ahead = read_ahead
+        self.h5file, self.dataset = self._open()
+        self._file_version = get_file_version(path)
+        self._frames = OrderedDict()
+        # The unfolding reads frames from worker threads
+        self._lock = threading.Lock()
+
+    @property
+    def shape(self) -> tuple:
+        # refresh may swap the dataset from another thread
+        with self._lock:
+            return self.dataset.shape
+
+    @property
+    def dtype(self) -> numpy.dtype:
+        with self._lock:
+            return self.dataset.dtype
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def size(self) -> int:
+        return int(numpy.prod(self.shape))
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __array__(self, dtype=None, copy=None):
+        with self._lock:
+            return numpy.asarray(self.dataset[()], dtype=dtype)
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple) and len(item) > 0 and isinstance(item[0], numbers.Integral):
+            return self.get_frame(item[0])[item[1:]]
+        if isinstance(item, numbers.Integral):
+            return self.get_frame(item)
+        with self._lock:
+            return self.dataset[item]
+
+    def get_frame(self, index: int) -> numpy.ndarray:
+        """Return the frame from the cache, or read it with the next ones. The returned frame is read-only."""
+        with self._lock:
+            nb_frames = self.dataset.shape[0]
+            if index < 0:
+                index += nb_frames
+            if not 0 <= index < nb_frames:
+                raise IndexError(f"Frame {index} is out of a stack of {nb_frames} images")
+            if index in self._frames:
+                self._frames.move_to_end(index)
+                return self._frames[index]
+            stop = min(index + self.read_ahead, nb_frames)
+            for frame_index, frame in enumerate(self.dataset[index: stop], start=index):
+                # A copy does not keep the whole block alive
+                frame = frame.copy()
+                frame.setflags(write=False)
+                self._frames[frame_index] = frame
+                self._frames.move_to_end(frame_index)
+            # The asked frame is the last one to be evicted
+            self._frames.move_to_end(index)
+            while len(self._frames) > self.cache_size:
+                self._frames.popitem(last=False)
+            return self._frames[index]
+
+    def refresh(self) -> int:
+        """Update the stack with the frames written since the last refresh and return the number of frames."""
+        with self._lock:
+            if self.h5file.swmr_mode:
+                self.dataset.refresh()
+            else:
+                file_version = get_file_version(self.path)
+                if file_version != self._file_version:
+                    self._reopen()
+                    self._file_version = file_version
+            # The frames already read are kept, the written frames do not change
+            return self.dataset.shape[0]
+
+    def get_angles(self) -> (numpy.ndarray, numpy.ndarray):
+        """return the delta and gamma arrays of the scan, read from the open file: in SWMR mode, the file can't be
+        opened a second time by the same process."""
+        with self._lock:
+            return read_angles(self.h5file)
+
+    def _reopen(self) -> None:
+        # The file must be closed first: hdf5 would give back the open file, whose cached metadata ignore what was
+        # written since
+        self.h5file.close()
+        for attempt in range(REOPEN_ATTEMPTS):
+            try:
+                self.h5file, self.dataset = self._open()
+                return
+            except OSError:
+                # The writer is in the middle of an update
+                if attempt == REOPEN_ATTEMPTS - 1:
+                    raise
+                time.sleep(REOPEN_DELAY)
+
+    def _open(self):
+        try:
+            h5file = File(self.path, mode='r')
+        except OSError:
+            # A file written in SWMR mode can only be read in SWMR mode
+            h5file = File(self.path, mode='r', libver='latest', swmr=True)
+        dataset = get_dataset(h5file, DataPath.IMAGE_INTERPRETATION.value)
+        if dataset is None:
+            h5file.close()
+            raise TypeError(f"{self.path} does not contain any image")
+        return h5file, dataset
+
+    def close(self) -> None:
+        with self._lock:
+            self._frames.clear()
+            self.h5file.close()
+
+
+class FlatfieldCorrectedStack:
+    """Stack of images divided by a flatfield, each frame being corrected when it is read.
+
+    The inverse of the flatfield is computed once, as float32, so that a frame only costs a multiplication and the
+    corrected stack is never held in memory. Like LazyImageStack, it can be given to silx StackView."""
+    # Tells silx to handle the stack as a dataset
+    h5_class = H5Type.DATASET
+    dtype = numpy.dtype(numpy.float32)
+
+    def __init__(self, images, flatfield: numpy.ndarray):
+        self.images = images
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            # the dead pixels of the flatfield give inf or nan, as the division did
+            self.inverse_flatfield = (1.0 / numpy.asarray(flatfield, dtype=numpy.float64)).astype(numpy.float32)
+
+    @property
+    def shape(self) -> tuple:
+        return tuple(self.images.shape)
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def size(self) -> int:
+        return int(numpy.prod(self.shape))
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __array__(self, dtype=None, copy=None):
+        return numpy.asarray(self[:], dtype=dtype)
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item,)
+        frames = numpy.asarray(self.images[item[0]], dtype=numpy.float32)
+        with numpy.errstate(invalid='ignore'):
+            corrected = frames * self.inverse_flatfield
+        if isinstance(item[0], numbers.Integral):
+            return corrected[item[1:]]
+        return corrected[(slice(None),) + item[1:]]
+
+
+class MemmapImageStack:
+    """Stack of the images of a scan mapped in memory from its sidecar, see save_frame_sidecar.
+
+    Nothing is read when the stack is opened: the pages of the frames are read by the system when they are used and
+    are shared by all the processes mapping the same sidecar. Slices are views of the mapped file."""
+    # Tells silx to handle the stack as a dataset
+    h5_class = H5Type.DATASET
+
+    def __init__(self, path: str):
+        self.path = path
+        frames_path, header_path = get_sidecar_paths(path)
+        with open(header_path) as header_file:
+            header = json.load(header_file)
+        if tuple(header["version"]) != get_file_version(path):
+            raise ValueError("the scan changed since they were saved")
+        self.frames = numpy.load(frames_path, mmap_mode='r')
+        if self.frames.shape != tuple(header["shape"]):
+            raise ValueError(f"{frames_path} holds {self.frames.shape} frames instead of {tuple(header['shape'])}")
+        self.delta_array = None if header["delta"] is None else numpy.asarray(header["delta"])
+        self.gamma_array = None if header["gamma"] is None else numpy.asarray(header["gamma"])
+
+    @property
+    def shape(self) -> tuple:
+        return self.frames.shape
+
+    @property
+    def dtype(self) -> numpy.dtype:
+        return self.frames.dtype
+
+    @property
+    def ndim(self) -> int:
+        return self.frames.ndim
+
+    @property
+    def size(self) -> int:
+        return self.frames.size
+
+    def __len__(self) -> int:
+        return self.frames.shape[0]
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    def __array__(self, dtype=None, copy=None):
+        return numpy.asarray(self.frames, dtype=dtype)
+
+    def __getitem__(self, item):
+        return self.frames[item]
+
+    def get_frame(self, index: int) -> numpy.ndarray:
+        return self.frames[index]
+
+    def refresh(self) -> int:
+        # The sidecar is only used while the scan is unchanged
+        return len(self)
+
+    def get_angles(self) -> (numpy.ndarray, numpy.ndarray):
+        """return copies of the delta and gamma arrays saved with the frames."""
+        return tuple(None if angles is None else angles.copy() for angles in (self.delta_array, self.gamma_array))
+
+    def close(self) -> None:
+        # The file is unmapped once the last view of the frames is released
+        self.frames = numpy.zeros((0,) + self.frames.shape[1:], dtype=self.frames.dtype)
+
+
+def get_file_version(path: str) -> tuple:
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def get_sidecar_paths(path: str) -> (str, str):
+    """return the paths of the frames and of the header of the sidecar of a scan."""
+    root = os.path.splitext(path)[0]
+    return root + SIDECAR_FRAMES_SUFFIX, root + SIDECAR_HEADER_SUFFIX
+
+
+def save_frame_sidecar(images: LazyImageStack, on_progress=None) -> str:
+    """Copy the frames of a scan in an uncompressed .npy file saved next to the scan, with a JSON header holding the
+    angles and the version of the scan file, so that the scan is then mapped in memory instead of being decompressed
+    (see open_image_stack). on_progress is called with the number of frames copied by each block.
+    return the path of the frames."""
+    frames_path, header_path = get_sidecar_paths(images.path)
+    delta_array, gamma_array = images.get_angles()
+    header = {"scan": os.path.basename(images.path), "version": list(get_file_version(images.path)),
+              "shape": list(images.shape), "dtype": numpy.dtype(images.dtype).str,
+              "delta": None if delta_array is None else numpy.asarray(delta_array, dtype=numpy.float64).tolist(),
+              "gamma": None if gamma_array is None else numpy.asarray(gamma_array, dtype=numpy.float64).tolist()}
+    # The header is written last: a sidecar without header is never used
+    if os.path.exists(header_path):
+        os.remove(header_path)
+    temporary_path = frames_path + ".tmp"
+    try:
+        frames = numpy.lib.format.open_memmap(temporary_path, mode='w+', dtype=images.dtype, shape=images.shape)
+        for start in range(0, len(images), SIDECAR_BLOCK_SIZE):
+            stop = min(start + SIDECAR_BLOCK_SIZE, len(images))
+            frames[start: stop] = images[start: stop]
+            if on_progress is not None:
+                on_progress(stop - start)
+        frames.flush()
+        del frames
+        os.replace(temporary_path, frames_path)
+    except Exception:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    with open(header_path + ".tmp", "w") as header_file:
+        json.dump(header, header_file)
+    os.replace(header_path + ".tmp", header_path)
+    return frames_path
+
+
+def open_image_stack(path: str):
+    """return the images of a scan, mapped in memory from its sidecar when it was saved from the current version of
+    the scan, read from the scan file otherwise."""
+    _, header_path = get_sidecar_paths(path)
+    if os.path.isfile(header_path):
+        try:
+            return MemmapImageStack(path)
+        except (OSError, ValueError, KeyError) as error:
+            print(f"The frames saved next to {path} are not used: {error}")
+    return LazyImageStack(path)
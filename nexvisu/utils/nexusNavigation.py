@@ -1,8 +1,11 @@
+from collections import OrderedDict
 from functools import partial
 from h5py import Dataset, File
 from typing import NamedTuple, Optional, Text, Union
 
+import numpy
 import os
+import threading
 
 # Generic hdf5 access types.
 DatasetPathContains = NamedTuple("DatasetPathContains", [("path", Text)])
@@ -16,18 +19,105 @@ DatasetPathWithAttribute = NamedTuple("DatasetPathWithAttribute",
 DatasetPath = Union[DatasetPathContains,
                     DatasetPathWithAttribute]
 
+# Attributes whose values are indexed, lookups on other attributes still walk the file
+INDEXED_ATTRIBUTES = ("interpretation", "long_name")
+# Number of file indexes kept in memory
+INDEX_CACHE_SIZE = 32
+
+_file_indexes = OrderedDict()
+# The indexes are looked up by the unfolding threads and the gui thread
+_file_indexes_lock = threading.Lock()
+
+
+class FileIndex:
+    """Names of all the nodes of a hdf5 file, and of the datasets holding the indexed attributes,
+    gathered in a single walk of the file. Each name is indexed by all the runs of its consecutive components, so that
+    a key made of whole components, as "d13-1-cx1__ex__dif.1-delta/raw_value", is found without going through the
+    names."""
+    def __init__(self, h5file: File):
+        self.names = []
+        self.components = {}
+        self.attributes = {}
+        self._contains = {}
+        h5file.visititems(self._index)
+
+    def _index(self, name: Text, obj) -> None:
+        self.names.append(name)
+        components = name.split("/")
+        for first in range(len(components)):
+            for last in range(first + 1, len(components) + 1):
+                # Like a walk, the first name met wins
+                self.components.setdefault("/".join(components[first: last]), name)
+        if isinstance(obj, Dataset):
+            for attribute in INDEXED_ATTRIBUTES:
+                if attribute in obj.attrs:
+                    value = obj.attrs[attribute]
+                    if isinstance(value, numpy.ndarray) and value.size == 1:
+                        value = value.item()
+                    try:
+                        # Like a walk, the first dataset met wins
+                        self.attributes.setdefault((attribute, value), name)
+                    except TypeError:
+                        # Non scalar values can not be looked up
+                        pass
+
+    def find_name_containing(self, key: Text) -> Optional[Text]:
+        name = self.components.get(key)
+        if name is not None:
+            return name
+        # A key holding a part of a component, as "/data", is looked for in all the names once
+        if key not in self._contains:
+            self._contains[key] = next((name for name in self.names if key in name), None)
+        return self._contains[key]
+
+    def find_attribute(self, attribute: Text, value) -> Optional[Text]:
+        return self.attributes.get((attribute, value))
+
 
 def get_dataset(h5file: File, path: DatasetPath) -> Optional[Dataset]:
     res = None
+    name = None
     if isinstance(path, DatasetPathContains):
-        res = h5file.visititems(partial(_v_item, path.path))
+        name = get_file_index(h5file).find_name_containing(path.path)
     elif isinstance(path, DatasetPathContainsDefault):
-        res = h5file.visititems(partial(_v_item, path.path))
+        name = get_file_index(h5file).find_name_containing(path.path)
     elif isinstance(path, DatasetPathWithAttribute):
-        res = h5file.visititems(partial(_v_attrs,  path.attribute, path.value))
+        if path.attribute in INDEXED_ATTRIBUTES:
+            name = get_file_index(h5file).find_attribute(path.attribute, path.value)
+        else:
+            res = h5file.visititems(partial(_v_attrs,  path.attribute, path.value))
+    if name is not None:
+        res = h5file[name]
     return res
 
 
+def get_file_index(h5file: File) -> FileIndex:
+    """return the index of the file, built once for each version of the file on the disk."""
+    try:
+        stat = os.stat(h5file.filename)
+        key = (os.path.realpath(h5file.filename), stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        # In memory files are indexed every time
+        return FileIndex(h5file)
+    with _file_indexes_lock:
+        if key in _file_indexes:
+            _file_indexes.move_to_end(key)
+            return _file_indexes[key]
+    # The file is walked out of the lock, a file indexed by two threads at once keeps the first index
+    file_index = FileIndex(h5file)
+    with _file_indexes_lock:
+        file_index = _file_indexes.setdefault(key, file_index)
+        _file_indexes.move_to_end(key)
+        while len(_file_indexes) > INDEX_CACHE_SIZE:
+            _file_indexes.popitem(last=False)
+    return file_index
+
+
+def clear_file_indexes() -> None:
+    with _file_indexes_lock:
+        _file_indexes.clear()
+
+
 def get_current_directory() -> str:
     """return the path of the current directory,
     aka where the script is running."""
@@ -39,8 +129,3 @@ def _v_attrs(attribute: Text, value: Text, _name: Text, obj) -> Dataset:
     if isinstance(obj, Dataset):
         if attribute in obj.attrs and obj.attrs[attribute] == value:
             return obj
-
-
-def _v_item(key: Text, name: Text, obj: Dataset) -> Dataset:
-    if key in name:
-        return obj
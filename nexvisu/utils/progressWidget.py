@@ -17,3 +17,7 @@ class ProgressWidget(QDialog):
 
     def increase_progress(self, value=1):
         self.progress.setValue(self.progress.value() + value)
+
+    def increase_maximum(self, value=1):
+        self.maximum += value
+        self.progress.setMaximum(self.maximum - 1)
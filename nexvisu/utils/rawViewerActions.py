@@ -1,8 +1,9 @@
-import numpy
 from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import QInputDialog
 from silx.gui.plot.actions import PlotAction
 
+from utils.lazyImageStack import FlatfieldCorrectedStack
+
 
 class DataViewerMovie(PlotAction):
     """QAction that runs a movie of the stacked images
@@ -101,26 +102,30 @@ class UseFlatfield(PlotAction):
                             parent=parent)
         self.flatfield = flatfield
         self.images = images
+        # Images divided by the flatfield when they are displayed, created by the first use of the flatfield
+        self.corrected_images = None
         self.already_triggered = False
 
     def use_flatfield(self):
         index_image = self.parent().getFrameNumber()
         if self.already_triggered or self.flatfield is None:
             self.parent().setStack(self.images)
-            self.parent().setFrameNumber(index_image)
-            self.parent().setColormap("viridis", autoscale=True, normalization='log')
             self.already_triggered = False
         else:
-            numpy.seterr(divide='ignore', invalid='ignore')
-            images = [image / self.flatfield for image in self.images]
-            self.parent().setStack(images)
-            self.parent().setFrameNumber(index_image)
-            self.parent().setColormap("viridis", autoscale=True, normalization='log')
+            if self.corrected_images is None:
+                self.corrected_images = FlatfieldCorrectedStack(self.images, self.flatfield)
+            self.parent().setStack(self.corrected_images)
             self.already_triggered = True
-            numpy.seterr(divide='raise', invalid='raise')
+        self.parent().setFrameNumber(index_image)
+        self.parent().setColormap("viridis", autoscale=True, normalization='log')
 
     def set_flatfield(self, flatfield):
         self.flatfield = flatfield
+        self.corrected_images = None
 
     def set_images(self, images):
         self.images = images
+        self.corrected_images = None
+
+    def get_displayed_images(self):
+        return self.corrected_images if self.already_triggered else self.images
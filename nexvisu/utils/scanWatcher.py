@@ -0,0 +1,43 @@
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+
+from utils.lazyImageStack import LazyImageStack
+
+# Time between two looks at a scan being written, in milliseconds
+WATCH_INTERVAL = 250
+
+
+class ScanWatcher(QObject):
+    """Follow a scan while it is written, by refreshing its image stack at regular intervals."""
+    # Range [start, stop) of the frames written since the last emission
+    framesAdded = pyqtSignal(int, int)
+
+    def __init__(self, images: LazyImageStack, interval: int = WATCH_INTERVAL, parent=None):
+        super().__init__(parent)
+        self.images = images
+        self.nb_frames = len(images)
+        self.timer = QTimer(self)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.poll)
+
+    def start(self) -> None:
+        # Frames may have been written before the watch started
+        self.poll()
+        self.timer.start()
+
+    def stop(self) -> None:
+        self.timer.stop()
+
+    def is_watching(self) -> bool:
+        return self.timer.isActive()
+
+    def poll(self) -> None:
+        try:
+            nb_frames = self.images.refresh()
+        except (OSError, KeyError, ValueError) as error:
+            # The file can be unreadable for a moment while the writer updates it
+            print(f"Can't look for new frames in {self.images.path}: {error}")
+            return
+        if nb_frames > self.nb_frames:
+            start = self.nb_frames
+            self.nb_frames = nb_frames
+            self.framesAdded.emit(start, nb_frames)
@@ -0,0 +1,77 @@
+import numpy
+
+
+class UnfoldedStack:
+    """Stack of unfolded images, stored as one (N, M) matrix of intensities and the 2θ and ψ maps of each position.
+
+    The images recorded at the same (delta, gamma) position share the same read-only maps, found by the angle key of
+    the image: a scan with a static detector holds a single pair of maps. The maps are the arrays of the angles cache
+    of imageProcessing, so stacks unfolded at the same positions also share them, and a map is freed once no stack nor
+    the cache refer to it. An image is read as the (two theta, psi, intensity) tuple of a list of unfolded images."""
+    def __init__(self, capacity: int = 0):
+        # Number of images the intensity matrix is first allocated for, it grows when more are added
+        self.capacity = capacity
+        self.angle_maps = {}
+        self.angle_keys = []
+        self.intensities = None
+
+    def __len__(self) -> int:
+        return len(self.angle_keys)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.get_scatter_item(item) for item in range(*index.indices(len(self)))]
+        return self.get_scatter_item(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.get_scatter_item(index)
+
+    @property
+    def nbytes(self) -> int:
+        maps = sum(two_theta.nbytes + psi.nbytes for two_theta, psi in self.angle_maps.values())
+        return maps + (0 if self.intensities is None else self.intensities[:len(self)].nbytes)
+
+    def get_scatter_item(self, index: int) -> tuple:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Image {index} is out of a stack of {len(self)} images")
+        two_theta, psi = self.angle_maps[self.angle_keys[index]]
+        return two_theta, psi, self.intensities[index]
+
+    def extend(self, angle_keys: list, angle_maps: dict, intensities: numpy.ndarray) -> None:
+        """Add images: the angle key of each, the (2θ, ψ) maps of their keys and their (n, M) intensities.
+        When the first images fill the capacity of the stack, it takes ownership of their intensities array instead
+        of copying it: the caller must not change that array afterwards."""
+        start = len(self)
+        stop = start + len(angle_keys)
+        if self.intensities is None and stop >= self.capacity:
+            self.intensities = intensities
+        else:
+            self._reserve(stop, intensities)
+            self.intensities[start: stop] = intensities
+        for key in angle_keys:
+            if key not in self.angle_maps:
+                self.angle_maps[key] = angle_maps[key]
+        self.angle_keys += list(angle_keys)
+
+    def copy(self):
+        """return a stack sharing the maps of this one, that images can be added to without changing this one."""
+        stack = UnfoldedStack(len(self))
+        stack.angle_maps = dict(self.angle_maps)
+        stack.angle_keys = list(self.angle_keys)
+        if self.intensities is not None:
+            stack.intensities = self.intensities[:len(self)].copy()
+        return stack
+
+    def _reserve(self, nb_images: int, intensities: numpy.ndarray) -> None:
+        if self.intensities is None:
+            self.intensities = numpy.empty((max(nb_images, self.capacity),) + intensities.shape[1:],
+                                           dtype=intensities.dtype)
+        elif nb_images > self.intensities.shape[0]:
+            # The stack doubles, images are added one chunk at a time to a scan being written
+            grown = numpy.empty((max(nb_images, 2 * self.intensities.shape[0]),) + self.intensities.shape[1:],
+                                dtype=self.intensities.dtype)
+            grown[:len(self)] = self.intensities[:len(self)]
+            self.intensities = grown